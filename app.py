@@ -1,85 +1,211 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from modules.controller import Pipeline
-import copy
+from modules.cache import cache_stats
+from modules.metrics import METRICS
+from modules.trace_sink import TraceSink
+from modules.jobs import JobQueue
+import atexit
+import os
 import sys
 import json
 
-app = Flask(__name__)
-CORS(app)  # Allow cross-origin requests if needed
-
-# Initialize pipeline once
-docs_path = "C:\\Users\\Balanagaiah\\Desktop\\Mini_Agentic_Pipeline\\kb_docs"  # Adjust as needed
-try:
-    pipeline = Pipeline(docs_path=docs_path, prompt_version="v2")
-except FileNotFoundError as fnf_error:
-    print(f"[Error] KB folder not found: {fnf_error}")
-    sys.exit(1)
-except Exception as e:
-    print(f"[Error] Failed to initialize pipeline: {e}")
-    sys.exit(1)
-
-
-@app.route("/query", methods=["POST"])
-def query_pipeline():
-    try:
-        data = request.json
+DOCS_PATH = "C:\\Users\\Balanagaiah\\Desktop\\Mini_Agentic_Pipeline\\kb_docs"  # Adjust as needed (or set KB_DOCS_PATH)
+
+
+def create_app(docs_path=None, pipeline=None):
+    """
+    Builds the Flask app around one Pipeline. Used by the dev server below and by gunicorn
+    ("app:create_app()", see gunicorn.conf.py), where the pipeline is built once in the master
+    and the KB index is memory-mapped so all workers share it.
+    """
+    app = Flask(__name__)
+    CORS(app)  # Allow cross-origin requests if needed
+
+    if pipeline is None:
+        docs_path = docs_path or os.getenv("KB_DOCS_PATH", DOCS_PATH)
+        try:
+            pipeline = Pipeline(docs_path=docs_path, prompt_version="v2")
+        except FileNotFoundError as fnf_error:
+            print(f"[Error] KB folder not found: {fnf_error}")
+            sys.exit(1)
+        except Exception as e:
+            print(f"[Error] Failed to initialize pipeline: {e}")
+            sys.exit(1)
+
+    # every answered query is appended (NDJSON) as it finishes; shared by all requests
+    trace_sink = TraceSink(os.getenv("TRACE_PATH", "answers_trace.jsonl"), answers_path="answers.txt")
+    atexit.register(trace_sink.close)
+    app.extensions["pipeline"] = pipeline
+    app.extensions["trace_sink"] = trace_sink
+    # large batches: POST /jobs queues them for background workers (JOB_WORKERS, optional JOBS_DB)
+    jobs = JobQueue(pipeline, sink=trace_sink)
+    app.extensions["jobs"] = jobs
+
+    @app.before_request
+    def start_job_workers():
+        jobs.start()  # once per process, so pre-forked workers each get their own pool
+
+    @app.route("/query", methods=["POST"])
+    def query_pipeline():
+        try:
+            data = request.json
+            if not data:
+                return jsonify({"error": "No JSON payload received"}), 400
+
+            queries = data.get("queries")
+            truncate = data.get("truncate", True)  # optional flag for truncated answers
+
+            # Validation
+            if not queries or not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+                return jsonify({"error": "Queries must be a list of strings"}), 400
+
+            # optional LLM answer over the KB/Tavily text; only then is an answer prompt used, so the
+            # per-request prompt ("prompt_version": "v3" or "prompt_ab": {"v1": 50, "v2": 50}) needs it
+            synthesize = bool(data.get("synthesize", False))
+            prompt_version, prompt_ab = data.get("prompt_version"), data.get("prompt_ab")
+            if prompt_ab is not None and not isinstance(prompt_ab, dict):
+                return jsonify({"error": "prompt_ab must map prompt versions to weights"}), 400
+            try:
+                pipeline.prompt_versions([""], prompt_version, prompt_ab, synthesize)
+            except (ValueError, TypeError) as e:
+                return jsonify({"error": str(e)}), 400
+
+            # Run pipeline (answers and traces are appended to answers.txt / answers_trace.jsonl)
+            answers, traces = pipeline.run_queries(queries, sink=trace_sink, synthesize=synthesize,
+                                                  prompt_version=prompt_version, prompt_ab=prompt_ab)
+
+            # Handle optional truncation for API response
+            if truncate:
+                truncated_answers = [ans[:500] + "..." if len(ans) > 500 else ans for ans in answers]
+            else:
+                truncated_answers = answers
+
+            return jsonify({
+                "answers": truncated_answers,
+                "traces": traces
+            })
+
+        except Exception as e:
+            print(f"[Exception] {e}")
+            return jsonify({"error": str(e)}), 500
+
+    @app.route("/query/stream", methods=["POST"])
+    def query_pipeline_stream():
+        """
+        Streams per-query progress as NDJSON (one JSON event per line): retrieval_done, decision,
+        tool_started/tool_done, answer_token (when "synthesize" is true) and result as each query finishes.
+        """
+        data = request.get_json(silent=True)
         if not data:
             return jsonify({"error": "No JSON payload received"}), 400
 
         queries = data.get("queries")
-        truncate = data.get("truncate", True)  # optional flag for truncated answers
+        synthesize = bool(data.get("synthesize", False))  # optional LLM answer streamed token by token
 
         # Validation
         if not queries or not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
             return jsonify({"error": "Queries must be a list of strings"}), 400
 
-        # Optional: limit number of queries to prevent overload
-        queries = queries[:10]
+        prompt_version, prompt_ab = data.get("prompt_version"), data.get("prompt_ab")  # need synthesize
+        if prompt_ab is not None and not isinstance(prompt_ab, dict):
+            return jsonify({"error": "prompt_ab must map prompt versions to weights"}), 400
+        try:
+            pipeline.prompt_versions([""], prompt_version, prompt_ab, synthesize)
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": str(e)}), 400
+
+        def generate():
+            try:
+                for event in pipeline.stream_queries(queries, synthesize=synthesize, sink=trace_sink,
+                                                     prompt_version=prompt_version, prompt_ab=prompt_ab):
+                    yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
+            except Exception as e:
+                print(f"[Exception] {e}")
+                yield json.dumps({"event": "error", "error": str(e)}) + "\n"
+
+        # X-Accel-Buffering stops reverse proxies from buffering the stream
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @app.route("/jobs", methods=["POST"])
+    def submit_job():
+        """
+        Queues a batch (up to JOB_MAX_QUERIES queries) and returns its job id at once; poll
+        GET /jobs/<id> for progress and results. Accepts synthesize / prompt_version / prompt_ab
+        like /query.
+        """
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify({"error": "No JSON payload received"}), 400
 
-        # Run pipeline
-        answers, traces = pipeline.run_queries(queries)
+        queries = data.get("queries")
+        prompt_ab = data.get("prompt_ab")
 
-        # Save truncated answers to text file
+        # Validation
+        if not queries or not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+            return jsonify({"error": "Queries must be a list of strings"}), 400
+        if prompt_ab is not None and not isinstance(prompt_ab, dict):
+            return jsonify({"error": "prompt_ab must map prompt versions to weights"}), 400
         try:
-            with open("answers.txt", "w", encoding="utf-8") as f:
-                for ans in answers:
-                    f.write(ans + "\n\n")
-            print("[Info] Answers saved to answers.txt")
+            job_id, reused = jobs.submit(queries, bool(data.get("synthesize", False)), data.get("prompt_version"),
+                                         prompt_ab)
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": str(e)}), 400
         except Exception as e:
-            print(f"[Warning] Could not save answers.txt: {e}")
+            print(f"[Exception] {e}")
+            return jsonify({"error": str(e)}), 500
+        return jsonify({"job_id": job_id, "total": len(queries), "reused": reused, "status_url": f"/jobs/{job_id}"}), 202
 
-        # Save full traces to JSON file
+    @app.route("/jobs/<job_id>", methods=["GET"])
+    def job_status(job_id):
+        # progress counters plus one page of results: ?offset=0&limit=100 (limit <= 1000)
         try:
-            serializable_traces = copy.deepcopy(traces)
-            for trace in serializable_traces.values():
-                trace["reasoning_trace"] = {k: str(v) for k, v in trace["reasoning_trace"].items()}
-            with open("answers_trace.json", "w", encoding="utf-8") as f:
-                json.dump(serializable_traces, f, indent=4, ensure_ascii=False)
-            print("[Info] Traces saved to answers_trace.json")
-        except Exception as e:
-            print(f"[Warning] Could not save answers_trace.json: {e}")
-
-        # Handle optional truncation for API response
-        if truncate:
-            truncated_answers = [ans[:500] + "..." if len(ans) > 500 else ans for ans in answers]
-        else:
-            truncated_answers = answers
-
-        return jsonify({
-            "answers": truncated_answers,
-            "traces": serializable_traces
-        })
-
-    except Exception as e:
-        print(f"[Exception] {e}")
-        return jsonify({"error": str(e)}), 500
-
-
-@app.route("/health", methods=["GET"])
-def health_check():
-    return jsonify({"status": "ok"})
+            offset = max(0, int(request.args.get("offset", 0)))
+            limit = min(1000, max(1, int(request.args.get("limit", 100))))
+        except ValueError:
+            return jsonify({"error": "offset and limit must be integers"}), 400
+        job = jobs.get(job_id, offset, limit)
+        if job is None:
+            return jsonify({"error": f"Unknown job: {job_id}"}), 404
+        return jsonify(job)
+
+    @app.route("/cache/stats", methods=["GET"])
+    def cache_statistics():
+        # hit/miss/eviction counters per cache namespace (retriever, reasoner, actor, semantic),
+        # plus speculative Tavily prefetches (launched / used / wasted)
+        stats = cache_stats()
+        stats["semantic"] = pipeline.semantic_cache.stats()
+        stats["speculation"] = pipeline.speculation.stats()
+        return jsonify(stats)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        # Prometheus text format: per-stage p50/p95/p99 latencies, token/LLM call counters, cache hit ratios
+        stats = cache_stats()
+        stats["semantic"] = pipeline.semantic_cache.stats()
+        embeddings = pipeline.retriever.embeddings
+        stats["embeddings"] = {
+            "hits": embeddings.hits,
+            "misses": embeddings.misses,
+            "hit_ratio": round(embeddings.hits / (embeddings.hits + embeddings.misses), 4) if embeddings.hits + embeddings.misses else 0.0,
+        }
+        return METRICS.render_prometheus(stats), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+    @app.route("/prompts", methods=["GET"])
+    def prompt_stats():
+        # discovered prompt versions with their content hash and per-version latency / LLM usage
+        return jsonify({"default": pipeline.reasoner.prompt_version, "versions": pipeline.prompts.stats()})
+
+    @app.route("/health", methods=["GET"])
+    def health_check():
+        # "degraded" while a provider's circuit is open (those queries are answered from the KB)
+        providers = {name: provider.status() for name, provider in pipeline.providers.items()}
+        degraded = any(status["circuit"] != "closed" for status in providers.values())
+        return jsonify({"status": "degraded" if degraded else "ok", "providers": providers})
+
+    return app
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    create_app().run(host="0.0.0.0", port=5000, debug=True)
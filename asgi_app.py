@@ -0,0 +1,175 @@
+from quart import Quart, request, jsonify
+from quart_cors import cors
+from modules.controller import Pipeline
+from modules.cache import cache_stats
+from modules.metrics import METRICS
+from modules.trace_sink import TraceSink
+from modules.jobs import JobQueue
+import asyncio
+import os
+import sys
+
+# ASGI variant of app.py: the whole pipeline runs on the event loop (Pipeline.arun),
+# so one worker keeps many LLM/tool calls in flight instead of blocking per request.
+# Run with: uvicorn asgi_app:create_app --factory --port 8000
+# (with --workers N, set KB_INDEX_SHARED=1 so the workers map one copy of the KB index,
+# and JOBS_DB so /jobs is one queue shared by every worker)
+
+
+def create_app(docs_path=None, pipeline=None):
+    """Builds the Quart app around one Pipeline (see app.create_app)."""
+    app = cors(Quart(__name__))  # Allow cross-origin requests if needed
+
+    if pipeline is None:
+        docs_path = docs_path or os.getenv("KB_DOCS_PATH", "kb_docs")
+        try:
+            pipeline = Pipeline(docs_path=docs_path, prompt_version="v2")
+        except FileNotFoundError as fnf_error:
+            print(f"[Error] KB folder not found: {fnf_error}")
+            sys.exit(1)
+        except Exception as e:
+            print(f"[Error] Failed to initialize pipeline: {e}")
+            sys.exit(1)
+
+    # every answered query is appended (NDJSON) in batches, never a full-file rewrite
+    trace_sink = TraceSink(os.getenv("TRACE_PATH", "answers_trace.jsonl"), answers_path="answers.txt")
+    app.extensions["pipeline"] = pipeline
+    app.extensions["trace_sink"] = trace_sink
+    # large batches: POST /jobs queues them for background workers (JOB_WORKERS, optional JOBS_DB)
+    jobs = JobQueue(pipeline, sink=trace_sink)
+    app.extensions["jobs"] = jobs
+
+    @app.before_request
+    async def start_job_workers():
+        jobs.start()  # once per process, so pre-forked workers each get their own pool
+
+    @app.after_serving
+    async def close_trace_sink():
+        jobs.stop()
+        trace_sink.close()
+
+    @app.route("/query", methods=["POST"])
+    async def query_pipeline():
+        try:
+            data = await request.get_json()
+            if not data:
+                return jsonify({"error": "No JSON payload received"}), 400
+
+            queries = data.get("queries")
+            truncate = data.get("truncate", True)  # optional flag for truncated answers
+
+            # Validation
+            if not queries or not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+                return jsonify({"error": "Queries must be a list of strings"}), 400
+
+            # optional LLM answer over the KB/Tavily text; only then is an answer prompt used, so the
+            # per-request prompt ("prompt_version": "v3" or "prompt_ab": {"v1": 50, "v2": 50}) needs it
+            synthesize = bool(data.get("synthesize", False))
+            prompt_version, prompt_ab = data.get("prompt_version"), data.get("prompt_ab")
+            if prompt_ab is not None and not isinstance(prompt_ab, dict):
+                return jsonify({"error": "prompt_ab must map prompt versions to weights"}), 400
+            try:
+                pipeline.prompt_versions([""], prompt_version, prompt_ab, synthesize)
+            except (ValueError, TypeError) as e:
+                return jsonify({"error": str(e)}), 400
+
+            # Run pipeline (answers and traces are appended to answers.txt / answers_trace.jsonl)
+            answers, traces = await pipeline.arun(queries, sink=trace_sink, synthesize=synthesize,
+                                                 prompt_version=prompt_version, prompt_ab=prompt_ab)
+
+            # Handle optional truncation for API response
+            if truncate:
+                truncated_answers = [ans[:500] + "..." if len(ans) > 500 else ans for ans in answers]
+            else:
+                truncated_answers = answers
+
+            return jsonify({
+                "answers": truncated_answers,
+                "traces": traces
+            })
+
+        except Exception as e:
+            print(f"[Exception] {e}")
+            return jsonify({"error": str(e)}), 500
+
+    @app.route("/jobs", methods=["POST"])
+    async def submit_job():
+        """
+        Queues a batch (up to JOB_MAX_QUERIES queries) and returns its job id at once; poll
+        GET /jobs/<id> for progress and results. Accepts synthesize / prompt_version / prompt_ab
+        like /query.
+        """
+        data = await request.get_json(silent=True)
+        if not data:
+            return jsonify({"error": "No JSON payload received"}), 400
+
+        queries = data.get("queries")
+        prompt_ab = data.get("prompt_ab")
+
+        # Validation
+        if not queries or not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+            return jsonify({"error": "Queries must be a list of strings"}), 400
+        if prompt_ab is not None and not isinstance(prompt_ab, dict):
+            return jsonify({"error": "prompt_ab must map prompt versions to weights"}), 400
+        try:
+            job_id, reused = await asyncio.to_thread(jobs.submit, queries, bool(data.get("synthesize", False)),
+                                                    data.get("prompt_version"), prompt_ab)
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            print(f"[Exception] {e}")
+            return jsonify({"error": str(e)}), 500
+        return jsonify({"job_id": job_id, "total": len(queries), "reused": reused, "status_url": f"/jobs/{job_id}"}), 202
+
+    @app.route("/jobs/<job_id>", methods=["GET"])
+    async def job_status(job_id):
+        # progress counters plus one page of results: ?offset=0&limit=100 (limit <= 1000)
+        try:
+            offset = max(0, int(request.args.get("offset", 0)))
+            limit = min(1000, max(1, int(request.args.get("limit", 100))))
+        except ValueError:
+            return jsonify({"error": "offset and limit must be integers"}), 400
+        job = jobs.get(job_id, offset, limit)
+        if job is None:
+            return jsonify({"error": f"Unknown job: {job_id}"}), 404
+        return jsonify(job)
+
+    @app.route("/cache/stats", methods=["GET"])
+    async def cache_statistics():
+        # hit/miss/eviction counters per cache namespace (retriever, reasoner, actor, semantic),
+        # plus speculative Tavily prefetches (launched / used / wasted)
+        stats = cache_stats()
+        stats["semantic"] = pipeline.semantic_cache.stats()
+        stats["speculation"] = pipeline.speculation.stats()
+        return jsonify(stats)
+
+    @app.route("/metrics", methods=["GET"])
+    async def metrics():
+        # Prometheus text format: per-stage p50/p95/p99 latencies, token/LLM call counters, cache hit ratios
+        stats = cache_stats()
+        stats["semantic"] = pipeline.semantic_cache.stats()
+        embeddings = pipeline.retriever.embeddings
+        stats["embeddings"] = {
+            "hits": embeddings.hits,
+            "misses": embeddings.misses,
+            "hit_ratio": round(embeddings.hits / (embeddings.hits + embeddings.misses), 4) if embeddings.hits + embeddings.misses else 0.0,
+        }
+        return METRICS.render_prometheus(stats), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+    @app.route("/prompts", methods=["GET"])
+    async def prompt_stats():
+        # discovered prompt versions with their content hash and per-version latency / LLM usage
+        return jsonify({"default": pipeline.reasoner.prompt_version, "versions": pipeline.prompts.stats()})
+
+    @app.route("/health", methods=["GET"])
+    async def health_check():
+        # "degraded" while a provider's circuit is open (those queries are answered from the KB)
+        providers = {name: provider.status() for name, provider in pipeline.providers.items()}
+        degraded = any(status["circuit"] != "closed" for status in providers.values())
+        return jsonify({"status": "degraded" if degraded else "ok", "providers": providers})
+
+    return app
+
+
+if __name__ == "__main__":
+    create_app().run(host="0.0.0.0", port=8000)
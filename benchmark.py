@@ -0,0 +1,254 @@
+"""
+Offline benchmark for the pipeline.
+Runs Pipeline against the stub chat/embeddings/Tavily clients (modules/stubs.py) with
+injected latency and failure rates, sweeping KB size, query count and concurrency.
+Reports QPS, p50/p95/p99 query latency, peak RSS and cold-start time as JSON and markdown,
+and compares against a previous JSON run to flag regressions. No API keys needed.
+
+    python benchmark.py --kb-sizes 13,200 --query-counts 50,200 --concurrency 1,8 --latency 0.02
+    python benchmark.py --baseline benchmark_results.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import multiprocessing
+from pathlib import Path
+from contextlib import redirect_stdout
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if the platform cannot tell."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def make_kb(base_docs, num_docs, out_dir, seed=0):
+    """
+    Copies the real KB documents and pads the folder with synthetic ones (sentences of the
+    real documents reshuffled) until it holds num_docs files.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    sources = sorted(Path(base_docs).glob("*.txt"))
+    sentences = []
+    for i, path in enumerate(sources):
+        text = path.read_text(encoding="utf-8")
+        if i < num_docs:
+            (out_dir / path.name).write_text(text, encoding="utf-8")
+        sentences.extend(s.strip() + "." for s in text.split(".") if s.strip())
+    rng = random.Random(seed)
+    for i in range(len(sources), num_docs):
+        body = " ".join(rng.choice(sentences) for _ in range(20))
+        (out_dir / f"synthetic_{i:05d}.txt").write_text(body, encoding="utf-8")
+    return str(out_dir)
+
+def make_queries(templates, count):
+    """Unique queries built from the templates, so no query is answered from a cache."""
+    return [f"{templates[i % len(templates)]} (#{i})" for i in range(count)]
+
+def run_config(config):
+    """
+    Runs one benchmark configuration. Meant to run in a fresh process so caches,
+    cold start and peak RSS are not shared between configurations.
+    """
+    from modules.controller import Pipeline
+    from modules.metrics import Histogram
+
+    work_dir = tempfile.mkdtemp(prefix="pipeline_bench_")
+    try:
+        os.environ["KB_INDEX_DIR"] = os.path.join(work_dir, "kb_index")
+        os.environ["EMBEDDING_CACHE_DIR"] = os.path.join(work_dir, "embedding_cache")
+        os.environ.pop("PIPELINE_CACHE_DB", None)
+        docs_path = make_kb(config["base_docs"], config["kb_size"], os.path.join(work_dir, "kb_docs"))
+        queries = make_queries(config["templates"], config["queries"])
+
+        with redirect_stdout(io.StringIO()):  # the pipeline prints every answer
+            # cold start: split + embed + index the whole KB
+            start = time.perf_counter()
+            Pipeline(docs_path, provider="stub", stub_latency=0)
+            cold_start = time.perf_counter() - start
+
+            # warm start: index and embeddings loaded from disk
+            start = time.perf_counter()
+            pipeline = Pipeline(
+                docs_path, provider="stub", stub_latency=config["latency"],
+                stub_failure_rate=config["failure_rate"], max_workers=config["concurrency"],
+            )
+            warm_start = time.perf_counter() - start
+
+            start = time.perf_counter()
+            if config["mode"] == "async":
+                _, traces = asyncio.run(pipeline.arun(queries, max_in_flight=config["concurrency"]))
+            else:
+                _, traces = pipeline.run_queries(queries, max_workers=config["concurrency"])
+            wall_time = time.perf_counter() - start
+
+        latencies = Histogram(max_samples=len(queries) or 1)
+        for trace in traces.values():
+            latencies.observe(trace["latency"])
+        fallbacks = sum(1 for t in traces.values() if t.get("fallback"))  # answered from the KB after a provider failure
+        return {
+            "kb_size": config["kb_size"],
+            "queries": config["queries"],
+            "concurrency": config["concurrency"],
+            "mode": config["mode"],
+            "latency": config["latency"],
+            "failure_rate": config["failure_rate"],
+            "completed": len(traces),
+            "errors": len(queries) - len(traces) + fallbacks,
+            "wall_time": round(wall_time, 4),
+            "qps": round(len(traces) / wall_time, 2) if wall_time else 0.0,
+            "p50": round(latencies.percentile(50), 4),
+            "p95": round(latencies.percentile(95), 4),
+            "p99": round(latencies.percentile(99), 4),
+            "cold_start": round(cold_start, 4),
+            "warm_start": round(warm_start, 4),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    finally:
+        # generated KB, FAISS index and embedding cache of this configuration
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def config_key(result):
+    return (result["mode"], result["kb_size"], result["queries"], result["concurrency"])
+
+def compare(results, baseline, tolerance):
+    """
+    Regressions against a baseline run: QPS lower, or p95 / cold start higher,
+    by more than tolerance (fraction). Configurations missing from the baseline are skipped.
+    """
+    previous = {config_key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(config_key(result))
+        if old is None:
+            continue
+        checks = [
+            ("qps", old["qps"] and result["qps"] < old["qps"] * (1 - tolerance)),
+            ("p95", old["p95"] and result["p95"] > old["p95"] * (1 + tolerance)),
+            ("cold_start", old["cold_start"] and result["cold_start"] > old["cold_start"] * (1 + tolerance)),
+        ]
+        for metric, regressed in checks:
+            if regressed:
+                regressions.append({
+                    "config": dict(zip(("mode", "kb_size", "queries", "concurrency"), config_key(result))),
+                    "metric": metric,
+                    "baseline": old[metric],
+                    "current": result[metric],
+                })
+    return regressions
+
+def render_markdown(results, settings, regressions=None):
+    headers = ["Mode", "KB Docs", "Queries", "Concurrency", "QPS", "p50 (s)", "p95 (s)", "p99 (s)",
+               "Errors", "Cold Start (s)", "Warm Start (s)", "Peak RSS (MB)"]
+    rows = [[
+        r["mode"], str(r["kb_size"]), str(r["queries"]), str(r["concurrency"]), f"{r['qps']:.2f}",
+        f"{r['p50']:.4f}", f"{r['p95']:.4f}", f"{r['p99']:.4f}", str(r["errors"]),
+        f"{r['cold_start']:.3f}", f"{r['warm_start']:.3f}",
+        "-" if r["peak_rss_mb"] is None else f"{r['peak_rss_mb']:.1f}",
+    ] for r in results]
+    lines = [
+        "# Benchmark Report",
+        "",
+        f"- **Provider:** offline stubs, {settings['latency']}s simulated latency per call, "
+        f"{settings['failure_rate']:.0%} injected failures",
+        f"- **Python:** {sys.version.split()[0]} on {sys.platform}",
+        "",
+        "| " + " | ".join(headers) + " |",
+        "|" + "|".join("---" for _ in headers) + "|",
+    ]
+    lines.extend("| " + " | ".join(row) + " |" for row in rows)
+    if regressions is not None:
+        lines += ["", "## Regressions", ""]
+        if not regressions:
+            lines.append(f"None (tolerance {settings['tolerance']:.0%}).")
+        for reg in regressions:
+            config = reg["config"]
+            lines.append(
+                f"- {config['mode']} kb={config['kb_size']} queries={config['queries']} "
+                f"concurrency={config['concurrency']}: **{reg['metric']}** {reg['baseline']} → {reg['current']}"
+            )
+    return "\n".join(lines) + "\n"
+
+def parse_ints(text):
+    return [int(x) for x in text.split(",") if x.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark")
+    parser.add_argument("--docs-path", default="kb_docs", help="Real KB documents used as the seed corpus")
+    parser.add_argument("--queries-file", default="queries.txt", help="Query templates")
+    parser.add_argument("--kb-sizes", default="13,200", help="Comma-separated KB sizes (number of documents)")
+    parser.add_argument("--query-counts", default="50,200", help="Comma-separated query counts")
+    parser.add_argument("--concurrency", default="1,8", help="Comma-separated worker counts / max in-flight")
+    parser.add_argument("--mode", default="threads", choices=["threads", "async"], help="run_queries or arun")
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated latency per stub call (s)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of stub calls that fail")
+    parser.add_argument("--output-json", default="benchmark_results.json")
+    parser.add_argument("--output-md", default="benchmark.md")
+    parser.add_argument("--baseline", default=None, help="Previous JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative slowdown before flagging")
+    args = parser.parse_args()
+
+    # added try except for better error handling
+    try:
+        with open(args.queries_file, "r", encoding="utf-8") as f:
+            templates = [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        print(f"[Error] Queries file not found: {args.queries_file}")
+        sys.exit(1)
+
+    baseline = None
+    if args.baseline:
+        try:
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baseline = json.load(f)["results"]
+        except Exception as e:
+            print(f"[Warning] Could not load baseline {args.baseline}: {e}")
+
+    configs = [
+        {
+            "base_docs": args.docs_path, "templates": templates, "kb_size": kb_size, "queries": count,
+            "concurrency": concurrency, "mode": args.mode, "latency": args.latency,
+            "failure_rate": args.failure_rate,
+        }
+        for kb_size in parse_ints(args.kb_sizes)
+        for count in parse_ints(args.query_counts)
+        for concurrency in parse_ints(args.concurrency)
+    ]
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for config in configs:
+        print(f"[Info] kb={config['kb_size']} queries={config['queries']} concurrency={config['concurrency']} ...")
+        with context.Pool(1) as pool:
+            result = pool.apply(run_config, (config,))
+        print(f"       {result['qps']} QPS, p95 {result['p95']}s, cold start {result['cold_start']}s")
+        results.append(result)
+
+    settings = {"latency": args.latency, "failure_rate": args.failure_rate, "mode": args.mode,
+                "tolerance": args.tolerance}
+    regressions = compare(results, baseline, args.tolerance) if baseline is not None else None
+    with open(args.output_md, "w", encoding="utf-8") as f:
+        f.write(render_markdown(results, settings, regressions))
+    with open(args.output_json, "w", encoding="utf-8") as f:
+        json.dump({"settings": settings, "results": results, "regressions": regressions}, f, indent=4)
+    print(f"✅ Benchmark results written to {args.output_json} and {args.output_md}")
+    if regressions:
+        print(f"[Warning] {len(regressions)} regression(s) against {args.baseline}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Recall vs latency of the approximate FAISS index types against the exact flat baseline.
+Uses synthetic clustered unit vectors (no API calls) and the same index factory as the KB
+(modules/kb_index.py), sweeping nprobe for IVF types and efSearch for HNSW.
+Writes index_benchmark.json and index_benchmark.md.
+
+    python benchmark_index.py --vectors 100000 --dim 256 --queries 500
+"""
+import sys
+import json
+import time
+import argparse
+import faiss
+import numpy as np
+from modules.kb_index import INDEX_DEFAULTS, make_faiss_index, apply_search_params
+from modules.metrics import Histogram
+
+def make_vectors(count, dim, clusters, rng):
+    """Unit vectors around random cluster centres, roughly like embeddings of topical chunks."""
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centres[rng.integers(0, clusters, count)] + 0.6 * rng.standard_normal((count, dim)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def recall_at_k(found, truth):
+    k = truth.shape[1]
+    return float(np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)]))
+
+def measure(index, queries, top_k):
+    """Per-query latencies (one search call per query, like the retriever) and the hits."""
+    latencies = Histogram(max_samples=len(queries))
+    found = np.empty((len(queries), top_k), dtype=np.int64)
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, found[i] = index.search(query[None, :], top_k)
+        latencies.observe(time.perf_counter() - start)
+    return latencies, found
+
+def main():
+    parser = argparse.ArgumentParser(description="ANN index recall/latency benchmark")
+    parser.add_argument("--vectors", type=int, default=100000, help="Indexed vectors (KB chunks)")
+    parser.add_argument("--dim", type=int, default=256, help="Vector dimension")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--clusters", type=int, default=200, help="Topic clusters in the synthetic data")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--nprobe", default="1,4,8,16,32", help="IVF nprobe values to sweep")
+    parser.add_argument("--ef-search", default="16,32,64,128", help="HNSW efSearch values to sweep")
+    parser.add_argument("--output-json", default="index_benchmark.json")
+    parser.add_argument("--output-md", default="index_benchmark.md")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = make_vectors(args.vectors, args.dim, args.clusters, rng)
+    queries = make_vectors(args.queries, args.dim, args.clusters, np.random.default_rng(1))
+    sweeps = {
+        "flat": [{}],
+        "ivf_flat": [{"nprobe": int(n)} for n in args.nprobe.split(",")],
+        "hnsw": [{"ef_search": int(n)} for n in args.ef_search.split(",")],
+        "ivf_pq": [{"nprobe": int(n)} for n in args.nprobe.split(",")],
+    }
+
+    results, truth = [], None
+    for index_type, settings in sweeps.items():
+        start = time.perf_counter()
+        index = make_faiss_index(index_type, args.dim, len(vectors))
+        if not index.is_trained:
+            sample = vectors[rng.choice(len(vectors), min(len(vectors), INDEX_DEFAULTS["train_size"]), replace=False)]
+            index.train(sample)
+        index.add(vectors)
+        build_time = time.perf_counter() - start
+        size_mb = faiss.serialize_index(index).nbytes / (1024 * 1024)
+        for params in settings:
+            apply_search_params(index, params)
+            latencies, found = measure(index, queries, args.top_k)
+            if truth is None:
+                truth = found  # flat runs first: exact neighbours
+            result = {
+                "index_type": index_type,
+                "params": params,
+                "recall": round(recall_at_k(found, truth), 4),
+                "p50_ms": round(latencies.percentile(50) * 1000, 4),
+                "p95_ms": round(latencies.percentile(95) * 1000, 4),
+                "p99_ms": round(latencies.percentile(99) * 1000, 4),
+                "build_s": round(build_time, 3),
+                "index_mb": round(size_mb, 1),
+            }
+            results.append(result)
+            print(f"[Info] {index_type} {params or ''}: recall@{args.top_k} {result['recall']}, "
+                  f"p50 {result['p50_ms']}ms, {result['index_mb']} MB")
+
+    headers = ["Index", "Params", f"Recall@{args.top_k}", "p50 (ms)", "p95 (ms)", "p99 (ms)", "Build (s)", "Size (MB)"]
+    lines = [
+        "# Index Benchmark",
+        "",
+        f"- **Data:** {args.vectors} synthetic unit vectors, dim {args.dim}, {args.clusters} clusters; "
+        f"{args.queries} queries, recall measured against the flat index",
+        f"- **Python:** {sys.version.split()[0]}, faiss {faiss.__version__}",
+        "",
+        "| " + " | ".join(headers) + " |",
+        "|" + "|".join("---" for _ in headers) + "|",
+    ]
+    for r in results:
+        params = ", ".join(f"{k}={v}" for k, v in r["params"].items()) or "-"
+        lines.append(f"| {r['index_type']} | {params} | {r['recall']:.4f} | {r['p50_ms']:.3f} | {r['p95_ms']:.3f} "
+                     f"| {r['p99_ms']:.3f} | {r['build_s']:.2f} | {r['index_mb']:.1f} |")
+    with open(args.output_md, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    with open(args.output_json, "w", encoding="utf-8") as f:
+        json.dump({"settings": vars(args), "results": results}, f, indent=4)
+    print(f"✅ Index benchmark written to {args.output_json} and {args.output_md}")
+
+if __name__ == "__main__":
+    main()
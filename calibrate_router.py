@@ -0,0 +1,74 @@
+"""
+Calibrates the local KB/Tavily router (modules/router.py) by replaying recorded LLM decisions.
+Every trace decided by the decide_action LLM (without a provider fallback) becomes a sample: its router features are taken
+from the trace when present, otherwise recomputed by running retrieval for the query.
+The chosen thresholds are written to router_calibration.json, which Router loads on startup.
+
+    python calibrate_router.py --traces answers_trace.jsonl
+"""
+import sys
+import json
+import argparse
+from pathlib import Path
+from dotenv import load_dotenv
+from modules.router import calibrate, router_features
+from modules.trace_sink import iter_traces
+
+def load_samples(trace_file):
+    """Returns [(query, llm_action, stored features or None)] for the LLM-decided traces."""
+    samples = {}
+    for entry in iter_traces(trace_file):
+        reasoning_trace = entry.get("reasoning_trace") or {}
+        if entry.get("semantic_cache") or reasoning_trace.get("router") == "local":
+            continue  # not an LLM decision
+        if entry.get("fallback"):
+            continue  # degraded answer: the KB was used because a provider failed, not by decision
+        used = str(reasoning_trace.get("used", "")).lower()
+        if used not in ("kb", "tavily"):
+            continue
+        action = "tavily_search" if used == "tavily" else "kb_summary"
+        samples[entry["query"]] = (entry["query"], action, reasoning_trace.get("router_features"))
+    return list(samples.values())
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Calibrate the local router from recorded LLM decisions")
+    parser.add_argument("--traces", default="answers_trace.jsonl", help="Trace file (NDJSON or legacy JSON)")
+    parser.add_argument("--docs-path", default="kb_docs", help="Path to KB documents")
+    parser.add_argument("--provider", default=None, choices=["openai", "stub"],
+                        help="Embeddings used to recompute retrieval features (default: PIPELINE_PROVIDER or openai)")
+    parser.add_argument("--min-agreement", type=float, default=0.95,
+                        help="Required agreement with the LLM decisions on locally decided queries")
+    parser.add_argument("--output", default="router_calibration.json")
+    args = parser.parse_args()
+
+    if not Path(args.traces).exists():
+        print(f"❌ {args.traces} not found!")
+        sys.exit(1)
+    samples = load_samples(args.traces)
+    if not samples:
+        print("[Info] No LLM-decided traces to calibrate from. Exiting.")
+        sys.exit(0)
+
+    missing = [query for query, _, features in samples if features is None]
+    computed = {}
+    if missing:
+        from modules.controller import Pipeline
+        pipeline = Pipeline(docs_path=args.docs_path, provider=args.provider)
+        for query, kb_results in zip(missing, pipeline.retriever.get_relevant_docs_batch(missing)):
+            computed[query] = router_features(query, kb_results)
+
+    labelled = [(features or computed[query], action) for query, action, features in samples]
+    thresholds, report = calibrate(labelled, min_agreement=args.min_agreement)
+    if report is None:
+        print(f"[Warning] No thresholds reach {args.min_agreement:.0%} agreement; keeping the defaults.")
+        report = {"samples": len(labelled), "decided_locally": 0, "agreement": None}
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"thresholds": thresholds, "report": report, "traces": args.traces}, f, indent=4)
+    print(f"Thresholds: {thresholds}")
+    print(f"Decided locally: {report['decided_locally']}/{report['samples']} (agreement {report['agreement']})")
+    print(f"✅ Router calibration written to {args.output}")
+
+if __name__ == "__main__":
+    main()
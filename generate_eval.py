@@ -1,42 +1,54 @@
-import json
-import statistics
 from pathlib import Path
-
-def generate_eval_md(trace_file="answers_trace.json", output_file="evaluation.md"):
+from modules.trace_sink import iter_traces
+
+def _table_row(entry):
+    query = entry.get("query","").strip()
+    decision_text = entry.get("reasoning_trace", {}).get("decision_text","").strip().replace("\n","-") or "-"
+    used = entry.get("reasoning_trace", {}).get("used","").strip() or "-"
+    latency = round(entry.get("latency",0),2)
+    tool_latency = entry.get("tool_latency", None)
+    tool_latency_str = f"{round(tool_latency,2)}" if tool_latency else "-"
+    return [query, f"`{decision_text}`", used, f"{latency:.2f}", tool_latency_str]
+
+def generate_eval_md(trace_file=None, output_file="evaluation.md"):
+    # NDJSON traces (answers_trace.jsonl) are streamed twice, first for column widths and
+    # averages, then for the table rows, so memory stays constant for large runs
+    if trace_file is None:
+        trace_file = next((f for f in ("answers_trace.jsonl", "answers_trace.json") if Path(f).exists()),
+                          "answers_trace.jsonl")
     trace_path = Path(trace_file)
     if not trace_path.exists():
         print(f"❌ {trace_file} not found!")
         return
 
-    with open(trace_path, "r", encoding="utf-8") as f:
-        traces = json.load(f)
-
-    # Prepare data for column width calculation
-    data_rows = []
     kb_count, web_count = 0, 0
-    latency_vals, tool_latency_vals = [], []
+    query_count = 0
+    latency_sum, tool_latency_sum, tool_latency_count = 0.0, 0.0, 0
+    llm_calls_sum, llm_token_sum, llm_usage_count = 0, 0, 0
 
-    for entry in traces:
-        query = entry.get("query","").strip()
-        decision_text = entry.get("reasoning_trace", {}).get("decision_text","").strip().replace("\n","-") or "-"
-        used = entry.get("reasoning_trace", {}).get("used","").strip() or "-"
-        latency = round(entry.get("latency",0),2)
-        tool_latency = entry.get("tool_latency", None)
-        tool_latency_str = f"{round(tool_latency,2)}" if tool_latency else "-"
+    # Calculate max width for each column
+    headers = ["Query","Decision Text","Source Used","Latency (s)","Tool Latency (s)"]
+    col_widths = [len(h) for h in headers]
 
+    for entry in iter_traces(trace_path):
+        row = _table_row(entry)
+        for i in range(5):
+            col_widths[i] = max(col_widths[i], len(row[i]))
+        used = row[2]
         if used.lower()=="kb": kb_count+=1
         elif used.lower()=="tavily": web_count+=1
 
-        data_rows.append([query, f"`{decision_text}`", used, f"{latency:.2f}", tool_latency_str])
-        latency_vals.append(latency)
+        query_count += 1
+        latency_sum += round(entry.get("latency",0),2)
+        tool_latency = entry.get("tool_latency", None)
         if tool_latency:
-            tool_latency_vals.append(tool_latency)
-
-    # Calculate max width for each column
-    col_widths = [0]*5
-    headers = ["Query","Decision Text","Source Used","Latency (s)","Tool Latency (s)"]
-    for i, h in enumerate(headers):
-        col_widths[i] = max(len(h), max(len(row[i]) for row in data_rows))
+            tool_latency_sum += tool_latency
+            tool_latency_count += 1
+        llm_usage = entry.get("llm_usage")
+        if llm_usage:
+            llm_calls_sum += llm_usage.get("calls", 0)
+            llm_token_sum += llm_usage.get("prompt_tokens", 0) + llm_usage.get("completion_tokens", 0)
+            llm_usage_count += 1
 
     # Helper to pad text
     def pad(text, width):
@@ -46,14 +58,11 @@ def generate_eval_md(trace_file="answers_trace.json", output_file="evaluation.md
     header_row = "| " + " | ".join([pad(headers[i], col_widths[i]) for i in range(5)]) + " |"
     separator_row = "|" + "|".join(["-"*(col_widths[i]+2) for i in range(5)]) + "|"
 
-    # Build table body
-    table_rows = []
-    for row in data_rows:
-        table_rows.append("| " + " | ".join([pad(row[i], col_widths[i]) for i in range(5)]) + " |")
-
     # Compute averages
-    avg_latency = round(statistics.mean(latency_vals),2) if latency_vals else 0
-    avg_tool_latency = round(statistics.mean(tool_latency_vals),2) if tool_latency_vals else "-"
+    avg_latency = round(latency_sum / query_count,2) if query_count else 0
+    avg_tool_latency = round(tool_latency_sum / tool_latency_count,2) if tool_latency_count else "-"
+    avg_llm_calls = round(llm_calls_sum / llm_usage_count,2) if llm_usage_count else "-"
+    avg_llm_tokens = round(llm_token_sum / llm_usage_count,1) if llm_usage_count else "-"
 
     # Quality notes
     quality_notes = []
@@ -67,19 +76,21 @@ def generate_eval_md(trace_file="answers_trace.json", output_file="evaluation.md
         quality_notes.append("Latency is well within acceptable limits, responses are fast and concise.")
 
     # Build Markdown content
-    md_content = f"""# Evaluation Report
+    md_head = f"""# Evaluation Report
 
 ## Test Queries & Results
 
 {header_row}
 {separator_row}
-{chr(10).join(table_rows)}
-
+"""
+    md_tail = f"""
 ---
 
 ## Latency Summary
 - **Average Latency:** {avg_latency}s
 - **Average Tool Latency:** {avg_tool_latency}s
+- **Average LLM Calls per Query:** {avg_llm_calls}
+- **Average LLM Tokens per Query:** {avg_llm_tokens}
 - **KB Used:** {kb_count} times
 - **Web Search Used:** {web_count} times
 
@@ -99,7 +110,12 @@ def generate_eval_md(trace_file="answers_trace.json", output_file="evaluation.md
 """
 
     with open(output_file,"w",encoding="utf-8") as f:
-        f.write(md_content)
+        f.write(md_head)
+        # Build table body
+        for entry in iter_traces(trace_path):
+            row = _table_row(entry)
+            f.write("| " + " | ".join([pad(row[i], col_widths[i]) for i in range(5)]) + " |\n")
+        f.write(md_tail)
 
     print(f"✅ Evaluation report written to {output_file}")
 
@@ -0,0 +1,31 @@
+"""
+Pre-fork deployment of the Flask API:
+
+    gunicorn -c gunicorn.conf.py "app:create_app()"
+
+The app (pipeline, BM25 index, caches) is built once in the master (preload_app) and the
+workers are forked from it, so worker startup takes milliseconds. The FAISS index and chunk
+text are memory-mapped from the index folder (KB_INDEX_SHARED), so their pages are shared by
+every worker instead of copied; gc.freeze() keeps the garbage collector from touching the
+preloaded objects, which would otherwise copy their pages into each worker.
+Re-run ingest.py and send SIGHUP to pick up KB changes.
+With more than one worker, /jobs is backed by the sqlite queue in JOBS_DB (default jobs.db),
+so any worker can serve a job's status whichever worker accepted it.
+"""
+import gc
+import os
+
+os.environ.setdefault("KB_INDEX_SHARED", "1")
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", 4))
+os.environ.setdefault("WEB_CONCURRENCY", str(workers))
+if workers > 1:
+    os.environ.setdefault("JOBS_DB", "jobs.db")
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+preload_app = True
+
+
+def pre_fork(server, worker):
+    gc.freeze()
@@ -0,0 +1,85 @@
+"""
+Builds or updates the persistent KB index ahead of time, for KBs too large to embed on startup.
+Files (.txt, .md, .html, .pdf with pypdf installed) are streamed through a pool of splitter
+processes and embedded in size-bounded batches with bounded concurrency, through the embeddings
+provider (pooled connections, rate limiting, retry/backoff, modules/providers.py);
+vectors are added to the index as each batch returns. The index is written to the same folder
+and with the same settings the pipeline uses, so the next startup just loads it.
+
+    python ingest.py --docs-path kb_docs --workers 8 --embed-concurrency 4
+"""
+import os
+import sys
+import time
+import argparse
+from dotenv import load_dotenv
+from langchain_openai import OpenAIEmbeddings
+from modules.kb_index import KBIndex, INDEX_TYPES, EMBED_BATCH_SIZE, EMBED_BATCH_CHARS
+from modules.embedding_cache import EmbeddingCache, CachedEmbeddings
+from modules.limits import ProviderLimits
+from modules.providers import Provider
+from modules.retriever import EMBEDDING_MODEL
+from modules.stubs import StubEmbeddings
+from benchmark import peak_rss_mb
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Ingest the KB folder into the persistent FAISS index")
+    parser.add_argument("--docs-path", default="kb_docs", help="Path to KB documents")
+    parser.add_argument("--index-dir", default=None, help="Index folder (default: KB_INDEX_DIR, as used by the pipeline)")
+    parser.add_argument("--provider", default=None, choices=["openai", "stub"],
+                        help="Embeddings provider (default: PIPELINE_PROVIDER or openai)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Splitter processes")
+    parser.add_argument("--embed-concurrency", type=int, default=4, help="Max in-flight embedding requests")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Max chunks per embedding request")
+    parser.add_argument("--batch-chars", type=int, default=EMBED_BATCH_CHARS, help="Max characters per embedding request")
+    parser.add_argument("--index-type", default=None, choices=INDEX_TYPES,
+                        help="FAISS index type (default: KB_INDEX_TYPE or flat)")
+    parser.add_argument("--rebuild", action="store_true", help="Re-index every file instead of only changes")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.docs_path):
+        print(f"❌ KB folder {args.docs_path} not found!")
+        sys.exit(1)
+    provider = args.provider or os.getenv("PIPELINE_PROVIDER", "openai")
+    index_dir = args.index_dir or os.getenv("KB_INDEX_DIR", "kb_index")
+    cache_dir = os.getenv("EMBEDDING_CACHE_DIR", "embedding_cache")
+    embed_provider = Provider("embeddings", ProviderLimits({"embeddings": args.embed_concurrency}),
+                              max_connections=args.embed_concurrency)
+    if provider == "stub":
+        # same folder and model name Pipeline(provider="stub") uses
+        index_dir = args.index_dir or index_dir + "_stub"
+        model, embeddings = "stub-embeddings", StubEmbeddings()
+    else:
+        model = EMBEDDING_MODEL
+        embeddings = OpenAIEmbeddings(model=model, http_client=embed_provider.http_client(), max_retries=0)
+    embeddings = CachedEmbeddings(embeddings, EmbeddingCache(cache_dir, model), provider=embed_provider)
+
+    kb_index = KBIndex(
+        args.docs_path,
+        embeddings,
+        index_dir=index_dir,
+        embedding_model=model,
+        chunk_size=1000,
+        chunk_overlap=100,
+        index_type=args.index_type or os.getenv("KB_INDEX_TYPE", "flat"),
+        workers=args.workers,
+        embed_concurrency=args.embed_concurrency,
+        batch_size=args.batch_size,
+        batch_chars=args.batch_chars,
+    )
+    start = time.perf_counter()
+    # added try except for better error handling
+    try:
+        vectorstore = kb_index.build() if args.rebuild else kb_index.load_or_build()
+    except Exception as e:
+        print(f"[Error] Ingestion failed: {e}")
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+    print(f"Files: {len(kb_index.manifest['files'])}, chunks: {vectorstore.index.ntotal}")
+    print(f"Embedding cache: {embeddings.hits} hits, {embeddings.misses} misses")
+    print(f"Time: {elapsed:.1f}s, peak RSS: {peak_rss_mb()} MB")
+    print(f"✅ KB index written to {index_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,11 @@
 import sys
 import os
-import time
 import argparse
+import asyncio
 from dotenv import load_dotenv
 from modules.controller import Pipeline
-from openai import AuthenticationError, RateLimitError, APIConnectionError
+from modules.prompt_registry import PromptRegistry
+from openai import AuthenticationError, APIConnectionError
     
 def load_queries(file_path):
         # added try except for better error handling
@@ -34,9 +35,33 @@ def main():
             "--prompt-version", 
             type=str, 
             default="v2", 
-            choices=["v1", "v2"], 
+            choices=PromptRegistry("prompts").versions(),  # every vN.txt in prompts/
             help="Prompt version to use"
         )
+        parser.add_argument("--max-workers", type=int, default=1, help="Queries processed concurrently (1 = sequential)")
+        parser.add_argument("--openai-concurrency", type=int, default=None, help="Max in-flight OpenAI chat calls")
+        parser.add_argument("--embeddings-concurrency", type=int, default=None, help="Max in-flight embedding calls")
+        parser.add_argument("--tavily-concurrency", type=int, default=None, help="Max in-flight Tavily calls")
+        parser.add_argument("--async", dest="use_async", action="store_true", help="Run queries with the async pipeline")
+        parser.add_argument("--max-in-flight", type=int, default=None, help="Max concurrent queries in async mode (default: all)")
+        parser.add_argument("--provider", default=None, choices=["openai", "stub"],
+                            help="Use real OpenAI/Tavily clients or offline stubs (default: PIPELINE_PROVIDER or openai)")
+        parser.add_argument("--stub-latency", type=float, default=None, help="Simulated latency per stub call (s)")
+        parser.add_argument("--stub-failure-rate", type=float, default=None, help="Fraction of stub calls that fail")
+        parser.add_argument("--speculative", default="off", choices=["off", "heuristic", "always"],
+                            help="Start Tavily in parallel with the LLM decision and discard it on KB")
+        parser.add_argument("--speculation-budget", type=int, default=None,
+                            help="Max wasted speculative Tavily calls before speculation stops")
+        parser.add_argument("--retrieval-mode", default=None, choices=["hybrid", "dense"],
+                            help="BM25 + FAISS with a keyword fast path, or FAISS only (default: RETRIEVAL_MODE or hybrid)")
+        parser.add_argument("--router", default=None, choices=["off", "local"],
+                            help="Decide KB vs Tavily locally when confident, LLM only for ambiguous queries")
+        parser.add_argument("--index-type", default=None, choices=["flat", "ivf_flat", "hnsw", "ivf_pq"],
+                            help="FAISS index type (default: KB_INDEX_TYPE or flat)")
+        parser.add_argument("--nprobe", type=int, default=None, help="IVF cells searched per query")
+        parser.add_argument("--ef-search", type=int, default=None, help="HNSW candidate list size per query")
+        parser.add_argument("--semantic-threshold", type=float, default=None,
+                            help="Enable the semantic answer cache at this cosine similarity (e.g. 0.92)")
         args = parser.parse_args()
 
         queries = load_queries(args.queries_file)
@@ -44,33 +69,48 @@ def main():
             print("[Info] No queries found in the file. Exiting.")
             sys.exit(0) # exit gracefully if no queries
 
-        pipeline = Pipeline(docs_path=args.docs_path, prompt_version=args.prompt_version)
+        pipeline = Pipeline(
+            docs_path=args.docs_path,
+            prompt_version=args.prompt_version,
+            max_workers=args.max_workers,
+            provider=args.provider,
+            stub_latency=args.stub_latency,
+            stub_failure_rate=args.stub_failure_rate,
+            speculative=args.speculative,
+            speculation_budget=args.speculation_budget,
+            semantic_threshold=args.semantic_threshold,
+            retrieval_mode=args.retrieval_mode,
+            router=args.router,
+            index_type=args.index_type,
+            index_params={k: v for k, v in {"nprobe": args.nprobe, "ef_search": args.ef_search}.items() if v is not None},
+            provider_limits={
+                "openai": args.openai_concurrency,
+                "embeddings": args.embeddings_concurrency,
+                "tavily": args.tavily_concurrency,
+            },
+        )
 
-        # Retry logic for RateLimitError
-        MAX_RETRIES = 3
-        RETRY_DELAY = 5  # seconds
-        retries = 0
-        while retries < MAX_RETRIES:
-            try:
-                all_answers, all_traces = pipeline.run_queries(
-                    queries,
-                    save_path_txt="answers.txt",
-                    save_path_json="answers_trace.json"
-                )
-                break  # success
-            except RateLimitError:
-                retries += 1
-                print(f"Rate limit hit. Retrying ({retries}/{MAX_RETRIES}) after {RETRY_DELAY}s...")
-                time.sleep(RETRY_DELAY)
+        # rate limits, retries and backoff are handled per provider call (modules/providers.py),
+        # so a throttled request never re-runs the whole batch
+        if args.use_async:
+            all_answers, all_traces = asyncio.run(pipeline.arun(
+                queries,
+                save_path_txt="answers.txt",
+                save_path_json="answers_trace.jsonl",
+                max_in_flight=args.max_in_flight,
+            ))
         else:
-            print("[Error] Rate limit exceeded: You are sending too many requests to OpenAI API. Try again later.")
-            sys.exit(1)
+            all_answers, all_traces = pipeline.run_queries(
+                queries,
+                save_path_txt="answers.txt",
+                save_path_json="answers_trace.jsonl"
+            )
 
         print(f"\nPipeline executed successfully! ✅")
         print(f"Processed {len(queries)} queries.")
         print("Outputs saved as:")
         print(" - answers.txt (truncated answers for readability)")
-        print(" - answers_trace.json (full answers and reasoning trace)")
+        print(" - answers_trace.jsonl (full answers and reasoning trace, one JSON line per query)")
             
     except AuthenticationError:
         print("[Error] Authentication failed: Please check your OpenAI API key in the .env file.")
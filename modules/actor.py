@@ -1,41 +1,73 @@
 import os
+import asyncio
 import sys
-from tavily import TavilyClient  
+from tavily import TavilyClient, AsyncTavilyClient
+from modules.limits import ProviderLimits
+from modules.cache import make_cache
+from modules.metrics import span
+from modules.providers import Provider
 
 class Actor:
-    def __init__(self):
+    def __init__(self, limits=None, client=None, async_client=None, cache=None, provider=None):
+        self.cache = cache if cache is not None else make_cache("actor")  # short TTL: web results go stale
+        self.limits = limits or ProviderLimits()
+        # Tavily calls go through the "tavily" Provider: pooled clients, rate limiting, retries, circuit breaker
+        self.provider = provider or Provider("tavily", self.limits)
+        # clients can be injected (e.g. the offline stubs in modules/stubs.py)
+        if client is not None:
+            self.tavily = client
+            self.async_tavily = async_client
+            return
         api_key = os.getenv("TAVILY_API_KEY")
         if not api_key:
             print("[Error] TAVILY_API_KEY not set in .env")
             sys.exit(1)
             # added try except for better error handling
         try:
-            self.tavily = TavilyClient(api_key=api_key)
+            try:
+                self.tavily = TavilyClient(api_key=api_key, session=self.provider.requests_session())
+                self.async_tavily = async_client or AsyncTavilyClient(api_key=api_key,
+                                                                      client=self.provider.async_http_client())
+            except TypeError:
+                # older tavily-python without injectable sessions (still keep-alive per client)
+                self.tavily = TavilyClient(api_key=api_key)
+                self.async_tavily = async_client or AsyncTavilyClient(api_key=api_key)
         except Exception as e:
             print(f"[Error] Failed to initialize Tavily client: {e}")
             sys.exit(1)
-        self.cache = {} # Simple in-memory cache
+
+    def _format_results(self, query, results):
+        if results and "results" in results:
+            snippets = [r.get("content", "") for r in results["results"]]
+            text = " ".join(snippets)
+            output = text[:500] + ("..." if len(text) > 500 else "")
+            self.cache.set(query, output)
+            return output
+        return "No relevant web results found."
 
     def web_search(self, query: str) -> str:
         # added simple in-memory cache for web search results
-        if query in self.cache:  # Check cache first
-            return self.cache[query]
+        cached = self.cache.get(query)
+        if cached is not None:  # Check cache first
+            return cached
         
         """
         Executes a web search via Tavily API.
-        Returns a concise paragraph (~3-4 lines).
+        Returns a concise paragraph (~3-4 lines). Raises ProviderError when Tavily is
+        unavailable, so the pipeline can fall back to the KB answer.
         """
-        # added try except for better error handling
-        try:
-            results = self.tavily.search(query, max_results=3)  # top 3 results
-            if results and "results" in results:
-                snippets = [r.get("content", "") for r in results["results"]]
-                text = " ".join(snippets)
-                output = text[:500] + ("..." if len(text) > 500 else "")
-                self.cache[query] = output
-                return output
-            return "No relevant web results found."
-        except Exception as e:
-            print(f"[Error] Tavily API call failed: {e}")
-            return f"Tavily API error: {e}"
+        with span("tool"):
+            results = self.provider.call(lambda: self.tavily.search(query, max_results=3))  # top 3 results
+        return self._format_results(query, results)
 
+    async def aweb_search(self, query: str) -> str:
+        """Async variant of web_search() using AsyncTavilyClient."""
+        cached = self.cache.get(query)
+        if cached is not None:  # Check cache first
+            return cached
+        with span("tool"):
+            if self.async_tavily is None:
+                results = await self.provider.acall(lambda: asyncio.to_thread(self.tavily.search, query, max_results=3))
+            else:
+                results = await self.provider.acall(lambda: self.async_tavily.search(query, max_results=3))  # top 3 results
+        return self._format_results(query, results)
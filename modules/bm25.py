@@ -0,0 +1,165 @@
+import os
+import re
+import json
+import math
+import numpy as np
+from collections import Counter
+from itertools import chain
+
+ARRAY_FILES = ("offsets", "docs", "tfs", "doc_len")  # bm25_<name>.npy next to the FAISS index
+VOCAB_FILE = "bm25_vocab.json"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset((
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "explain", "for", "from",
+    "how", "in", "is", "it", "of", "on", "or", "some", "tell", "that", "the", "this", "to", "what",
+    "when", "where", "which", "who", "why", "with", "about", "me", "describe", "like",
+))
+
+def tokenize(text):
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+class BM25Index:
+    """
+    In-process inverted index with Okapi BM25 scoring over the KB chunks.
+    Postings are stored CSR-style (one docs/tfs array, sliced per term by offsets), so a query
+    costs one vectorized update per query term, and the arrays can be saved as .npy files and
+    memory-mapped by every server worker (save()/load()).
+    keys are the chunk ids (the FAISS docstore ids), so results can be fused with vector hits.
+    """
+    def __init__(self, keys, texts, k1=1.5, b=0.75):
+        postings = {}
+        lengths = []
+        for doc_idx, text in enumerate(texts):
+            terms = Counter(tokenize(text))
+            lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(doc_idx)
+                postings[term][1].append(tf)
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term][0]) for term in terms])
+        total = int(offsets[-1])
+        docs = np.fromiter(chain.from_iterable(postings[term][0] for term in terms), dtype=np.int32, count=total)
+        tfs = np.fromiter(chain.from_iterable(postings[term][1] for term in terms), dtype=np.float32, count=total)
+        self._init_arrays(keys, terms, offsets, docs, tfs, np.asarray(lengths, dtype=np.float32), k1, b)
+
+    def _init_arrays(self, keys, terms, offsets, docs, tfs, doc_len, k1, b):
+        self.keys = list(keys)
+        self.positions = {key: i for i, key in enumerate(self.keys)}
+        self.k1 = k1
+        self.b = b
+        self.terms = {term: row for row, term in enumerate(terms)}
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.avg_len = float(doc_len.mean()) if len(doc_len) else 0.0
+        n = len(self.keys)
+        df = np.diff(offsets).astype(np.float64)
+        self.idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+        # idf of a term that appears in no chunk
+        self.max_idf = math.log(1 + (n + 0.5) / 0.5) if n else 0.0
+
+    def _posting(self, term):
+        """(row, docs, tfs) of a term, or None if no chunk contains it."""
+        row = self.terms.get(term)
+        if row is None:
+            return None
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return row, self.docs[start:end], self.tfs[start:end]
+
+    def save(self, directory, stamp):
+        """
+        Writes the postings as .npy files plus a JSON vocabulary into directory; stamp
+        identifies the KB state they were built from (see load()).
+        """
+        for name in ARRAY_FILES:
+            tmp_path = os.path.join(directory, f"bm25_{name}.npy.tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(tmp_path, os.path.join(directory, f"bm25_{name}.npy"))
+        # the vocabulary is written last, so it never points at arrays of another build
+        tmp_path = os.path.join(directory, VOCAB_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"stamp": stamp, "k1": self.k1, "b": self.b, "count": len(self.keys),
+                       "terms": sorted(self.terms, key=self.terms.get)}, f)
+        os.replace(tmp_path, os.path.join(directory, VOCAB_FILE))
+
+    @classmethod
+    def load(cls, directory, keys, stamp):
+        """Memory-maps postings saved by save(); None if missing or built from another KB state."""
+        try:
+            with open(os.path.join(directory, VOCAB_FILE), "r", encoding="utf-8") as f:
+                vocab = json.load(f)
+            if vocab["stamp"] != stamp or vocab["count"] != len(keys):
+                return None
+            arrays = {name: np.load(os.path.join(directory, f"bm25_{name}.npy"), mmap_mode="r")
+                      for name in ARRAY_FILES}
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"[Warning] Could not load saved BM25 index, rebuilding: {e}")
+            return None
+        index = cls.__new__(cls)
+        index._init_arrays(keys, vocab["terms"], arrays["offsets"], arrays["docs"], arrays["tfs"],
+                           arrays["doc_len"], vocab["k1"], vocab["b"])
+        return index
+
+    def __len__(self):
+        return len(self.keys)
+
+    def scores(self, terms):
+        scores = np.zeros(len(self.keys), dtype=np.float32)
+        for term in set(terms):
+            posting = self._posting(term)
+            if posting is None:
+                continue
+            row, docs, tfs = posting
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / (self.avg_len or 1.0))
+            scores[docs] += self.idf[row] * tfs * (self.k1 + 1) / (tfs + norm)
+        return scores
+
+    def search(self, query, top_k=10):
+        """Returns [(key, score)] of the best matching chunks, highest score first."""
+        terms = tokenize(query)
+        if not terms or not self.keys:
+            return []
+        scores = self.scores(terms)
+        top_k = min(top_k, len(self.keys))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.keys[i], float(scores[i])) for i in top if scores[i] > 0]
+
+    def confidence(self, query, results):
+        """
+        How clearly the keyword match answers the query, in [0, 1]: the share of the query's
+        idf mass found in the best chunk (terms unknown to the KB count with maximal idf),
+        scaled down when the runner-up scores almost as high.
+        """
+        terms = set(tokenize(query))
+        if not terms or not results:
+            return 0.0
+        best_idx = self.positions[results[0][0]]
+        postings = {term: self._posting(term) for term in terms}
+        total = sum(self.idf[p[0]] if p is not None else self.max_idf for p in postings.values())
+        matched = 0.0
+        for posting in postings.values():
+            if posting is not None and best_idx in posting[1]:
+                matched += self.idf[posting[0]]
+        coverage = matched / total if total else 0.0
+        margin = 1.0
+        if len(results) > 1 and results[0][1] > 0:
+            margin = min(1.0, 2 * (1 - results[1][1] / results[0][1]) + 0.5)
+        return coverage * margin
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuses ranked key lists with RRF: score(key) = sum(1 / (k + rank)).
+    Returns [(key, score)] sorted by fused score.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, 1):
+            fused[key] = fused.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
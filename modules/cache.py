@@ -0,0 +1,261 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+
+# per-namespace defaults: retrieval results are cheap to recompute and change with the KB,
+# LLM outputs are expensive and stable, web results (prices, news) go stale quickly
+CACHE_DEFAULTS = {
+    "retriever": {"max_entries": 1024, "ttl": 3600, "persist": False},
+    "reasoner": {"max_entries": 4096, "ttl": 7 * 24 * 3600, "persist": True},
+    "actor": {"max_entries": 1024, "ttl": 600, "persist": True},
+}
+
+_MISSING = object()
+_REGISTRY = weakref.WeakSet()
+
+def _key_id(key):
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+class SQLiteBackend:
+    """
+    On-disk cache store shared by every worker process that points at the same file.
+    One connection per thread; WAL mode lets readers and a writer work concurrently.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL,"
+            " expires_at REAL, accessed_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, accessed_at)")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace, key):
+        """Returns (value, expires_at) or None."""
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?", (time.time(), namespace, key)
+        )
+        conn.commit()
+        return pickle.loads(row[0]), row[1]
+
+    def set(self, namespace, key, value, expires_at):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, pickle.dumps(value), expires_at, time.time()),
+        )
+        conn.commit()
+
+    def delete(self, namespace, key):
+        conn = self._conn()
+        conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+        conn.commit()
+
+    def evict(self, namespace, max_entries):
+        """Drops expired rows and the least recently used rows beyond max_entries. Returns rows removed."""
+        conn = self._conn()
+        removed = conn.execute(
+            "DELETE FROM cache WHERE namespace = ? AND expires_at IS NOT NULL AND expires_at < ?",
+            (namespace, time.time()),
+        ).rowcount
+        count = conn.execute("SELECT COUNT(*) FROM cache WHERE namespace = ?", (namespace,)).fetchone()[0]
+        if count > max_entries:
+            removed += conn.execute(
+                "DELETE FROM cache WHERE rowid IN ("
+                " SELECT rowid FROM cache WHERE namespace = ? ORDER BY accessed_at LIMIT ?)",
+                (namespace, count - max_entries),
+            ).rowcount
+        conn.commit()
+        return removed
+
+    def clear(self, namespace):
+        conn = self._conn()
+        conn.execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+        conn.commit()
+
+class Cache:
+    """
+    Size-bounded LRU cache with a per-namespace TTL.
+    An in-process LRU sits in front of an optional SQLiteBackend, so hot keys stay in
+    memory while entries survive restarts and are shared across worker processes.
+    """
+    def __init__(self, namespace, max_entries=1024, ttl=None, backend=None):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self._entries = OrderedDict()  # key id -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._sets_since_evict = 0
+        _REGISTRY.add(self)
+
+    def _expired(self, expires_at):
+        return expires_at is not None and expires_at < time.time()
+
+    def get(self, key, default=None):
+        key_id = _key_id(key)
+        with self._lock:
+            entry = self._entries.get(key_id, _MISSING)
+            if entry is not _MISSING:
+                value, expires_at = entry
+                if not self._expired(expires_at):
+                    self._entries.move_to_end(key_id)
+                    self.hits += 1
+                    return value
+                del self._entries[key_id]
+                self.expirations += 1
+        if self.backend is not None:
+            try:
+                stored = self.backend.get(self.namespace, key_id)
+            except Exception as e:
+                print(f"[Warning] Cache backend read failed ({self.namespace}): {e}")
+                stored = None
+            if stored is not None:
+                value, expires_at = stored
+                if not self._expired(expires_at):
+                    with self._lock:
+                        self.hits += 1
+                        self._store_local(key_id, value, expires_at)
+                    return value
+                with self._lock:
+                    self.expirations += 1
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def _store_local(self, key_id, value, expires_at):
+        self._entries[key_id] = (value, expires_at)
+        self._entries.move_to_end(key_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def set(self, key, value, ttl=_MISSING):
+        ttl = self.ttl if ttl is _MISSING else ttl
+        expires_at = time.time() + ttl if ttl else None
+        key_id = _key_id(key)
+        with self._lock:
+            self._store_local(key_id, value, expires_at)
+            self._sets_since_evict += 1
+            run_backend_evict = self._sets_since_evict >= max(1, self.max_entries // 10)
+            if run_backend_evict:
+                self._sets_since_evict = 0
+        if self.backend is not None:
+            try:
+                self.backend.set(self.namespace, key_id, value, expires_at)
+                if run_backend_evict:
+                    removed = self.backend.evict(self.namespace, self.max_entries)
+                    with self._lock:
+                        self.evictions += removed
+            except Exception as e:
+                print(f"[Warning] Cache backend write failed ({self.namespace}): {e}")
+
+    def __contains__(self, key):
+        """Peek without touching LRU order or hit/miss counters."""
+        key_id = _key_id(key)
+        with self._lock:
+            entry = self._entries.get(key_id)
+            if entry is not None and not self._expired(entry[1]):
+                return True
+        if self.backend is not None:
+            try:
+                stored = self.backend.get(self.namespace, key_id)
+            except Exception:
+                return False
+            return stored is not None and not self._expired(stored[1])
+        return False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.backend is not None:
+            self.backend.clear(self.namespace)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "namespace": self.namespace,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "persistent": self.backend is not None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+_BACKENDS = {}
+_BACKENDS_LOCK = threading.Lock()
+
+def get_backend(db_path):
+    with _BACKENDS_LOCK:
+        if db_path not in _BACKENDS:
+            _BACKENDS[db_path] = SQLiteBackend(db_path)
+        return _BACKENDS[db_path]
+
+def make_cache(namespace, db_path=None, **overrides):
+    """
+    Builds a Cache with the namespace defaults from CACHE_DEFAULTS.
+    db_path (or PIPELINE_CACHE_DB) enables the shared sqlite backend for persistent namespaces.
+    """
+    settings = dict(CACHE_DEFAULTS.get(namespace, {"max_entries": 1024, "ttl": None, "persist": False}))
+    settings.update({k: v for k, v in overrides.items() if v is not None})
+    db_path = db_path or os.getenv("PIPELINE_CACHE_DB")
+    backend = None
+    if db_path and settings.get("persist"):
+        try:
+            backend = get_backend(db_path)
+        except Exception as e:
+            print(f"[Warning] Could not open cache database {db_path}, using memory only: {e}")
+    return Cache(namespace, max_entries=settings["max_entries"], ttl=settings["ttl"], backend=backend)
+
+def cache_stats():
+    """Hit/miss/eviction counters of every live cache, summed per namespace."""
+    totals = {}
+    for cache in list(_REGISTRY):
+        stats = cache.stats()
+        total = totals.setdefault(stats["namespace"], {
+            "size": 0, "hits": 0, "misses": 0, "evictions": 0, "expirations": 0,
+            "max_entries": stats["max_entries"], "ttl": stats["ttl"], "persistent": stats["persistent"],
+        })
+        for field in ("size", "hits", "misses", "evictions", "expirations"):
+            total[field] += stats[field]
+        total["persistent"] = total["persistent"] or stats["persistent"]
+    for total in totals.values():
+        lookups = total["hits"] + total["misses"]
+        total["hit_ratio"] = round(total["hits"] / lookups, 4) if lookups else 0.0
+    return totals
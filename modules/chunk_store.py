@@ -0,0 +1,99 @@
+import os
+import json
+import mmap
+import uuid
+import threading
+from langchain_core.documents import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+class ChunkStore(Docstore, AddableMixin):
+    """
+    Docstore for the FAISS vector store that keeps chunk text out of Python memory.
+    Chunks are appended as JSON records to a data file in the index folder and read back
+    through mmap only for the hits a search returns; memory holds just id -> (offset, length).
+    Pickled with the vector store (FAISS.save_local), the file itself is not copied.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.filename = f"chunks-{uuid.uuid4().hex[:8]}.bin"
+        self.offsets = {}
+        self._init_runtime()
+
+    def _init_runtime(self):
+        self._lock = threading.Lock()
+        self._mmap = None
+        self._mapped_size = 0
+
+    def __getstate__(self):
+        return {"filename": self.filename, "offsets": self.offsets}
+
+    def __setstate__(self, state):
+        self.directory = None  # set by open() once the index folder is known
+        self.filename = state["filename"]
+        self.offsets = state["offsets"]
+        self._init_runtime()
+
+    def open(self, directory):
+        self.directory = directory
+        return self
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.filename)
+
+    def add(self, texts):
+        """Appends {id: Document} records to the data file."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, open(self.path, "ab") as f:
+            position = f.tell()
+            for key, doc in texts.items():
+                record = json.dumps({"page_content": doc.page_content, "metadata": doc.metadata},
+                                    ensure_ascii=False).encode("utf-8")
+                f.write(record)
+                self.offsets[key] = (position, len(record))
+                position += len(record)
+
+    def delete(self, ids):
+        # the bytes stay in the file until the next full rebuild writes a fresh one
+        with self._lock:
+            for key in ids:
+                self.offsets.pop(key, None)
+
+    def _view(self, end):
+        """mmap of the data file covering at least `end` bytes (remapped after appends)."""
+        with self._lock:
+            if self._mmap is None or self._mapped_size < end:
+                if self._mmap is not None:
+                    self._mmap.close()
+                with open(self.path, "rb") as f:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._mapped_size = len(self._mmap)
+            return self._mmap
+
+    def search(self, search):
+        location = self.offsets.get(search)
+        if location is None:
+            return f"ID {search} not found."
+        offset, length = location
+        record = json.loads(self._view(offset + length)[offset:offset + length].decode("utf-8"))
+        return Document(id=search, page_content=record["page_content"], metadata=record["metadata"])
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+                self._mapped_size = 0
+
+    def remove_stale_files(self):
+        """Deletes data files of earlier builds left in the index folder."""
+        for name in os.listdir(self.directory):
+            if name.startswith("chunks-") and name.endswith(".bin") and name != self.filename:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError as e:
+                    # e.g. still mapped by another worker on Windows; retried after the next build
+                    print(f"[Warning] Could not remove old chunk file {name}: {e}")
@@ -0,0 +1,126 @@
+import os
+import re
+import math
+import threading
+from collections import Counter
+from modules.bm25 import tokenize
+
+# prompt token budgets for the context block; the decision only needs enough to judge coverage
+CONTEXT_BUDGETS = {"decision": 250, "answer": 600}
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n{2,}")
+MIN_OVERLAP = 20  # characters; shorter suffix/prefix matches are coincidences
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+def count_tokens(text):
+    """gpt-4o-mini tokens via tiktoken when its encoding is available, else ~4 characters per token."""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                print(f"[Warning] tiktoken encoding unavailable, estimating tokens from length: {e}")
+                _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / 4)
+
+def _chunk_position(doc):
+    """(file name, chunk number) from KB chunk ids like "ai.txt#3", or None."""
+    doc_id = getattr(doc, "id", None) or ""
+    name, _, number = doc_id.rpartition("#")
+    return (name, int(number)) if name and number.isdigit() else None
+
+def trim_overlap(previous, text):
+    """Drops the start of text that repeats the end of previous (the splitter's chunk overlap)."""
+    longest = min(len(previous), len(text))
+    for size in range(longest, MIN_OVERLAP - 1, -1):
+        if previous.endswith(text[:size]):
+            return text[size:].lstrip()
+    return text
+
+class ContextBuilder:
+    """
+    Turns retrieved chunks into the context block of a prompt: removes the overlap between
+    adjacent chunks of the same file, drops near-duplicate sentences, re-ranks sentences by
+    query-term overlap (IDF-weighted over the candidates, ties broken by retrieval rank) and
+    keeps the best ones up to the token budget of the prompt kind ("decision" or "answer"),
+    in their original order. Budgets come from CONTEXT_BUDGETS or CONTEXT_BUDGET_DECISION /
+    CONTEXT_BUDGET_ANSWER.
+    """
+    def __init__(self, budgets=None, duplicate_threshold=0.8):
+        self.budgets = dict(CONTEXT_BUDGETS)
+        for kind in self.budgets:
+            if os.getenv(f"CONTEXT_BUDGET_{kind.upper()}"):
+                self.budgets[kind] = int(os.getenv(f"CONTEXT_BUDGET_{kind.upper()}"))
+        self.budgets.update(budgets or {})
+        self.duplicate_threshold = duplicate_threshold
+
+    def _passages(self, context):
+        """Passage texts, best retrieval rank first, with chunk overlap removed."""
+        if not isinstance(context, dict):
+            return [str(context or "")]
+        docs = context.get("docs") or []
+        if not docs:
+            return [context.get("summary", "")]
+        by_position = {_chunk_position(doc): doc.page_content for doc in docs if _chunk_position(doc)}
+        passages = []
+        for doc in docs:
+            text = doc.page_content
+            position = _chunk_position(doc)
+            if position is not None:
+                previous = by_position.get((position[0], position[1] - 1))
+                if previous is not None:
+                    text = trim_overlap(previous, text)
+            passages.append(text)
+        return passages
+
+    def _sentences(self, passages):
+        """[(passage rank, sentence, terms)] without near-duplicates."""
+        sentences, seen = [], []
+        for rank, passage in enumerate(passages):
+            for sentence in SENTENCE_PATTERN.split(passage):
+                sentence = " ".join(sentence.split())
+                if not sentence:
+                    continue
+                terms = set(tokenize(sentence))
+                if any(self._similar(terms, other) for other in seen):
+                    continue
+                seen.append(terms)
+                sentences.append((rank, sentence, terms))
+        return sentences
+
+    def _similar(self, terms, other):
+        if not terms or not other:
+            return False
+        return len(terms & other) / len(terms | other) >= self.duplicate_threshold
+
+    def build(self, query, context, kind="answer"):
+        """Returns (context text, its token count) for the prompt kind's budget."""
+        budget = self.budgets[kind]
+        sentences = self._sentences(self._passages(context))
+        if not sentences:
+            return "", 0
+        query_terms = set(tokenize(query))
+        document_frequency = Counter(term for _, _, terms in sentences for term in terms & query_terms)
+        def score(item):
+            rank, _, terms = item
+            overlap = sum(math.log(1 + len(sentences) / document_frequency[t]) for t in terms & query_terms)
+            return (overlap, -rank)
+        ranked = sorted(range(len(sentences)), key=lambda i: score(sentences[i]), reverse=True)
+        chosen, used = set(), 0
+        for i in ranked:
+            tokens = count_tokens(sentences[i][1])
+            if used + tokens > budget:
+                continue  # a shorter, lower-ranked sentence may still fit
+            chosen.add(i)
+            used += tokens
+        if not chosen:
+            # a single sentence longer than the budget: keep its start
+            text = sentences[ranked[0]][1][:budget * 4]
+            return text, count_tokens(text)
+        text = " ".join(sentences[i][1] for i in sorted(chosen))
+        return text, used
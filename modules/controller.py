@@ -1,8 +1,21 @@
 from modules.retriever import Retriever
 from modules.reasoner import Reasoner
+from modules.prompt_registry import PromptRegistry
 from modules.actor import Actor
+from modules.limits import ProviderLimits
+from modules.providers import ProviderError, build_providers, is_auth_error
+from modules.stubs import build_stub_providers
+from modules.speculation import SpeculationPolicy
+from modules.router import Router
+from modules.semantic_cache import SemanticCache
+from modules.metrics import METRICS, span, collect_spans
+from modules.trace_sink import TraceSink, OrderedWriter
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import os
+import queue
 import time
-import json
 import sys
 
 def truncate_answer(text, max_chars=500):
@@ -12,98 +25,553 @@ def truncate_answer(text, max_chars=500):
     return text[:max_chars].rsplit(' ', 1)[0] + "..."
 
 class Pipeline:
-    def __init__(self, docs_path, prompt_version="v2"):
+    def __init__(self, docs_path, prompt_version="v2", max_workers=1, provider_limits=None,
+                 provider=None, stub_latency=None, speculative="off", speculation_budget=None,
+                 semantic_threshold=None, stub_failure_rate=None, retrieval_mode=None, router=None,
+                 index_type=None, index_params=None, shared_index=None):
+        """
+        max_workers: number of queries processed concurrently by run_queries (1 = sequential).
+        provider_limits: optional {"openai": n, "embeddings": n, "tavily": n} caps on
+        in-flight calls per provider, shared across all workers.
+        provider: "openai" (default) or "stub" for the offline clients in modules/stubs.py
+        (also settable via PIPELINE_PROVIDER); stub_latency sets their simulated latency in seconds
+        and stub_failure_rate (or STUB_FAILURE_RATE) the fraction of stub calls that raise.
+        speculative: "off", "heuristic" or "always" - start the Tavily call in parallel with
+        retrieval + decision and discard it if the decision is KB; speculation_budget caps
+        how many discarded (wasted) tool calls are allowed before speculation stops.
+        semantic_threshold: enables the semantic answer cache; queries whose embedding has at
+        least this cosine similarity to an already answered query reuse its answer and trace
+        (also settable via SEMANTIC_CACHE_THRESHOLD).
+        retrieval_mode: "hybrid" (BM25 + FAISS, default) or "dense" (FAISS only), see Retriever.
+        index_type / index_params: FAISS index type and its build/search settings, see Retriever.
+        shared_index: map the saved KB index read-only for multi-process servers, see Retriever.
+        router: "off" (default) or "local" - decide KB vs Tavily locally from retrieval signals and
+        recency cues when confident, calling the decide_action LLM only for ambiguous queries
+        (also settable via ROUTER_MODE).
+        All provider calls go through modules/providers.py (rate limiting, retries, circuit
+        breakers); when OpenAI or Tavily is unavailable the query is answered from the KB and
+        the trace's "fallback" says why. PROVIDER_HEDGING=1 enables hedged requests.
+        prompt_version is the default answer prompt; prompts come from self.prompts (a
+        PromptRegistry over prompts/). The answer prompt is only used when a run synthesizes
+        answers (synthesize=True), and such a run can pick another version or an A/B split.
+        """
+        self.max_workers = max(1, int(max_workers or 1))
+        self.speculation = SpeculationPolicy(speculative or "off", max_wasted=speculation_budget)
+        self._speculation_executor = None
+        self.limits = ProviderLimits(provider_limits)
+        self.providers = build_providers(
+            self.limits, hedge=os.getenv("PROVIDER_HEDGING", "0").lower() in ("1", "true", "yes"))
+        router_mode = router or os.getenv("ROUTER_MODE", "off")
+        if router_mode not in ("off", "local"):
+            raise ValueError(f"Unsupported router mode: {router_mode}")
+        local_router = Router() if router_mode == "local" else None
+        self.prompts = PromptRegistry("prompts")
+        self.provider = provider or os.getenv("PIPELINE_PROVIDER", "openai")
         try:
-            self.retriever = Retriever(docs_path)
-            self.reasoner = Reasoner(prompt_version=prompt_version)
-            self.actor = Actor()
+            if self.provider == "stub":
+                latency = float(stub_latency if stub_latency is not None else os.getenv("STUB_LATENCY", 0))
+                failure_rate = float(stub_failure_rate if stub_failure_rate is not None else os.getenv("STUB_FAILURE_RATE", 0))
+                stubs = build_stub_providers(
+                    chat_latency=latency, tool_latency=latency, embedding_latency=latency,
+                    chat_failure_rate=failure_rate, tool_failure_rate=failure_rate,
+                    embedding_failure_rate=failure_rate,
+                )
+                self.retriever = Retriever(
+                    docs_path,
+                    index_dir=os.getenv("KB_INDEX_DIR", "kb_index") + "_stub",
+                    limits=self.limits,
+                    embeddings=stubs["embeddings"],
+                    embedding_model="stub-embeddings",
+                    mode=retrieval_mode,
+                    index_type=index_type,
+                    index_params=index_params,
+                    shared_index=shared_index,
+                    provider=self.providers["embeddings"],
+                )
+                self.reasoner = Reasoner(
+                    prompt_version=prompt_version, limits=self.limits,
+                    client=stubs["chat"], async_client=stubs["async_chat"], router=local_router,
+                    provider=self.providers["openai"], prompts=self.prompts,
+                )
+                self.actor = Actor(limits=self.limits, client=stubs["tavily"], async_client=stubs["async_tavily"],
+                                   provider=self.providers["tavily"])
+            else:
+                self.retriever = Retriever(docs_path, limits=self.limits, mode=retrieval_mode,
+                                           index_type=index_type, index_params=index_params,
+                                           shared_index=shared_index, provider=self.providers["embeddings"])
+                self.reasoner = Reasoner(prompt_version=prompt_version, limits=self.limits, router=local_router,
+                                         provider=self.providers["openai"], prompts=self.prompts)
+                self.actor = Actor(limits=self.limits, provider=self.providers["tavily"])
         except FileNotFoundError as fnf_error:
             print(f"[Error] KB folder not found: {fnf_error}")
             sys.exit(1)
         except Exception as e:
             print(f"[Error] Failed to initialize pipeline modules: {e}")
             sys.exit(1)
+        # query embeddings go through the retriever's embedding cache, so lookups cost no extra API call
+        if semantic_threshold is None and os.getenv("SEMANTIC_CACHE_THRESHOLD"):
+            semantic_threshold = float(os.getenv("SEMANTIC_CACHE_THRESHOLD"))
+        self.semantic_cache = SemanticCache(self.retriever.embeddings, threshold=semantic_threshold)
 
-    def run_queries(self, queries, save_path_txt=None, save_path_json=None):
-        all_answers = []
-        all_traces = {}
+    def _build_result(self, idx, query, kb_results, action, reasoning_trace, answer, tool_latency, start_time,
+                      speculation=None, synthesized=None):
+        if action == "tavily_search":
+            reasoning_trace["used"] = "Tavily"
+        else:
+            answer = kb_results.get("summary", "No relevant KB info available.")
+            reasoning_trace["used"] = "KB"
+        if synthesized is not None:
+            answer = synthesized
 
-        for idx, query in enumerate(queries, 1):
-            start_time = time.time()
-            try: 
-                kb_results = self.retriever.get_relevant_docs(query)
-            # LLM-only decision
-                action, answer, reasoning_trace = self.reasoner.decide_action(query, kb_results)
-
-                if action == "tavily_search":
-                    tool_start = time.time()
-                    answer = self.actor.web_search(query)
-                    tool_latency = time.time() - tool_start
-                    reasoning_trace["used"] = "Tavily"
-                else:
-                    answer = kb_results.get("summary", "No relevant KB info available.")
-                    tool_latency = None
-                    reasoning_trace["used"] = "KB"
+        answer = truncate_answer(answer, 500)
+        latency = time.time() - start_time
 
-                answer = truncate_answer(answer, 500)
-                latency = time.time() - start_time
+        # Truncate answer for text output
+        truncated_answer = truncate_answer(answer, 500)
+        latency = time.time() - start_time
 
-                # Truncate answer for text output
-                truncated_answer = truncate_answer(answer, 500)
-                latency = time.time() - start_time
+        formatted_answer = (
+            f"--- Query {idx}: {query} ---\n"
+            f"Answer: {truncated_answer}\n"
+            f"(used: {reasoning_trace['used']}, latency: {latency:.2f}s)\n\n"
+        )
+        print(formatted_answer)
 
-                formatted_answer = (
-                    f"--- Query {idx}: {query} ---\n"
-                    f"Answer: {truncated_answer}\n"
-                    f"(used: {reasoning_trace['used']}, latency: {latency:.2f}s)\n\n"
-                )
-                print(formatted_answer)
-                all_answers.append(formatted_answer)
-
-                # Store full answer in JSON trace
-                all_traces[query] = {
-                    "query": query,
-                    "answer": answer,  # FULL answer, no truncation
-                    "reasoning_trace": {
-                        "prompt_version": reasoning_trace["prompt_version"],
-                        "used": reasoning_trace["used"],
-                        "decision_text": reasoning_trace["decision_text"]
-                    },
-                    "latency": latency,
-                    "tool_latency": tool_latency,
-                }
-            except Exception as e:
-                print(f"[Error] Failed processing query '{query}': {e}")
-
-        # Save outputs
-        # Write truncated answers to text file
-        if save_path_txt:
-            with open(save_path_txt, "w", encoding="utf-8") as f:
-                f.writelines(all_answers)
-        if save_path_txt:
-            try:
-                with open(save_path_txt, "w", encoding="utf-8") as f:
-                    f.writelines(all_answers)
-            except Exception as e:
-                print(f"[File Save Error] Could not write answers.txt → {e}")    
-
-        # Write full answers to JSON trace
-        if save_path_json:
-            try: 
-                serializable_traces = []
-                for query, trace in all_traces.items():
-                    serializable_traces.append({
-                        "query": query,
-                        "answer": trace.get("answer"),
-                        "reasoning_trace": trace.get("reasoning_trace"),
-                        "latency": trace.get("latency"),
-                        "tool_latency": trace.get("tool_latency"),
-                    })
+        # Store full answer in JSON trace
+        trace = {
+            "index": idx,  # position in the run's input, since concurrent queries finish out of order
+            "query": query,
+            "answer": answer,  # FULL answer, no truncation
+            "reasoning_trace": {
+                "prompt_version": reasoning_trace["prompt_version"],
+                "prompt_hash": reasoning_trace.get("prompt_hash"),
+                "used": reasoning_trace["used"],
+                "decision_text": reasoning_trace["decision_text"],
+                "router": reasoning_trace.get("router", "llm"),
+                "router_features": reasoning_trace.get("router_features"),
+                "context_tokens": reasoning_trace.get("context_tokens"),
+            },
+            "latency": latency,
+            "tool_latency": tool_latency,
+            "retrieval": kb_results.get("retrieval"),
+            "llm_usage": reasoning_trace.get("llm_usage"),
+            "speculation": speculation,
+            "semantic_cache": None,
+            "synthesized": synthesized is not None,  # answered by the LLM with the answer prompt
+            "fallback": reasoning_trace.get("fallback"),
+        }
+        return formatted_answer, trace
+
+    def _cached_result(self, idx, query, hit, start_time):
+        """Builds the result for a semantic cache hit from the stored trace."""
+        entry, similarity = hit
+        trace = entry["trace"]
+        latency = time.time() - start_time
+        formatted_answer = (
+            f"--- Query {idx}: {query} ---\n"
+            f"Answer: {truncate_answer(trace['answer'], 500)}\n"
+            f"(used: {trace['reasoning_trace']['used']}, latency: {latency:.2f}s)\n\n"
+        )
+        print(formatted_answer)
+        trace.update({
+            "index": idx,
+            "query": query,
+            "latency": latency,
+            "tool_latency": None,
+            "llm_usage": Reasoner.new_usage(),
+            "speculation": None,
+            "semantic_cache": {"matched_query": entry["query"], "similarity": round(similarity, 4)},
+            "fallback": None,
+        })
+        return formatted_answer, trace
+
+    def _cacheable(self, result):
+        # degraded (fallback) answers are not reused once the provider recovers
+        return result is not None and not result[1]["fallback"]
+
+    @staticmethod
+    def _fallback(reasoning_trace, error):
+        """Records a provider failure on the trace; the query is answered from the KB instead."""
+        print(f"[Warning] Falling back to the KB answer: {error}")
+        METRICS.inc("fallback_answers")
+        reasoning_trace["fallback"] = str(error)
+        return "kb_summary"
+
+    def _timed_web_search(self, query):
+        tool_start = time.time()
+        answer = self.actor.web_search(query)
+        return answer, time.time() - tool_start
+
+    async def _atimed_web_search(self, query):
+        tool_start = time.time()
+        answer = await self.actor.aweb_search(query)
+        return answer, time.time() - tool_start
+
+    def _start_speculation(self, query):
+        """Starts the Tavily call in the background if the speculation policy allows it."""
+        if query in self.actor.cache or not self.speculation.should_speculate(query):
+            return None
+        if self._speculation_executor is None:
+            self._speculation_executor = ThreadPoolExecutor(max_workers=max(4, self.max_workers))
+        # copy the context so the tool span lands in this query's spans
+        return self._speculation_executor.submit(contextvars.copy_context().run, self._timed_web_search, query)
+
+    def _record_query(self, result, spans, batch_spans=None):
+        """
+        Attaches the per-stage spans to the trace and counts the query by source. batch_spans
+        are the spans of the work shared by the whole batch (see _prewarm), None for single queries.
+        """
+        if result is None:
+            METRICS.inc("queries_failed")
+            return None
+        trace = result[1]
+        trace["spans"] = spans
+        trace["batch_spans"] = dict(batch_spans) if batch_spans else None
+        source = "semantic_cache" if trace.get("semantic_cache") else trace["reasoning_trace"]["used"].lower()
+        METRICS.inc(f"queries_{source}")
+        if trace.get("synthesized"):
+            # only synthesized answers used the answer prompt, so only they count towards its stats
+            self.prompts.record(trace["reasoning_trace"]["prompt_version"], trace["latency"], trace.get("llm_usage"))
+        return result
+
+    def _process_query(self, idx, query, emit=None, synthesize=False, prompt_version=None, prewarmed=None):
+        """
+        Runs one query end to end. Returns (formatted_answer, trace) or None on failure.
+        emit: optional callback receiving progress events (see stream_queries).
+        synthesize: stream an LLM answer over the selected KB/Tavily text instead of returning it raw.
+        prompt_version: answer prompt for this query (None = the pipeline default).
+        prewarmed: (semantic cache hit, batch spans) from _prewarm(), None to look the query up here.
+        """
+        with collect_spans() as spans:
+            with span("query"):
+                result = self._run_query(idx, query, emit, synthesize, prompt_version, prewarmed)
+        return self._record_query(result, spans, prewarmed and prewarmed[1])
+
+    async def _aprocess_query(self, idx, query, synthesize=False, prompt_version=None, prewarmed=None):
+        """Async variant of _process_query()."""
+        with collect_spans() as spans:
+            with span("query"):
+                result = await self._arun_query(idx, query, synthesize, prompt_version, prewarmed)
+        return self._record_query(result, spans, prewarmed and prewarmed[1])
+
+    def _prewarm(self, queries, synthesize=False):
+        """
+        Batch work done once before a multi-query run: semantic cache lookups for all queries in
+        one embeddings request, then one batched retrieval (embeddings + FAISS matrix search)
+        for the misses only, which warms the retriever cache. Returns one (hit, batch spans) per
+        query, or None per query for single-query runs. The batch spans are recorded here, outside
+        any query, and are attached to every trace of the batch as "batch_spans".
+        """
+        if len(queries) <= 1:
+            return [None] * len(queries)
+        hits = [None] * len(queries)
+        with collect_spans() as batch_spans:
+            if not synthesize:
                 # added try except for better error handling
-                    with open(save_path_json, "w", encoding="utf-8") as f:
-                        json.dump(serializable_traces, f, indent=4, ensure_ascii=False)
-            except Exception as e:
-                print(f"[Warning] Could not save JSON output: {e}")
+                try:
+                    with span("semantic_lookup"):
+                        hits = self.semantic_cache.lookup_batch(queries)
+                except Exception as e:
+                    if is_auth_error(e):
+                        raise  # a rejected API key fails the run instead of every query
+                    print(f"[Warning] Semantic cache lookup failed, answering without it: {e}")
+            misses = [query for query, hit in zip(queries, hits) if hit is None]
+            if len(misses) > 1:
+                with span("retrieve_batch"):
+                    self.retriever.get_relevant_docs_batch(misses)
+        batch_spans["queries"] = len(queries)
+        return [(hit, batch_spans) for hit in hits]
 
-        return all_answers, all_traces
+    async def _aprewarm(self, queries, synthesize=False):
+        """Async variant of _prewarm()."""
+        if len(queries) <= 1:
+            return [None] * len(queries)
+        hits = [None] * len(queries)
+        with collect_spans() as batch_spans:
+            if not synthesize:
+                # added try except for better error handling
+                try:
+                    with span("semantic_lookup"):
+                        hits = await self.semantic_cache.alookup_batch(queries)
+                except Exception as e:
+                    if is_auth_error(e):
+                        raise
+                    print(f"[Warning] Semantic cache lookup failed, answering without it: {e}")
+            misses = [query for query, hit in zip(queries, hits) if hit is None]
+            if len(misses) > 1:
+                with span("retrieve_batch"):
+                    await self.retriever.aget_relevant_docs_batch(misses)
+        batch_spans["queries"] = len(queries)
+        return [(hit, batch_spans) for hit in hits]
+
+    def prompt_versions(self, queries, prompt_version=None, prompt_ab=None, synthesize=False):
+        """
+        Answer prompt version per query: prompt_version for all of them, or an A/B split like
+        {"v1": 50, "v2": 50} assigned by query hash. Raises ValueError for unknown versions, and
+        when a version is requested without synthesize (no answer prompt would be rendered).
+        """
+        if not synthesize:
+            if prompt_version or prompt_ab:
+                raise ValueError("prompt_version / prompt_ab only apply to synthesized answers (synthesize=True)")
+            return [None] * len(queries)
+        return [self.prompts.pick(query, prompt_version, prompt_ab) for query in queries]
+
+    def _run_query(self, idx, query, emit=None, synthesize=False, prompt_version=None, prewarmed=None):
+        emit = emit or (lambda event: None)
+        start_time = time.time()
+        speculative_call = None
+        try: 
+            # the semantic cache only holds raw KB/Tavily answers, never prompt-dependent synthesized ones
+            if prewarmed is not None:
+                hit = prewarmed[0]
+            else:
+                hit = self.semantic_cache.lookup(query) if not synthesize else None
+            if hit is not None:
+                return self._cached_result(idx, query, hit, start_time)
+            # speculative mode: the tool call overlaps retrieval and the decision round-trip
+            speculative_call = self._start_speculation(query)
+            kb_results = self.retriever.get_relevant_docs(query)
+            emit({"event": "retrieval_done", "index": idx, "query": query, "docs": len(kb_results.get("docs", []))})
+        # LLM-only decision
+            action, answer, reasoning_trace = self.reasoner.decide_action(query, kb_results,
+                                                                          prompt_version=prompt_version)
+            emit({"event": "decision", "index": idx, "action": action,
+                  "decision_text": reasoning_trace.get("decision_text")})
+
+            tool_latency = None
+            speculation = None
+            if action == "tavily_search":
+                emit({"event": "tool_started", "index": idx, "tool": "tavily", "speculative": speculative_call is not None})
+            try:
+                if speculative_call is not None:
+                    if action == "tavily_search":
+                        speculation = self.speculation.record(used=True, wasted=False)
+                        answer, tool_latency = speculative_call.result()
+                    else:
+                        # a call that already started still costs a Tavily request
+                        speculation = self.speculation.record(used=False, wasted=not speculative_call.cancel())
+                elif action == "tavily_search":
+                    answer, tool_latency = self._timed_web_search(query)
+            except ProviderError as e:
+                action = self._fallback(reasoning_trace, e)
+                emit({"event": "tool_done", "index": idx, "tool": "tavily", "fallback": str(e)})
+            if action == "tavily_search":
+                emit({"event": "tool_done", "index": idx, "tool": "tavily", "tool_latency": tool_latency})
+
+            synthesized = None
+            if synthesize and action != "error":
+                source = answer if action == "tavily_search" else kb_results  # packed by the context builder
+                tokens = []
+                try:
+                    for token in self.reasoner.stream_reason(query, source, usage=reasoning_trace.get("llm_usage"),
+                                                             prompt_version=prompt_version):
+                        tokens.append(token)
+                        emit({"event": "answer_token", "index": idx, "token": token})
+                    synthesized = "".join(tokens).strip()
+                except ProviderError as e:
+                    self._fallback(reasoning_trace, e)  # the raw KB/Tavily text is returned instead
+            result = self._build_result(idx, query, kb_results, action, reasoning_trace, answer, tool_latency,
+                                        start_time, speculation, synthesized)
+            if synthesized is None and self._cacheable(result):
+                self.semantic_cache.add(query, result[1])
+            return result
+        except Exception as e:
+            if speculative_call is not None:
+                speculative_call.cancel()
+            if is_auth_error(e):
+                raise
+            print(f"[Error] Failed processing query '{query}': {e}")
+            return None
 
+    async def _arun_query(self, idx, query, synthesize=False, prompt_version=None, prewarmed=None):
+        start_time = time.time()
+        speculative_task = None
+        try:
+            if prewarmed is not None:
+                hit = prewarmed[0]
+            else:
+                hit = await self.semantic_cache.alookup(query) if not synthesize else None
+            if hit is not None:
+                return self._cached_result(idx, query, hit, start_time)
+            if query not in self.actor.cache and self.speculation.should_speculate(query):
+                speculative_task = asyncio.create_task(self._atimed_web_search(query))
+            kb_results = await self.retriever.aget_relevant_docs(query)
+            action, answer, reasoning_trace = await self.reasoner.adecide_action(query, kb_results,
+                                                                                 prompt_version=prompt_version)
+
+            tool_latency = None
+            speculation = None
+            try:
+                if speculative_task is not None:
+                    if action == "tavily_search":
+                        speculation = self.speculation.record(used=True, wasted=False)
+                        answer, tool_latency = await speculative_task
+                    else:
+                        speculative_task.cancel()
+                        speculation = self.speculation.record(used=False, wasted=True)
+                elif action == "tavily_search":
+                    answer, tool_latency = await self._atimed_web_search(query)
+            except ProviderError as e:
+                action = self._fallback(reasoning_trace, e)
+
+            synthesized = None
+            if synthesize and action != "error":
+                source = answer if action == "tavily_search" else kb_results  # packed by the context builder
+                try:
+                    synthesized = await self.reasoner.areason(query, source, usage=reasoning_trace.get("llm_usage"),
+                                                              prompt_version=prompt_version)
+                except ProviderError as e:
+                    self._fallback(reasoning_trace, e)  # the raw KB/Tavily text is returned instead
+            result = self._build_result(idx, query, kb_results, action, reasoning_trace, answer, tool_latency,
+                                        start_time, speculation, synthesized)
+            if synthesized is None and self._cacheable(result):
+                await self.semantic_cache.aadd(query, result[1])
+            return result
+        except Exception as e:
+            if speculative_task is not None:
+                speculative_task.cancel()
+            if is_auth_error(e):
+                raise
+            print(f"[Error] Failed processing query '{query}': {e}")
+            return None
+
+    def _open_sink(self, sink, save_path_txt, save_path_json):
+        """The given (shared) sink, else a TraceSink for this run's save paths, else None."""
+        if sink is not None or not (save_path_txt or save_path_json):
+            return sink
+        return TraceSink(save_path_json, answers_path=save_path_txt, append=False)
+
+    def run_queries(self, queries, save_path_txt=None, save_path_json=None, max_workers=None, sink=None,
+                    synthesize=False, prompt_version=None, prompt_ab=None):
+        """
+        Runs the queries and returns (answers, traces). Finished queries are appended to the
+        trace sink in input order (each trace carries its "index"): either the given (shared)
+        sink, or one writing save_path_json (NDJSON, one trace per line) and save_path_txt.
+        synthesize: answer with the LLM over the selected KB/Tavily text instead of returning it raw.
+        prompt_version / prompt_ab: answer prompt for a synthesizing run, see prompt_versions().
+        """
+        max_workers = max(1, int(max_workers or self.max_workers))
+        versions = self.prompt_versions(queries, prompt_version, prompt_ab, synthesize)
+        sink = self._open_sink(sink, save_path_txt, save_path_json)
+        writer = OrderedWriter(sink) if sink is not None else None
+
+        def run_one(idx, query):
+            result = self._process_query(idx, query, synthesize=synthesize, prompt_version=versions[idx - 1],
+                                         prewarmed=prewarmed[idx - 1])
+            if writer is not None:
+                writer.write_result(idx, result)
+            return result
+
+        try:
+            prewarmed = self._prewarm(queries, synthesize)
+            if max_workers == 1 or len(queries) <= 1:
+                results = [run_one(idx, query) for idx, query in enumerate(queries, 1)]
+            else:
+                # concurrent mode: queries overlap their network waits, results keep input order
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(queries))) as executor:
+                    futures = [
+                        executor.submit(run_one, idx, query)
+                        for idx, query in enumerate(queries, 1)
+                    ]
+                    results = [future.result() for future in futures]
+        finally:
+            if sink is not None:
+                writer.close()
+                sink.flush()
+
+        return self._finish(results)
+
+    def stream_queries(self, queries, synthesize=False, max_workers=None, sink=None, prompt_version=None,
+                       prompt_ab=None):
+        """
+        Generator version of run_queries() for streaming responses. Queries run concurrently and
+        events are yielded as they happen, in completion order:
+          retrieval_done, decision, tool_started/tool_done, answer_token (synthesize=True only),
+          result (answer + trace, as soon as that query finishes) or error, then a final done.
+        Finished queries are also appended to sink, if given, in input order. prompt_version /
+        prompt_ab as in run_queries().
+        """
+        versions = self.prompt_versions(queries, prompt_version, prompt_ab, synthesize)
+        if not queries:
+            yield {"event": "done", "count": 0}
+            return
+        events = queue.Queue()
+        finished = object()
+        max_workers = max_workers or max(self.max_workers, min(len(queries), 10))
+        writer = OrderedWriter(sink) if sink is not None else None
+
+        def run_one(idx, query):
+            try:
+                result = self._process_query(idx, query, emit=events.put, synthesize=synthesize,
+                                             prompt_version=versions[idx - 1], prewarmed=prewarmed[idx - 1])
+                if writer is not None:
+                    writer.write_result(idx, result)
+                if result is None:
+                    events.put({"event": "error", "index": idx, "query": query})
+                else:
+                    formatted_answer, trace = result
+                    events.put({"event": "result", "index": idx, "query": query,
+                                "answer": trace["answer"], "formatted_answer": formatted_answer, "trace": trace})
+            finally:
+                events.put(finished)
+
+        prewarmed = self._prewarm(queries, synthesize)
+        try:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(queries))) as executor:
+                for idx, query in enumerate(queries, 1):
+                    executor.submit(run_one, idx, query)
+                remaining = len(queries)
+                while remaining:
+                    event = events.get()
+                    if event is finished:
+                        remaining -= 1
+                        continue
+                    yield event
+        finally:
+            if sink is not None:
+                writer.close()
+                sink.flush()
+        yield {"event": "done", "count": len(queries)}
+
+    async def arun(self, queries, save_path_txt=None, save_path_json=None, max_in_flight=None, sink=None,
+                   synthesize=False, prompt_version=None, prompt_ab=None):
+        """
+        Async variant of run_queries(): every query runs as a task on the current event loop,
+        at most max_in_flight at a time (None = all at once). Same return value and output files;
+        synthesized answers come from areason() in one piece instead of a token stream.
+        """
+        semaphore = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+        versions = self.prompt_versions(queries, prompt_version, prompt_ab, synthesize)
+        sink = self._open_sink(sink, save_path_txt, save_path_json)
+        writer = OrderedWriter(sink) if sink is not None else None
+
+        async def run_one(idx, query):
+            if semaphore is None:
+                result = await self._aprocess_query(idx, query, synthesize, versions[idx - 1], prewarmed[idx - 1])
+            else:
+                async with semaphore:
+                    result = await self._aprocess_query(idx, query, synthesize, versions[idx - 1],
+                                                        prewarmed[idx - 1])
+            if writer is not None:
+                writer.write_result(idx, result)
+            return result
+
+        try:
+            prewarmed = await self._aprewarm(queries, synthesize)
+            results = await asyncio.gather(*(run_one(idx, query) for idx, query in enumerate(queries, 1)))
+        finally:
+            if sink is not None:
+                writer.close()
+                sink.flush()
+        return self._finish(results)
+
+    def _finish(self, results):
+        all_answers = []
+        all_traces = {}
+        for result in results:
+            if result is None:
+                continue
+            formatted_answer, trace = result
+            all_answers.append(formatted_answer)
+            all_traces[trace["query"]] = trace
+        return all_answers, all_traces
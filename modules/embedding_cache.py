@@ -0,0 +1,191 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from modules.metrics import METRICS, span
+from modules.providers import Provider
+
+try:
+    import fcntl  # POSIX only, used to serialize appends across worker processes
+except ImportError:
+    fcntl = None
+
+def normalize_text(text):
+    """Collapses whitespace and case so near-duplicate texts share one cache entry."""
+    return " ".join(text.split()).casefold()
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed embedding cache for one embedding model.
+    Vectors live in an append-only float32 file read through a memory map;
+    an offset index maps sha256(normalized text) -> row.
+    """
+    def __init__(self, cache_dir, model):
+        self.cache_dir = cache_dir
+        self.model = model
+        safe_model = model.replace("/", "_")
+        self.vectors_path = os.path.join(cache_dir, f"{safe_model}.f32")
+        self.index_path = os.path.join(cache_dir, f"{safe_model}.idx")
+        self.meta_path = os.path.join(cache_dir, f"{safe_model}.json")
+        self.dim = None
+        self.rows = {}
+        self._mmap = None
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _load(self):
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        self.rows[parts[0]] = int(parts[1])
+        self._remap()
+
+    def _remap(self):
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            self._mmap = None
+            return
+        n_rows = os.path.getsize(self.vectors_path) // (4 * self.dim)
+        if n_rows == 0:
+            self._mmap = None
+            return
+        self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(n_rows, self.dim))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, text):
+        return self.get_many([text])[0]
+
+    def get_many(self, texts):
+        """Returns a list with a vector (list of floats) or None per text."""
+        results = []
+        with self._lock:
+            for text in texts:
+                row = self.rows.get(self.key(text))
+                if row is None:
+                    results.append(None)
+                    continue
+                if self._mmap is None or row >= self._mmap.shape[0]:
+                    self._remap()
+                results.append(self._mmap[row].tolist())
+        return results
+
+    def put_many(self, texts, vectors):
+        if not texts:
+            return
+        with self._lock:
+            if self.dim is None:
+                self.dim = len(vectors[0])
+                with open(self.meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"model": self.model, "dim": self.dim}, f)
+            new = {}
+            for text, vector in zip(texts, vectors):
+                key = self.key(text)
+                if key not in self.rows and key not in new:
+                    new[key] = vector
+            if not new:
+                return
+            data = np.asarray(list(new.values()), dtype=np.float32)
+            with open(self.vectors_path, "ab") as vf, open(self.index_path, "a", encoding="utf-8") as idx:
+                if fcntl:
+                    fcntl.flock(vf, fcntl.LOCK_EX)
+                try:
+                    # row numbers come from the file size so concurrent writers never collide
+                    vf.seek(0, os.SEEK_END)
+                    start = vf.tell() // (4 * self.dim)
+                    vf.write(data.tobytes())
+                    vf.flush()
+                    lines = []
+                    for offset, key in enumerate(new):
+                        self.rows[key] = start + offset
+                        lines.append(f"{key} {start + offset}\n")
+                    idx.writelines(lines)
+                    idx.flush()
+                finally:
+                    if fcntl:
+                        fcntl.flock(vf, fcntl.LOCK_UN)
+            self._remap()
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps a LangChain embeddings model with an EmbeddingCache.
+    Used by both KB indexing and query-time retrieval, so repeated chunks and
+    repeated/near-duplicate queries never hit the embeddings API twice.
+    API calls go through the "embeddings" Provider (rate limiting, retries, circuit breaker).
+    """
+    def __init__(self, embeddings, cache, limits=None, provider=None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.provider = provider or Provider("embeddings", limits)
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        vectors = self.cache.get_many(texts)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            # one API request for all misses, duplicates in the batch are embedded once
+            unique_texts = list(dict.fromkeys(texts[i] for i in missing))
+            with span("embedding_api"):
+                embedded = self.provider.call(lambda: self.embeddings.embed_documents(unique_texts))
+            METRICS.inc("embedding_api_calls")
+            self.cache.put_many(unique_texts, embedded)
+            lookup = dict(zip(unique_texts, embedded))
+            for i in missing:
+                vectors[i] = lookup[texts[i]]
+        return vectors
+
+    def embed_query(self, text):
+        vector = self.cache.get(text)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        self.misses += 1
+        with span("embedding_api"):
+            vector = self.provider.call(lambda: self.embeddings.embed_query(text))
+        METRICS.inc("embedding_api_calls")
+        self.cache.put_many([text], [vector])
+        return vector
+
+    async def aembed_documents(self, texts):
+        texts = list(texts)
+        vectors = self.cache.get_many(texts)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            unique_texts = list(dict.fromkeys(texts[i] for i in missing))
+            with span("embedding_api"):
+                embedded = await self.provider.acall(lambda: self.embeddings.aembed_documents(unique_texts))
+            METRICS.inc("embedding_api_calls")
+            self.cache.put_many(unique_texts, embedded)
+            lookup = dict(zip(unique_texts, embedded))
+            for i in missing:
+                vectors[i] = lookup[texts[i]]
+        return vectors
+
+    async def aembed_query(self, text):
+        vector = self.cache.get(text)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        self.misses += 1
+        with span("embedding_api"):
+            vector = await self.provider.acall(lambda: self.embeddings.aembed_query(text))
+        METRICS.inc("embedding_api_calls")
+        self.cache.put_many([text], [vector])
+        return vector
@@ -0,0 +1,99 @@
+"""
+Building blocks for KB ingestion: text extraction for the supported file formats,
+per-file splitting (run in worker processes), and in-order bounded-concurrency mapping.
+"""
+import os
+from html.parser import HTMLParser
+from collections import deque
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+try:
+    from pypdf import PdfReader  # optional, only needed for .pdf files
+except ImportError:
+    PdfReader = None
+
+SUPPORTED_EXTENSIONS = (".txt", ".md", ".markdown", ".html", ".htm", ".pdf")
+
+class _HTMLText(HTMLParser):
+    """Collects the visible text of an HTML page, one line per block element."""
+    SKIP = {"script", "style", "head", "noscript", "template"}
+    BLOCKS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "pre"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skipping += 1
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self._skipping:
+            self._skipping -= 1
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+    def text(self):
+        lines = (" ".join(line.split()) for line in "".join(self.parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+def load_text(path):
+    """Extracts the text of one KB file based on its extension ("" if it cannot be read)."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".pdf":
+        if PdfReader is None:
+            print(f"[Warning] pypdf is not installed, skipping {path}")
+            return ""
+        reader = PdfReader(path)
+        return "\n\n".join(page.extract_text() or "" for page in reader.pages)
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    if extension in (".html", ".htm"):
+        parser = _HTMLText()
+        parser.feed(text)
+        return parser.text()
+    return text
+
+_SPLITTERS = {}
+
+def split_file(docs_path, name, chunk_size, chunk_overlap):
+    """
+    Loads and splits one KB file. Runs in worker processes, so it returns plain data:
+    (name, [(chunk text, metadata)], chunk ids).
+    """
+    key = (chunk_size, chunk_overlap)
+    if key not in _SPLITTERS:  # one splitter per worker process
+        _SPLITTERS[key] = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    path = os.path.join(docs_path, name)
+    try:
+        text = load_text(path)
+    except Exception as e:
+        print(f"[Error] Failed to load {path}: {e}")
+        text = ""
+    chunks = _SPLITTERS[key].split_text(text) if text.strip() else []
+    return name, [(chunk, {"source": path}) for chunk in chunks], [f"{name}#{i}" for i in range(len(chunks))]
+
+def bounded_map(executor, fn, items, window):
+    """
+    Like executor.map, but keeps at most `window` calls pending and yields results in input
+    order as they become available, so a fast producer never piles results up in memory.
+    executor=None runs fn inline.
+    """
+    if executor is None:
+        for item in items:
+            yield fn(*item)
+        return
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, *item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from modules.metrics import METRICS
+
+# settings, each overridable by the env var of the same name
+JOB_DEFAULTS = {
+    "JOB_WORKERS": 4,            # batches processed concurrently per process
+    "JOB_BATCH_SIZE": 8,         # queries per pipeline.run_queries call (one batched retrieval)
+    "JOB_MAX_QUERIES": 10000,    # per submitted job
+    "JOB_RESULT_TTL": 600,       # seconds a finished query is reused by new jobs (web results go stale)
+    "JOB_LEASE": 600,            # seconds before a query claimed by a dead worker is picked up again
+    "JOB_RETENTION": 24 * 3600,  # seconds finished jobs are kept
+}
+
+def _setting(name):
+    return float(os.getenv(name, JOB_DEFAULTS[name]))
+
+def query_key(query, prompt_version):
+    """Dedup key: the same query (whitespace-normalized) under the same answer prompt (None: raw answer)."""
+    return f"{prompt_version}\x1f{' '.join(query.split())}"
+
+class JobStore:
+    """
+    Jobs, their queries and the per-query results in sqlite. path=None keeps everything in
+    memory; a file path (JOBS_DB) lets queued jobs survive restarts and lets every worker
+    process of a server claim and serve the same jobs. Queries are stored once per job but
+    processed once per dedup key: results are shared by every job asking the same thing.
+    The connection is opened lazily in each process: sqlite connections must not cross a fork.
+    """
+    def __init__(self, path=None):
+        self.path = path or ":memory:"
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        """This process's connection (caller holds self._lock); one per process, guarded by the lock."""
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        # statements are short, and WAL handles the other processes sharing the file
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        if self.path != ":memory:":
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, created_at REAL NOT NULL, total INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS items ("
+            " job_id TEXT NOT NULL, idx INTEGER NOT NULL, key TEXT NOT NULL, query TEXT NOT NULL,"
+            " prompt_version TEXT, status TEXT NOT NULL, claimed_at REAL, PRIMARY KEY (job_id, idx));"
+            "CREATE INDEX IF NOT EXISTS items_status ON items (status, key);"
+            "CREATE INDEX IF NOT EXISTS items_key ON items (key);"
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, status TEXT NOT NULL, answer TEXT, trace TEXT, completed_at REAL NOT NULL);"
+        )
+        self._conn, self._pid = conn, os.getpid()
+        return conn
+
+    def _write(self, fn):
+        """Runs fn(conn) in one write transaction (BEGIN IMMEDIATE serializes processes too)."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn)
+                conn.execute("COMMIT")
+                return result
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def submit(self, queries, versions, result_ttl):
+        """Stores a job; queries already answered within result_ttl are done at once. Returns (job id, reused)."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        keys = [query_key(query, version) for query, version in zip(queries, versions)]
+
+        def insert(conn):
+            fresh = set()
+            unique = list(set(keys))
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT key FROM results WHERE status = 'done' AND completed_at >= ?"
+                    f" AND key IN ({','.join('?' * len(chunk))})", [now - result_ttl] + chunk
+                ).fetchall()
+                fresh.update(row[0] for row in rows)
+            conn.execute("INSERT INTO jobs (id, created_at, total) VALUES (?, ?, ?)", (job_id, now, len(queries)))
+            conn.executemany(
+                "INSERT INTO items (job_id, idx, key, query, prompt_version, status) VALUES (?, ?, ?, ?, ?, ?)",
+                [(job_id, idx, key, query, version, "done" if key in fresh else "pending")
+                 for idx, (key, query, version) in enumerate(zip(keys, queries, versions), 1)],
+            )
+            return sum(1 for key in keys if key in fresh)
+
+        return job_id, self._write(insert)
+
+    def claim(self, limit, lease):
+        """
+        Claims up to limit pending dedup keys (oldest first, plus keys whose claim expired)
+        and returns them as [(key, query, prompt_version)]. A key another worker is still running
+        (unexpired claim) is skipped even when a newer job queued it again; complete() answers
+        every item of the key.
+        """
+        now = time.time()
+
+        def take(conn):
+            rows = conn.execute(
+                "SELECT key, query, prompt_version FROM items"
+                " WHERE status = 'pending' OR (status = 'running' AND claimed_at < ?)"
+                " GROUP BY key HAVING NOT EXISTS (SELECT 1 FROM items AS claimed WHERE claimed.key = items.key"
+                " AND claimed.status = 'running' AND claimed.claimed_at >= ?)"
+                " ORDER BY MIN(rowid) LIMIT ?", (now - lease, now - lease, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE items SET status = 'running', claimed_at = ? WHERE key = ? AND status IN ('pending', 'running')",
+                [(now, row[0]) for row in rows],
+            )
+            return rows
+
+        return self._write(take)
+
+    def complete(self, key, trace):
+        """Stores the result of a dedup key (trace=None: the query failed) for every job waiting on it."""
+        status = "done" if trace is not None else "failed"
+
+        def store(conn):
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, status, answer, trace, completed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, status, trace["answer"] if trace else None,
+                 json.dumps(trace, ensure_ascii=False, default=str) if trace else None, time.time()),
+            )
+            conn.execute("UPDATE items SET status = ? WHERE key = ? AND status IN ('pending', 'running')", (status, key))
+
+        self._write(store)
+
+    def job(self, job_id, offset=0, limit=100):
+        """Progress of a job and one page of its results, or None if there is no such job."""
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT created_at, total FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM items WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall())
+            items = conn.execute(
+                "SELECT items.idx, items.query, items.status, results.answer, results.trace FROM items"
+                " LEFT JOIN results ON results.key = items.key AND items.status IN ('done', 'failed')"
+                " WHERE items.job_id = ? ORDER BY items.idx LIMIT ? OFFSET ?", (job_id, limit, offset)
+            ).fetchall()
+        created_at, total = row
+        finished = counts.get("done", 0) + counts.get("failed", 0)
+        if finished == total:
+            status = "done"
+        elif finished or counts.get("running"):
+            status = "running"
+        else:
+            status = "queued"
+        next_offset = offset + len(items)
+        return {
+            "job_id": job_id,
+            "status": status,
+            "created_at": created_at,
+            "total": total,
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "pending": counts.get("pending", 0) + counts.get("running", 0),
+            "results": [
+                {"index": idx, "query": query, "status": item_status, "answer": answer,
+                 "trace": json.loads(trace) if trace else None}
+                for idx, query, item_status, answer, trace in items
+            ],
+            "next_offset": next_offset if next_offset < total else None,
+        }
+
+    def prune(self, retention):
+        """Drops jobs created more than retention seconds ago and results no job refers to."""
+        cutoff = time.time() - retention
+
+        def delete(conn):
+            old = [row[0] for row in conn.execute("SELECT id FROM jobs WHERE created_at < ?", (cutoff,))]
+            conn.executemany("DELETE FROM items WHERE job_id = ?", [(job_id,) for job_id in old])
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in old])
+            conn.execute(
+                "DELETE FROM results WHERE completed_at < ? AND key NOT IN (SELECT key FROM items)", (cutoff,)
+            )
+            return len(old)
+
+        return self._write(delete)
+
+class JobQueue:
+    """
+    Background processing of large query batches: POST /jobs returns a job id at once and
+    GET /jobs/<id> pages through the results. A pool of JOB_WORKERS threads claims batches
+    of pending queries from the JobStore and runs them through pipeline.run_queries, so at
+    most JOB_WORKERS * JOB_BATCH_SIZE queries are in flight whatever the number of jobs.
+    Identical queries (same prompt version) are answered once, within a job and across jobs.
+    The threads start on first use in each process (start() is safe to call per request),
+    so a pre-fork server does not start them in the master. A server with several worker
+    processes (WEB_CONCURRENCY > 1) needs JOBS_DB: in-memory jobs would only be visible to
+    the worker that accepted them.
+    """
+    def __init__(self, pipeline, db_path=None, workers=None, batch_size=None, sink=None):
+        self.pipeline = pipeline
+        db_path = db_path or os.getenv("JOBS_DB")
+        if not db_path and int(os.getenv("WEB_CONCURRENCY", 1)) > 1:
+            raise ValueError("JOBS_DB must be set when the server runs more than one worker process")
+        self.store = JobStore(db_path)
+        self.workers = int(workers or _setting("JOB_WORKERS"))
+        self.batch_size = int(batch_size or _setting("JOB_BATCH_SIZE"))
+        self.max_queries = int(_setting("JOB_MAX_QUERIES"))
+        self.result_ttl = _setting("JOB_RESULT_TTL")
+        self.lease = _setting("JOB_LEASE")
+        self.retention = _setting("JOB_RETENTION")
+        self.sink = sink
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._last_prune = 0.0
+
+    def start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for n in range(self.workers):
+                threading.Thread(target=self._work, name=f"job-worker-{n}", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def submit(self, queries, synthesize=False, prompt_version=None, prompt_ab=None):
+        """
+        Queues a job and returns (job id, queries answered from earlier jobs). Synthesized queries
+        are stored with their answer prompt version, raw ones with None. Raises ValueError for
+        too many queries or invalid prompt versions (see Pipeline.prompt_versions).
+        """
+        if len(queries) > self.max_queries:
+            raise ValueError(f"A job can have at most {self.max_queries} queries")
+        normalized = [' '.join(query.split()) for query in queries]
+        versions = self.pipeline.prompt_versions(normalized, prompt_version, prompt_ab, synthesize)
+        if synthesize:
+            versions = [version or self.pipeline.reasoner.prompt_version for version in versions]
+        job_id, reused = self.store.submit(queries, versions, self.result_ttl)
+        METRICS.inc("jobs_submitted")
+        METRICS.inc("job_queries_reused", reused)
+        self.start()
+        self._wake.set()
+        return job_id, reused
+
+    def get(self, job_id, offset=0, limit=100):
+        return self.store.job(job_id, offset, limit)
+
+    def _work(self):
+        while not self._stop.is_set():
+            # added try except for better error handling
+            try:
+                self._maybe_prune()
+                batch = self.store.claim(self.batch_size, self.lease)
+            except Exception as e:
+                print(f"[Error] Job queue unavailable: {e}")
+                batch = []
+            if not batch:
+                # other processes sharing JOBS_DB may queue work too, so poll as well
+                self._wake.wait(timeout=1.0)
+                self._wake.clear()
+                continue
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        by_version = {}
+        for key, query, version in batch:
+            by_version.setdefault(version, []).append((key, query))
+        for version, entries in by_version.items():
+            queries = [query for _, query in entries]
+            try:
+                _, traces = self.pipeline.run_queries(queries, max_workers=1, sink=self.sink,
+                                                      synthesize=version is not None, prompt_version=version)
+            except Exception as e:
+                print(f"[Error] Job batch failed: {e}")
+                traces = {}
+            for key, query in entries:
+                trace = traces.get(query)
+                METRICS.inc("job_queries_done" if trace is not None else "job_queries_failed")
+                try:
+                    self.store.complete(key, trace)
+                except Exception as e:
+                    print(f"[Error] Failed to store job result for '{query}': {e}")
+
+    def _maybe_prune(self):
+        if time.time() - self._last_prune < 60:
+            return
+        self._last_prune = time.time()
+        removed = self.store.prune(self.retention)
+        if removed:
+            print(f"[Info] Removed {removed} expired jobs")
@@ -0,0 +1,387 @@
+import os
+import json
+import math
+import pickle
+import hashlib
+import faiss
+import numpy as np
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from modules.chunk_store import ChunkStore
+from modules.ingest import SUPPORTED_EXTENSIONS, split_file, bounded_map
+
+try:
+    import fcntl  # POSIX only, used to let one worker process build the shared index
+except ImportError:
+    fcntl = None
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 3  # 2: memory-mapped ChunkStore, index types; 3: md/html/pdf files, nested folders
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+TRAINED_INDEX_TYPES = ("ivf_flat", "ivf_pq")
+INDEX_DEFAULTS = {
+    "nlist": None,          # IVF cells; None = 4 * sqrt(chunks)
+    "pq_m": 16,             # PQ sub-quantizers (bytes per vector at 8 bits)
+    "pq_nbits": 8,
+    "hnsw_m": 32,           # HNSW graph degree
+    "ef_construction": 200,
+    "train_size": 65536,    # vectors sampled for IVF training
+    "nprobe": 8,            # query time: IVF cells visited
+    "ef_search": 64,        # query time: HNSW candidate list size
+}
+SEARCH_PARAMS = ("nprobe", "ef_search")
+# read flags that leave the vectors in the page cache (shared by all processes) instead of the heap:
+# flat/HNSW vector storage via IO_FLAG_MMAP_IFC (faiss >= 1.8), IVF inverted lists via IO_FLAG_MMAP
+MMAP_FLAGS = {
+    "flat": getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP),
+    "hnsw": getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP),
+    "ivf_flat": faiss.IO_FLAG_MMAP,
+    "ivf_pq": faiss.IO_FLAG_MMAP,
+}
+EMBED_BATCH_SIZE = 512        # chunks per embeddings request
+EMBED_BATCH_CHARS = 400_000   # ~100k tokens per request, well under the API's per-request limit
+
+def make_faiss_index(index_type, dim, num_vectors, params=None):
+    """
+    Creates an empty (untrained) L2 index of the given type. IVF cell counts and PQ code sizes
+    are clamped to what num_vectors training points can support, so tiny KBs still build.
+    """
+    params = {**INDEX_DEFAULTS, **(params or {})}
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["hnsw_m"])
+        index.hnsw.efConstruction = params["ef_construction"]
+        return index
+    if index_type not in TRAINED_INDEX_TYPES:
+        raise ValueError(f"Unsupported index type: {index_type}")
+    nlist = params["nlist"] or int(4 * math.sqrt(max(num_vectors, 1)))
+    nlist = max(1, min(nlist, num_vectors // 39))  # faiss wants ~39 training points per cell
+    quantizer = faiss.IndexFlatL2(dim)
+    if index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+    else:
+        pq_m = max(m for m in range(1, min(params["pq_m"], dim) + 1) if dim % m == 0)
+        nbits = max(1, min(params["pq_nbits"], int(math.log2(max(2, num_vectors // 39)))))
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, nbits)
+        if num_vectors < 39 * 2 ** nbits:
+            index.pq.cp.min_points_per_centroid = 1  # tiny KB: train anyway, without warnings
+    if num_vectors < 39 * nlist:
+        index.cp.min_points_per_centroid = 1
+    return index
+
+def apply_search_params(index, params=None):
+    """Sets the query-time knobs (IVF nprobe, HNSW efSearch) on an index."""
+    params = {**INDEX_DEFAULTS, **(params or {})}
+    try:
+        faiss.extract_index_ivf(index).nprobe = params["nprobe"]
+    except RuntimeError:
+        pass  # not an IVF index
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = params["ef_search"]
+
+class KBIndex:
+    """
+    Persistent FAISS vector store for the KB folder.
+    Keeps a manifest of file hashes and chunk ids next to the saved index so that
+    on startup only added/changed files are embedded and deleted files are dropped.
+    index_type: "flat" (exact), "ivf_flat", "hnsw" or "ivf_pq" (approximate, for large KBs);
+    index_params overrides INDEX_DEFAULTS. Chunk text lives in a memory-mapped ChunkStore.
+    glob=None indexes every supported format (modules/ingest.py) in the folder tree.
+    workers > 1 splits files in a process pool; embed_concurrency bounds the embedding requests
+    in flight. Files are streamed through both, so memory stays flat however large the KB is.
+    """
+    def __init__(self, docs_path, embeddings, index_dir="kb_index", embedding_model="",
+                 chunk_size=1000, chunk_overlap=100, glob=None, index_type="flat", index_params=None,
+                 workers=1, embed_concurrency=1, batch_size=EMBED_BATCH_SIZE, batch_chars=EMBED_BATCH_CHARS):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unsupported index type: {index_type}")
+        self.docs_path = docs_path
+        self.embeddings = embeddings
+        self.index_dir = index_dir
+        self.embedding_model = embedding_model
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.glob = glob
+        self.index_type = index_type
+        self.index_params = {**INDEX_DEFAULTS, **(index_params or {})}
+        self.workers = max(1, workers)
+        self.embed_concurrency = max(1, embed_concurrency)
+        self.batch_size = batch_size
+        self.batch_chars = batch_chars
+        self.vectorstore = None
+        self.manifest = None
+
+    def _settings(self):
+        # anything that changes chunk ids or vectors forces a full rebuild
+        return {
+            "version": MANIFEST_VERSION,
+            "docs_path": os.path.abspath(self.docs_path),
+            "embedding_model": self.embedding_model,
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "glob": self.glob,
+            "index_type": self.index_type,
+            # query-time params (nprobe, ef_search) can change without a rebuild
+            "index_params": {k: v for k, v in self.index_params.items() if k not in SEARCH_PARAMS},
+        }
+
+    def _scan_files(self):
+        """Returns {file name (relative path): sha256} for every KB file to index."""
+        root = Path(self.docs_path)
+        if self.glob:
+            paths = root.glob(self.glob)
+        else:
+            paths = (p for p in root.rglob("*") if p.suffix.lower() in SUPPORTED_EXTENSIONS)
+        files = {}
+        for path in sorted(paths):
+            if not path.is_file():
+                continue
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            files[path.relative_to(root).as_posix()] = digest.hexdigest()
+        return files
+
+    def _split_files(self, names):
+        """Yields (name, chunks, ids) per file in order, splitting up to `workers` files in parallel."""
+        args = ((self.docs_path, name, self.chunk_size, self.chunk_overlap) for name in names)
+        if self.workers == 1 or len(names) < 2:
+            results = bounded_map(None, split_file, args, 1)
+            yield from self._as_documents(results)
+            return
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            yield from self._as_documents(bounded_map(pool, split_file, args, self.workers * 4))
+
+    @staticmethod
+    def _as_documents(results):
+        for name, chunks, ids in results:
+            yield name, [Document(page_content=text, metadata=metadata) for text, metadata in chunks], ids
+
+    def _chunk_batches(self, names, store, entries, files):
+        """
+        Splits files, appends their chunks to the ChunkStore and records them in entries,
+        yielding (ids, texts) batches bounded by batch_size chunks and batch_chars characters.
+        """
+        ids, texts, chars = [], [], 0
+        for name, chunks, chunk_ids in self._split_files(names):
+            entries[name] = {"hash": files[name], "chunk_ids": chunk_ids}
+            store.add(dict(zip(chunk_ids, chunks)))
+            for chunk_id, chunk in zip(chunk_ids, chunks):
+                if ids and (len(ids) >= self.batch_size or chars + len(chunk.page_content) > self.batch_chars):
+                    yield ids, texts
+                    ids, texts, chars = [], [], 0
+                ids.append(chunk_id)
+                texts.append(chunk.page_content)
+                chars += len(chunk.page_content)
+        if ids:
+            yield ids, texts
+
+    def _embed_batches(self, batches):
+        """Yields (ids, vectors) in order, with up to embed_concurrency embedding requests in flight."""
+        embed = lambda ids, texts: (ids, self._embed(texts))
+        if self.embed_concurrency == 1:
+            yield from bounded_map(None, embed, batches, 1)
+            return
+        with ThreadPoolExecutor(max_workers=self.embed_concurrency) as pool:
+            yield from bounded_map(pool, embed, batches, self.embed_concurrency * 2)
+
+    def _load_manifest(self):
+        path = os.path.join(self.index_dir, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except Exception as e:
+            print(f"[Warning] Could not read index manifest, rebuilding: {e}")
+            return None
+        if manifest.get("settings") != self._settings():
+            print("[Info] KB index settings changed, rebuilding index.")
+            return None
+        return manifest
+
+    def _load_vectorstore(self, mmap=False):
+        try:
+            if mmap:
+                # same files FAISS.save_local writes; the index is mapped read-only, never modified
+                index = faiss.read_index(os.path.join(self.index_dir, "index.faiss"), MMAP_FLAGS[self.index_type])
+                with open(os.path.join(self.index_dir, "index.pkl"), "rb") as f:
+                    docstore, index_to_docstore_id = pickle.load(f)
+                vectorstore = FAISS(self.embeddings, index, docstore, index_to_docstore_id)
+            else:
+                # the index is written by this process, so the pickled docstore is trusted
+                vectorstore = FAISS.load_local(self.index_dir, self.embeddings, allow_dangerous_deserialization=True)
+            vectorstore.docstore.open(self.index_dir)
+            apply_search_params(vectorstore.index, self.index_params)
+            return vectorstore
+        except Exception as e:
+            print(f"[Warning] Could not load saved KB index, rebuilding: {e}")
+            return None
+
+    def save(self):
+        """
+        Writes the same index.faiss / index.pkl files as FAISS.save_local, but through temp files
+        and os.replace: server workers may have the old index.faiss memory-mapped (load_shared),
+        and rewriting it in place would crash their next search with SIGBUS.
+        """
+        os.makedirs(self.index_dir, exist_ok=True)
+        tmp_path = os.path.join(self.index_dir, "index.faiss.tmp")
+        faiss.write_index(self.vectorstore.index, tmp_path)
+        os.replace(tmp_path, os.path.join(self.index_dir, "index.faiss"))
+        tmp_path = os.path.join(self.index_dir, "index.pkl.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump((self.vectorstore.docstore, self.vectorstore.index_to_docstore_id), f)
+        os.replace(tmp_path, os.path.join(self.index_dir, "index.pkl"))
+        # manifest is written last so a crash mid-save never leaves it pointing at a stale index
+        tmp_path = os.path.join(self.index_dir, MANIFEST_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.index_dir, MANIFEST_FILE))
+        self.vectorstore.docstore.remove_stale_files()
+
+    def _embed(self, texts):
+        # retries/backoff and rate limiting happen in the embeddings provider (CachedEmbeddings)
+        return np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+
+    def build(self, files=None):
+        """
+        Embeds every KB file from scratch. Files are streamed through the splitter pool and
+        size-bounded embedding batches; chunk text goes straight to the ChunkStore.
+        Flat/HNSW vectors are added as they are embedded; IVF types first keep a reservoir
+        sample of train_size vectors for training, then add everything in a second pass
+        (re-embedding is served by the embedding cache, as is a re-run after a crash).
+        """
+        files = files if files is not None else self._scan_files()
+        store = ChunkStore(self.index_dir)
+        trained = self.index_type in TRAINED_INDEX_TYPES
+        rng = np.random.default_rng(0)
+        index, sample, seen = None, None, 0
+        entries, all_ids = {}, []
+        for ids, vectors in self._embed_batches(self._chunk_batches(list(files), store, entries, files)):
+            all_ids.extend(ids)
+            if not trained:
+                if index is None:
+                    index = make_faiss_index(self.index_type, vectors.shape[1], 0, self.index_params)
+                index.add(vectors)
+                continue
+            if sample is None:
+                sample = np.empty((self.index_params["train_size"], vectors.shape[1]), dtype=np.float32)
+            for vector in vectors:  # reservoir sampling keeps the training set uniform over the KB
+                if seen < len(sample):
+                    sample[seen] = vector
+                else:
+                    slot = rng.integers(0, seen + 1)
+                    if slot < len(sample):
+                        sample[slot] = vector
+                seen += 1
+        if not all_ids:
+            raise ValueError(f"No KB documents ({self.glob or ', '.join(SUPPORTED_EXTENSIONS)}) in {self.docs_path}")
+        if trained:
+            training = sample[:min(seen, len(sample))]
+            index = make_faiss_index(self.index_type, training.shape[1], len(all_ids), self.index_params)
+            index.train(training)
+            batches = ((batch, [store.search(cid).page_content for cid in batch])
+                       for batch in (all_ids[i:i + self.batch_size] for i in range(0, len(all_ids), self.batch_size)))
+            for _, vectors in self._embed_batches(batches):
+                index.add(vectors)
+        apply_search_params(index, self.index_params)
+        self.vectorstore = FAISS(self.embeddings, index, store, dict(enumerate(all_ids)))
+        self.manifest = {"settings": self._settings(), "files": entries}
+        self.save()
+        print(f"[Info] Built KB index ({self.index_type}): {len(entries)} files, {len(all_ids)} chunks.")
+        return self.vectorstore
+
+    def load_or_build(self):
+        """
+        Loads the saved index and re-indexes only what changed in the KB folder.
+        Falls back to a full build when there is no usable saved index.
+        """
+        if not os.path.exists(self.docs_path):
+            raise FileNotFoundError(f"KB folder {self.docs_path} does not exist!")
+
+        files = self._scan_files()
+        manifest = self._load_manifest()
+        vectorstore = self._load_vectorstore() if manifest else None
+        if vectorstore is None:
+            return self.build(files)
+
+        self.vectorstore = vectorstore
+        self.manifest = manifest
+        indexed = manifest["files"]
+
+        added = [name for name in files if name not in indexed]
+        changed = [name for name in files if name in indexed and indexed[name]["hash"] != files[name]]
+        deleted = [name for name in indexed if name not in files]
+        if not (added or changed or deleted):
+            print(f"[Info] Loaded KB index from {self.index_dir} (no changes).")
+            return self.vectorstore
+
+        if self.index_type != "flat" and (changed or deleted):
+            # IVF ids do not compact on removal and HNSW cannot remove at all, so rebuild
+            # (unchanged chunks come from the embedding cache, no API calls)
+            print(f"[Info] KB files changed or deleted, rebuilding {self.index_type} index.")
+            return self.build(files)
+
+        stale_ids = [cid for name in changed + deleted for cid in indexed[name]["chunk_ids"]]
+        if stale_ids:
+            self.vectorstore.delete(stale_ids)
+        for name in deleted:
+            del indexed[name]
+
+        new_ids = []
+        id_map = self.vectorstore.index_to_docstore_id
+        batches = self._chunk_batches(added + changed, self.vectorstore.docstore, indexed, files)
+        for ids, vectors in self._embed_batches(batches):
+            start = len(id_map)
+            self.vectorstore.index.add(vectors)
+            id_map.update((start + i, cid) for i, cid in enumerate(ids))
+            new_ids.extend(ids)
+
+        self.save()
+        print(f"[Info] Updated KB index: {len(added)} added, {len(changed)} changed, "
+              f"{len(deleted)} deleted ({len(new_ids)} chunks embedded).")
+        return self.vectorstore
+
+    @contextmanager
+    def build_lock(self):
+        """Cross-process lock on the index folder, so only one worker builds shared files."""
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(os.path.join(self.index_dir, ".build.lock"), "w") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def stamp(self):
+        """Short hash of the indexed KB state (settings, file hashes, chunk ids) for derived files."""
+        return hashlib.sha256(json.dumps(self.manifest, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def load_shared(self):
+        """
+        Read-only load for multi-process servers: the saved index is memory-mapped, so every
+        worker shares the same physical pages, and the KB folder is not rescanned (startup takes
+        milliseconds). Only when there is no usable saved index does one process build it, under
+        a file lock, while the others wait and then map the result. Run ingest.py (or restart
+        without KB_INDEX_SHARED) to pick up KB changes.
+        """
+        with self.build_lock():
+            manifest = self._load_manifest()
+            if manifest is None:
+                self.load_or_build()
+                manifest = self.manifest
+        vectorstore = self._load_vectorstore(mmap=True)
+        if vectorstore is None:
+            raise RuntimeError(f"Could not memory-map the KB index in {self.index_dir}")
+        self.vectorstore = vectorstore
+        self.manifest = manifest
+        print(f"[Info] Mapped shared KB index from {self.index_dir} ({vectorstore.index.ntotal} chunks).")
+        return self.vectorstore
@@ -0,0 +1,41 @@
+import asyncio
+import threading
+import weakref
+from contextlib import contextmanager, asynccontextmanager
+
+# provider names used by the pipeline modules
+PROVIDERS = ("openai", "embeddings", "tavily")
+
+class ProviderLimits:
+    """
+    Per-provider concurrency limits shared by Retriever, Reasoner and Actor.
+    A limit of None/0 means the provider is only bounded by the pipeline's worker count.
+    """
+    def __init__(self, limits=None):
+        self.limits = dict(limits or {})
+        self._semaphores = {
+            provider: threading.BoundedSemaphore(limit)
+            for provider, limit in self.limits.items() if limit
+        }
+        # asyncio semaphores are bound to an event loop, so keep one set per loop
+        self._async_semaphores = weakref.WeakKeyDictionary()
+
+    @contextmanager
+    def slot(self, provider):
+        semaphore = self._semaphores.get(provider)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+    @asynccontextmanager
+    async def aslot(self, provider):
+        limit = self.limits.get(provider)
+        if not limit:
+            yield
+            return
+        loop_semaphores = self._async_semaphores.setdefault(asyncio.get_running_loop(), {})
+        semaphore = loop_semaphores.setdefault(provider, asyncio.Semaphore(limit))
+        async with semaphore:
+            yield
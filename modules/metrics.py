@@ -0,0 +1,116 @@
+import math
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+# per-query span durations; set by the pipeline around each query, None outside a query
+_current_spans = contextvars.ContextVar("pipeline_spans", default=None)
+
+class Histogram:
+    """Latency samples kept in a bounded reservoir (most recent max_samples) plus exact count/sum."""
+    def __init__(self, max_samples=10000):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        rank = min(len(ordered) - 1, max(0, math.ceil(p / 100.0 * len(ordered)) - 1))  # nearest rank
+        return ordered[rank]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "p50": round(self.percentile(50), 6),
+            "p95": round(self.percentile(95), 6),
+            "p99": round(self.percentile(99), 6),
+        }
+
+class MetricsRegistry:
+    """Process-wide stage latency histograms and counters (tokens, LLM calls, queries)."""
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "stages": {name: h.summary() for name, h in sorted(self.histograms.items())},
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def render_prometheus(self, cache_stats=None):
+        """
+        Prometheus text exposition format. Stage latencies are summaries with
+        0.5/0.95/0.99 quantiles; cache_stats ({namespace: stats}) adds hit/miss/eviction counters.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP pipeline_stage_seconds Latency of pipeline stages in seconds.",
+            "# TYPE pipeline_stage_seconds summary",
+        ]
+        for stage, summary in snapshot["stages"].items():
+            for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")):
+                lines.append(f'pipeline_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {summary[key]}')
+            lines.append(f'pipeline_stage_seconds_sum{{stage="{stage}"}} {summary["sum"]}')
+            lines.append(f'pipeline_stage_seconds_count{{stage="{stage}"}} {summary["count"]}')
+        for name, value in snapshot["counters"].items():
+            lines.append(f"# TYPE pipeline_{name}_total counter")
+            lines.append(f"pipeline_{name}_total {value}")
+        if cache_stats:
+            for metric in ("hits", "misses", "evictions"):
+                lines.append(f"# TYPE pipeline_cache_{metric}_total counter")
+                for namespace, stats in sorted(cache_stats.items()):
+                    if metric in stats:
+                        lines.append(f'pipeline_cache_{metric}_total{{namespace="{namespace}"}} {stats[metric]}')
+            lines.append("# TYPE pipeline_cache_hit_ratio gauge")
+            for namespace, stats in sorted(cache_stats.items()):
+                if "hit_ratio" in stats:
+                    lines.append(f'pipeline_cache_hit_ratio{{namespace="{namespace}"}} {stats["hit_ratio"]}')
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+
+@contextmanager
+def span(name):
+    """Times a block into the global histogram and, inside a query, into that query's spans."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        METRICS.observe(name, duration)
+        spans = _current_spans.get()
+        if spans is not None:
+            spans[name] = round(spans.get(name, 0.0) + duration, 6)
+
+@contextmanager
+def collect_spans():
+    """Collects the spans recorded in this context (thread / asyncio task) into a dict."""
+    spans = {}
+    token = _current_spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _current_spans.reset(token)
@@ -0,0 +1,151 @@
+import os
+import re
+import time
+import hashlib
+import threading
+from string import Formatter
+from modules.metrics import Histogram
+
+VERSION_PATTERN = re.compile(r"^v\d+$")  # answer prompt versions: v1.txt, v2.txt, v3.txt, ...
+
+class PromptTemplate:
+    """A prompt file parsed once into literal/field segments; render() only joins strings."""
+    def __init__(self, name, text, mtime):
+        self.name = name
+        self.text = text
+        self.mtime = mtime
+        self.hash = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+        self.segments = [(literal, field) for literal, field, _, _ in Formatter().parse(text)]
+        self.fields = {field for _, field in self.segments if field}
+
+    def render(self, **values):
+        missing = self.fields - values.keys()
+        if missing:
+            raise KeyError(f"Prompt {self.name} needs {', '.join(sorted(missing))}")
+        return "".join(literal + (str(values[field]) if field else "") for literal, field in self.segments)
+
+class PromptRegistry:
+    """
+    All prompt templates of the prompts folder, loaded and parsed at startup. Files are re-checked
+    at most every reload_interval seconds (PROMPT_RELOAD_INTERVAL) and re-read only when their
+    mtime changes, so edits and new versions (v3.txt, ...) go live without a restart and no LLM
+    call reads from disk. Each template's content hash is part of the LLM cache keys, so editing
+    a prompt only invalidates the answers it produced. Also keeps latency/usage stats per version.
+    """
+    def __init__(self, prompts_dir="prompts", reload_interval=None):
+        self.prompts_dir = prompts_dir
+        if reload_interval is None:
+            reload_interval = float(os.getenv("PROMPT_RELOAD_INTERVAL", 1.0))
+        self.reload_interval = reload_interval
+        self.templates = {}
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self.reload(force=True)
+
+    def reload(self, force=False):
+        """Loads new and changed prompt files and drops deleted ones."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked < self.reload_interval:
+                return
+            self._checked = now
+            try:
+                entries = [e for e in os.scandir(self.prompts_dir) if e.is_file() and e.name.endswith(".txt")]
+            except FileNotFoundError:
+                print(f"[Error] Prompts folder not found: {self.prompts_dir}")
+                entries = []
+            found = {}
+            for entry in entries:
+                name = entry.name[:-len(".txt")]
+                mtime = entry.stat().st_mtime_ns
+                current = self.templates.get(name)
+                if current is not None and current.mtime == mtime:
+                    found[name] = current
+                    continue
+                # added try except for better error handling
+                try:
+                    with open(entry.path, "r", encoding="utf-8") as f:
+                        found[name] = PromptTemplate(name, f.read(), mtime)
+                    if current is not None:
+                        print(f"[Info] Reloaded prompt {name} ({found[name].hash})")
+                except Exception as e:
+                    print(f"[Error] Failed to load prompt {entry.name}: {e}")
+                    if current is not None:
+                        found[name] = current  # keep serving the last good version
+            self.templates = found
+
+    def get(self, name):
+        self.reload()
+        template = self.templates.get(name)
+        if template is None:
+            raise ValueError(f"Unsupported prompt version: {name}")
+        return template
+
+    def versions(self):
+        """Answer prompt versions available right now, e.g. ["v1", "v2", "v3"]."""
+        self.reload()
+        return sorted((name for name in self.templates if VERSION_PATTERN.match(name)), key=lambda v: int(v[1:]))
+
+    def render(self, name, **values):
+        """Returns (prompt text, template hash)."""
+        template = self.get(name)
+        return template.render(**values), template.hash
+
+    def pick(self, query, version=None, ab=None):
+        """
+        Prompt version for one query: the requested version, or an A/B split such as
+        {"v1": 50, "v2": 50}. A/B arms are assigned by hashing the query, so the same query
+        always lands in the same arm (and keeps hitting its cached answers).
+        """
+        if ab:
+            arms = sorted((v, float(w)) for v, w in ab.items() if float(w) > 0)
+            total = sum(w for _, w in arms)
+            if not arms or any(float(w) < 0 for w in ab.values()):
+                raise ValueError("A/B weights must be non-negative with at least one positive weight")
+            for arm, _ in arms:
+                self.get(arm)
+            point = int(hashlib.sha256(query.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF * total
+            for arm, weight in arms:
+                point -= weight
+                if point <= 0:
+                    version = arm
+                    break
+            else:
+                version = arms[-1][0]
+        if version is not None:
+            self.get(version)  # raises ValueError for unknown versions
+        return version
+
+    def record(self, version, latency, usage=None):
+        """Adds one answered query to the per-version stats."""
+        with self._stats_lock:
+            stats = self._stats.setdefault(version, {
+                "latency": Histogram(max_samples=2000), "llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+            })
+            stats["latency"].observe(latency)
+            for key in ("llm_calls", "prompt_tokens", "completion_tokens"):
+                stats[key] += (usage or {}).get("calls" if key == "llm_calls" else key, 0) or 0
+
+    def stats(self):
+        """{version: {"hash", "queries", latency p50/p95/p99, LLM calls and tokens}}."""
+        with self._stats_lock:
+            result = {}
+            for version in sorted(set(self.versions()) | set(self._stats)):
+                stats = self._stats.get(version)
+                template = self.templates.get(version)
+                entry = {"hash": template.hash if template else None, "queries": 0}
+                if stats:
+                    summary = stats["latency"].summary()
+                    entry.update({
+                        "queries": summary["count"],
+                        "latency_p50": summary["p50"],
+                        "latency_p95": summary["p95"],
+                        "latency_p99": summary["p99"],
+                        "llm_calls": stats["llm_calls"],
+                        "prompt_tokens": stats["prompt_tokens"],
+                        "completion_tokens": stats["completion_tokens"],
+                    })
+                result[version] = entry
+            return result
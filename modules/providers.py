@@ -0,0 +1,437 @@
+import re
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from modules.limits import ProviderLimits
+from modules.metrics import METRICS, Histogram
+
+try:
+    import openai
+except ImportError:
+    openai = None
+try:
+    from tavily import errors as tavily_errors
+except ImportError:
+    tavily_errors = None
+
+PROVIDER_DEFAULTS = {
+    "retries": 3,              # retries per call (429, 5xx, timeouts, connection errors)
+    "base_delay": 0.5,         # backoff: base_delay * 2^attempt, +-50% jitter, capped at max_delay
+    "max_delay": 20.0,
+    "failure_threshold": 5,    # consecutive failed calls that open the circuit
+    "reset_timeout": 30.0,     # seconds the circuit stays open before a trial call
+    "hedge": False,            # send a second request when the first is slower than the p95 latency
+    "hedge_min_delay": 0.5,
+    "timeout": 30.0,           # HTTP timeout of the pooled clients
+    "max_connections": 20,     # pooled keep-alive connections per provider
+}
+BURST_SECONDS = 5  # bucket capacity, in seconds of the provider's allowed request rate
+AUTH_STATUSES = {401, 403}
+# errors without an HTTP status that still mean a transient provider problem (connection, timeout, quota)
+TRANSIENT_ERRORS = (httpx.TransportError, requests.ConnectionError, requests.Timeout, ConnectionError,
+                    TimeoutError, asyncio.TimeoutError)
+if openai is not None:
+    TRANSIENT_ERRORS += (openai.APIConnectionError,)  # includes APITimeoutError
+if tavily_errors is not None:
+    TRANSIENT_ERRORS += (tavily_errors.UsageLimitExceededError, tavily_errors.TimeoutError)
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+
+class ProviderError(Exception):
+    """A provider call failed after its retries, or was rejected by an open circuit."""
+
+class CircuitOpenError(ProviderError):
+    pass
+
+def parse_duration(value):
+    """Seconds from rate-limit header values like "1s", "6m0s", "20ms" or "1.5"."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = _DURATION.findall(value)
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+def parse_rate_limit_headers(headers):
+    """(limit, remaining, reset seconds) of the request quota, from OpenAI-style or generic headers."""
+    def first(*names):
+        for name in names:
+            if headers.get(name) is not None:
+                return headers.get(name)
+        return None
+    limit = first("x-ratelimit-limit-requests", "x-ratelimit-limit")
+    remaining = first("x-ratelimit-remaining-requests", "x-ratelimit-remaining")
+    reset = first("x-ratelimit-reset-requests", "x-ratelimit-reset")
+    try:
+        limit = int(limit) if limit is not None else None
+        remaining = int(remaining) if remaining is not None else None
+    except ValueError:
+        return None, None, None
+    return limit, remaining, parse_duration(reset)
+
+def retry_after(exc):
+    """Seconds the provider asked us to wait (Retry-After on a 429/503), or None."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        return parse_duration(headers["retry-after-ms"] + "ms")
+    return parse_duration(headers.get("retry-after"))
+
+def status_code(exc):
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
+
+def is_auth_error(exc):
+    """A rejected API key (401/403): a configuration problem, never hidden behind a fallback."""
+    if tavily_errors is not None and isinstance(exc, (tavily_errors.InvalidAPIKeyError, tavily_errors.ForbiddenError)):
+        return True
+    return status_code(exc) in AUTH_STATUSES
+
+class TokenBucket:
+    """
+    Client-side rate limiter. Unlimited until the provider's rate-limit headers give its quota
+    (limits are per minute); then refills at limit/60 requests per second, never holds more
+    than the remaining quota, and pauses until the reset time once the quota is used up.
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.capacity = max(1.0, (rate or 1) * BURST_SECONDS)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Takes a token and returns how long the caller must wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self.paused_until - now)
+            if not self.rate:
+                return delay
+            self._refill(now)
+            self.tokens -= 1
+            if self.tokens < 0:
+                delay = max(delay, -self.tokens / self.rate)
+            return delay
+
+    def try_acquire(self):
+        """Takes a token only if one is available right now (used for hedged requests)."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return False
+            if not self.rate:
+                return True
+            self._refill(now)
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update(self, limit=None, remaining=None, reset=None):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if limit:
+                self.rate = limit / 60.0
+                self.capacity = max(1.0, self.rate * BURST_SECONDS)
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+                if remaining == 0 and reset:
+                    self.paused_until = max(self.paused_until, now + reset)
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failed calls and rejects calls for reset_timeout
+    seconds; then lets one trial call through (half-open) and closes again if it succeeds.
+    A trial that ends without a verdict (cancelled) is released so the next call can try.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self):
+        """"closed" or "trial" if the call may go ahead (pass it to release()), None if rejected."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return "closed"
+            if state == "half_open" and not self._trial:
+                self._trial = True
+                return "trial"
+            return None
+
+    def release(self, admission):
+        """Called when an admitted call ends, whatever the outcome; frees an undecided trial slot."""
+        if admission == "trial":
+            with self._lock:
+                self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+class Provider:
+    """
+    One external provider ("openai", "embeddings" or "tavily"): pooled keep-alive HTTP clients,
+    a token bucket fed by the provider's rate-limit headers, per-call retries with exponential
+    backoff and jitter, a circuit breaker, and optional hedged requests. Every call goes through
+    call()/acall() with a zero-argument callable, so it can be retried or hedged.
+    Only transient failures (connection errors, timeouts, 429, 5xx) are retried, count against
+    the circuit breaker and surface as ProviderError, on which callers fall back to a KB-only
+    answer. Any other exception (4xx such as a rejected API key, or a bug in fn) is raised as is.
+    """
+    def __init__(self, name, limits=None, **settings):
+        self.name = name
+        self.limits = limits or ProviderLimits()
+        self.settings = {**PROVIDER_DEFAULTS, **settings}
+        self.bucket = TokenBucket()
+        self.breaker = CircuitBreaker(self.settings["failure_threshold"], self.settings["reset_timeout"])
+        self.latencies = Histogram(max_samples=512)
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._hedge_executor = None
+
+    # pooled HTTP clients; responses feed the token bucket
+
+    def observe_headers(self, headers):
+        limit, remaining, reset = parse_rate_limit_headers(headers)
+        if limit is not None or remaining is not None:
+            self.bucket.update(limit, remaining, reset)
+
+    def _client(self, kind, factory):
+        with self._clients_lock:
+            if kind not in self._clients:
+                self._clients[kind] = factory()
+            return self._clients[kind]
+
+    def _pool_limits(self):
+        size = self.settings["max_connections"]
+        return httpx.Limits(max_connections=size, max_keepalive_connections=size)
+
+    def http_client(self):
+        """Shared httpx.Client (e.g. OpenAI(http_client=...))."""
+        hook = lambda response: self.observe_headers(response.headers)
+        return self._client("httpx", lambda: httpx.Client(
+            limits=self._pool_limits(), timeout=self.settings["timeout"], event_hooks={"response": [hook]}))
+
+    def async_http_client(self):
+        """Shared httpx.AsyncClient (e.g. AsyncOpenAI(http_client=...))."""
+        async def hook(response):
+            self.observe_headers(response.headers)
+        return self._client("httpx_async", lambda: httpx.AsyncClient(
+            limits=self._pool_limits(), timeout=self.settings["timeout"], event_hooks={"response": [hook]}))
+
+    def requests_session(self):
+        """Shared requests.Session with a connection pool (e.g. TavilyClient(session=...))."""
+        def factory():
+            session = requests.Session()
+            size = self.settings["max_connections"]
+            session.mount("https://", HTTPAdapter(pool_connections=size, pool_maxsize=size))
+            session.hooks["response"].append(lambda response, *args, **kwargs: self.observe_headers(response.headers))
+            return session
+        return self._client("requests", factory)
+
+    # calls
+
+    def _retryable(self, exc):
+        status = status_code(exc)
+        if status is not None:
+            return status == 429 or status >= 500
+        return isinstance(exc, TRANSIENT_ERRORS)
+
+    def _backoff(self, attempt, exc):
+        delay = retry_after(exc)
+        if delay is not None:
+            self.bucket.pause(delay)  # every caller of this provider waits, not just this one
+            return delay
+        delay = min(self.settings["max_delay"], self.settings["base_delay"] * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    def _check_circuit(self):
+        admission = self.breaker.allow()
+        if admission is None:
+            METRICS.inc(f"provider_{self.name}_rejected")
+            raise CircuitOpenError(f"{self.name} circuit open")
+        return admission
+
+    def _failed(self, exc):
+        self.breaker.record_failure()
+        if self.breaker.state == "open":
+            print(f"[Warning] {self.name} circuit opened after repeated failures")
+        METRICS.inc(f"provider_{self.name}_failures")
+        return ProviderError(f"{self.name} call failed: {exc}")
+
+    def _not_retried(self, exc):
+        # other HTTP errors (bad request, bad API key) mean the provider answered, so it counts as
+        # healthy; errors without a status came from fn itself and say nothing about the provider
+        if status_code(exc) is not None:
+            self.breaker.record_success()
+
+    def _retry(self, attempt, exc):
+        """Returns the delay before the next attempt, or None when the call should fail."""
+        if attempt == self.settings["retries"]:
+            return None
+        delay = self._backoff(attempt, exc)
+        METRICS.inc(f"provider_{self.name}_retries")
+        print(f"[Warning] {self.name} call failed ({exc}), retrying in {delay:.1f}s "
+              f"({attempt + 1}/{self.settings['retries']})")
+        return delay
+
+    def _hedge_delay(self):
+        """p95 of recent latencies once there are enough samples, else None (no hedging yet)."""
+        if not self.settings["hedge"] or len(self.latencies.samples) < 20:
+            return None
+        return max(self.settings["hedge_min_delay"], self.latencies.percentile(95))
+
+    def _hedged(self, fn):
+        delay = self._hedge_delay()
+        if delay is None:
+            return fn()
+        if self._hedge_executor is None:
+            self._hedge_executor = ThreadPoolExecutor(max_workers=8)
+        first = self._hedge_executor.submit(contextvars.copy_context().run, fn)
+        done, _ = wait([first], timeout=delay)
+        if done or not self.bucket.try_acquire():
+            return first.result()
+        METRICS.inc(f"provider_{self.name}_hedged")
+        pending = {first, self._hedge_executor.submit(contextvars.copy_context().run, fn)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()  # the slower request finishes in the background
+                error = error or future.exception()
+        raise error
+
+    async def _ahedged(self, fn):
+        delay = self._hedge_delay()
+        if delay is None:
+            return await fn()
+        first = asyncio.ensure_future(fn())
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not self.bucket.try_acquire():
+            return await first
+        METRICS.inc(f"provider_{self.name}_hedged")
+        pending = {first, asyncio.ensure_future(fn())}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def call(self, fn, hedge=True):
+        """Runs fn() with rate limiting, retries, the circuit breaker and (if enabled) hedging."""
+        admission = self._check_circuit()
+        try:
+            for attempt in range(self.settings["retries"] + 1):
+                self.bucket.acquire()
+                start = time.perf_counter()
+                try:
+                    with self.limits.slot(self.name):
+                        result = self._hedged(fn) if hedge else fn()
+                except Exception as e:
+                    if not self._retryable(e):
+                        self._not_retried(e)
+                        raise
+                    delay = self._retry(attempt, e)
+                    if delay is None:
+                        raise self._failed(e) from e
+                    time.sleep(delay)
+                    continue
+                self.latencies.observe(time.perf_counter() - start)
+                self.breaker.record_success()
+                return result
+        finally:
+            self.breaker.release(admission)
+
+    async def acall(self, fn, hedge=True):
+        """Async variant of call(); fn() returns an awaitable."""
+        admission = self._check_circuit()
+        try:
+            for attempt in range(self.settings["retries"] + 1):
+                await self.bucket.aacquire()
+                start = time.perf_counter()
+                try:
+                    async with self.limits.aslot(self.name):
+                        result = await (self._ahedged(fn) if hedge else fn())
+                except Exception as e:
+                    if not self._retryable(e):
+                        self._not_retried(e)
+                        raise
+                    delay = self._retry(attempt, e)
+                    if delay is None:
+                        raise self._failed(e) from e
+                    await asyncio.sleep(delay)
+                    continue
+                self.latencies.observe(time.perf_counter() - start)
+                self.breaker.record_success()
+                return result
+        finally:
+            # a cancelled (e.g. discarded speculative) trial must not keep the circuit half-open forever
+            self.breaker.release(admission)
+
+    def status(self):
+        return {"circuit": self.breaker.state, "rate_per_s": self.bucket.rate}
+
+def build_providers(limits=None, **settings):
+    """One Provider per external service, sharing the pipeline's concurrency limits."""
+    return {name: Provider(name, limits, **settings) for name in ("openai", "embeddings", "tavily")}
@@ -1,95 +1,261 @@
 import os
 import sys  
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from modules.limits import ProviderLimits
+from modules.cache import make_cache
+from modules.metrics import METRICS, span
+from modules.providers import Provider, ProviderError, is_auth_error
+from modules.context_builder import ContextBuilder
+from modules.prompt_registry import PromptRegistry
 
 class Reasoner:
-    def __init__(self, prompt_version="v1"):
+    def __init__(self, prompt_version="v1", limits=None, client=None, async_client=None, cache=None, router=None,
+                 provider=None, context_builder=None, prompts=None):
         try:
-            self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+            # OpenAI calls go through the "openai" Provider: pooled keep-alive clients, rate limiting,
+            # retries and a circuit breaker (the SDK's own retries are off)
+            self.limits = limits or ProviderLimits()
+            self.provider = provider or Provider("openai", self.limits)
+            # clients can be injected (e.g. the offline stubs in modules/stubs.py)
+            self.client = client or OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0,
+                                           http_client=self.provider.http_client())
+            self.async_client = async_client or AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0,
+                                                            http_client=self.provider.async_http_client())
+            # templates are loaded once and hot-reloaded on change; each call can pick its own version
+            self.prompts = prompts or PromptRegistry("prompts")
+            self.prompts.get(prompt_version)  # fail fast on unsupported versions
             self.prompt_version = prompt_version
-            self.prompts_dir = "prompts"
-            self.cache = {} # Simple in-memory cache
+            self.cache = cache if cache is not None else make_cache("reasoner")  # bounded LRU/TTL cache, optionally on disk
+            self.router = router  # optional local KB/Tavily router (modules/router.py) in front of the LLM decision
+            # deduplicated, re-ranked context packed to a per-prompt token budget
+            self.context_builder = context_builder or ContextBuilder()
         except Exception as e:
             print(f"[Error] Failed to initialize Reasoner: {e}")
             sys.exit(1)
 
-    def _load_prompt(self, filename):
-        path = os.path.join(self.prompts_dir, filename)
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                return f.read()
-        except FileNotFoundError:
-            print(f"[Error] Prompt file not found: {path}")
-            sys.exit(1)
-        except Exception as e:
-            print(f"[Error] Failed to load prompt {filename}: {e}")
-            sys.exit(1)
+    def _get_prompt(self, query, context="", prompt_version=None):
+        """(answer prompt, template hash) for the version; raises ValueError for unknown versions."""
+        return self.prompts.render(prompt_version or self.prompt_version, query=query, context=context)
 
-    def _get_prompt(self, query, context=""):
-        try:
-            if self.prompt_version == "v1":
-                template = self._load_prompt("v1.txt")
-            elif self.prompt_version == "v2":
-                template = self._load_prompt("v2.txt")
-            else:
-                raise ValueError(f"Unsupported prompt version: {self.prompt_version}")
-            return template.format(query=query, context=context)
-        except Exception as e:
-            print(f"[Error] Failed to format prompt: {e}")
-            return ""
-        
-    def reason(self, query, context=""):
-        key = (query, context)
-        if key in self.cache:  # Check cache first
-            return self.cache[key]
-        # added try except for better error handling 
-        try:
-            prompt = self._get_prompt(query, context)
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=250
-            )
-            output = response.choices[0].message.content.strip()
-            self.cache[key] = output  # Cache the result
-            return output
-        except Exception as e:
-            print(f"[Error] LLM reasoning failed: {e}")
-            return "LLM reasoning failed due to an error."
+    def _decision_prompt(self, query, context):
+        """decide_action prompt with the context packed to the (smaller) decision budget."""
+        context_text, context_tokens = self.context_builder.build(query, context, "decision")
+        prompt, _ = self.prompts.render(
+            "decide_action",
+            query=query,
+            context=context_text if context_text else "No KB context available."
+        )
+        return prompt, context_tokens
+
+    def _fallback_result(self, usage, error, prompt_version=None):
+        """KB answer used when the decision LLM is unavailable (provider failed or circuit open)."""
+        print(f"[Warning] Decision LLM unavailable, answering from the KB: {error}")
+        METRICS.inc("fallback_answers")
+        action, reasoning_trace = self._decision_result("fallback: kb", usage, prompt_version)
+        reasoning_trace["fallback"] = str(error)
+        return action, reasoning_trace
 
-    def decide_action(self, query, context=""):
+    def _decision_result(self, action_text, usage, prompt_version=None):
+        # LLM decides
+        action = "tavily_search" if "tavily" in action_text else "kb_summary"
+        prompt_version = prompt_version or self.prompt_version
+        reasoning_trace = {
+            "prompt_version": prompt_version,
+            "prompt_hash": self.prompts.get(prompt_version).hash,
+            "used": "KB" if action == "kb_summary" else "Tavily",
+            "decision_text": action_text,   # log exact LLM output
+            "llm_usage": usage
+        }
+        return action, reasoning_trace
+
+    def _route(self, query, context):
+        """
+        Asks the local router first. Returns (action_text, router trace fields); action_text is
+        None when there is no router or the query is ambiguous and the LLM has to decide.
         """
-        Decide whether to use KB or external tool (Tavily) based ONLY on LLM decision.
+        if self.router is None:
+            return None, {}
+        with span("route"):
+            action, features = self.router.route(query, context)
+        METRICS.inc("router_llm" if action is None else "router_local")
+        router_trace = {"router": "llm" if action is None else "local", "router_features": features}
+        if action is None:
+            return None, router_trace
+        return ("router: tavily" if action == "tavily_search" else "router: kb"), router_trace
+
+    @staticmethod
+    def new_usage():
+        """Per-query accumulator of the LLM calls and tokens actually spent."""
+        return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    @staticmethod
+    def _record_usage(usage, response):
+        response_usage = getattr(response, "usage", None)
+        prompt_tokens = (getattr(response_usage, "prompt_tokens", 0) or 0) if response_usage is not None else 0
+        completion_tokens = (getattr(response_usage, "completion_tokens", 0) or 0) if response_usage is not None else 0
+        METRICS.inc("llm_calls")
+        METRICS.inc("llm_prompt_tokens", prompt_tokens)
+        METRICS.inc("llm_completion_tokens", completion_tokens)
+        if usage is None:
+            return
+        usage["calls"] += 1
+        usage["prompt_tokens"] += prompt_tokens
+        usage["completion_tokens"] += completion_tokens
+
+    def _complete(self, prompt, max_tokens, usage=None):
+        response = self.provider.call(lambda: self.client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens
+        ))
+        self._record_usage(usage, response)
+        return response.choices[0].message.content.strip()
+
+    async def _acomplete(self, prompt, max_tokens, usage=None):
+        response = await self.provider.acall(lambda: self.async_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens
+        ))
+        self._record_usage(usage, response)
+        return response.choices[0].message.content.strip()
+
+    def reason(self, query, context="", usage=None, prompt_version=None):
         """
+        LLM answer over the context (retrieval results or text), packed to the answer budget.
+        Raises ProviderError when the LLM is unavailable.
+        """
+        context, _ = self.context_builder.build(query, context, "answer")
+        prompt, prompt_hash = self._get_prompt(query, context, prompt_version)
+        # the template hash is part of the key: editing a prompt only invalidates its own answers
+        key = (prompt_version or self.prompt_version, prompt_hash, query, context)
+        cached = self.cache.get(key)
+        if cached is not None:  # Check cache first
+            return cached
+        with span("answer"):
+            output = self._complete(prompt, max_tokens=250, usage=usage)
+        self.cache.set(key, output)  # Cache the result
+        return output
+
+    async def areason(self, query, context="", usage=None, prompt_version=None):
+        """Async variant of reason() using AsyncOpenAI."""
+        context, _ = self.context_builder.build(query, context, "answer")
+        prompt, prompt_hash = self._get_prompt(query, context, prompt_version)
+        # the template hash is part of the key: editing a prompt only invalidates its own answers
+        key = (prompt_version or self.prompt_version, prompt_hash, query, context)
+        cached = self.cache.get(key)
+        if cached is not None:  # Check cache first
+            return cached
+        with span("answer"):
+            output = await self._acomplete(prompt, max_tokens=250, usage=usage)
+        self.cache.set(key, output)  # Cache the result
+        return output
+
+    def stream_reason(self, query, context="", usage=None, prompt_version=None):
+        """
+        Streaming variant of reason(): yields answer tokens as the completion arrives.
+        The full answer is cached once the stream finishes. Raises ProviderError when the
+        LLM is unavailable (the stream itself is not retried or hedged).
+        """
+        context, _ = self.context_builder.build(query, context, "answer")
+        prompt, prompt_hash = self._get_prompt(query, context, prompt_version)
+        key = (prompt_version or self.prompt_version, prompt_hash, query, context)
+        cached = self.cache.get(key)
+        if cached is not None:  # Check cache first
+            yield cached
+            return
+        parts = []
+        stream = self.provider.call(lambda: self.client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=250,
+            stream=True,
+            stream_options={"include_usage": True}
+        ), hedge=False)
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+            elif getattr(chunk, "usage", None) is not None:
+                self._record_usage(usage, chunk)
+        self.cache.set(key, "".join(parts).strip())  # Cache the result
+
+    def decide_action(self, query, context="", generate_answer=False, prompt_version=None):
+        """
+        Decide whether to use KB or external tool (Tavily) based ONLY on LLM decision,
+        unless a local router is set and confident (reasoning_trace["router"] says which decided).
+        The pipeline answers from the KB summary or the Tavily result, so the answer
+        LLM call is only made when generate_answer=True; otherwise answer is None.
+        reasoning_trace["llm_usage"] records the calls/tokens actually spent.
+        If the OpenAI provider is unavailable the action falls back to "kb_summary" and
+        reasoning_trace["fallback"] records why. prompt_version overrides the default answer
+        prompt for this call (per-request selection / A/B tests).
+        """
+        usage = self.new_usage()
+        fallback, router_trace, context_tokens = None, {}, None
         # added try except for better error handling
         try: 
-            context_text = context.get("summary", "") if isinstance(context, dict) else str(context)
-
-            template = self._load_prompt("decide_action.txt")
-            prompt = template.format(
-                query=query,
-                context=context_text if context_text else "No KB context available."
-            )
-
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=20
-            )
-            action_text = response.choices[0].message.content.strip().lower()
+            action_text, router_trace = self._route(query, context)
+            if action_text is None:
+                prompt, context_tokens = self._decision_prompt(query, context)
+                with span("decision"):
+                    action_text = self._complete(prompt, max_tokens=20, usage=usage).lower()
+        except ProviderError as e:
+            fallback = e
         except Exception as e:
+            if is_auth_error(e):
+                raise  # a rejected API key is reported, not answered around
             print(f"[Error] Failed to decide action: {e}")
             return "error", "Unable to decide action due to an error.", {}
-        # LLM decides
-        action = "tavily_search" if "tavily" in action_text else "kb_summary"
+        if fallback is not None:
+            action, reasoning_trace = self._fallback_result(usage, fallback, prompt_version)
+        else:
+            action, reasoning_trace = self._decision_result(action_text, usage, prompt_version)
+        reasoning_trace.update(router_trace)
+        reasoning_trace["context_tokens"] = context_tokens
 
-        # Generate final answer
-        answer = self.reason(query, context_text if action == "kb_summary" else "")
+        # Generate final answer only if the caller consumes it
+        answer = None
+        if generate_answer and fallback is None:
+            try:
+                answer = self.reason(query, context if action == "kb_summary" else "", usage=usage,
+                                     prompt_version=prompt_version)
+            except ProviderError as e:
+                reasoning_trace["fallback"] = str(e)
 
-        reasoning_trace = {
-            "prompt_version": self.prompt_version,
-            "used": "KB" if action == "kb_summary" else "Tavily",
-            "decision_text": action_text   # log exact LLM output
-        }
+        return action, answer, reasoning_trace
+
+    async def adecide_action(self, query, context="", generate_answer=False, prompt_version=None):
+        """Async variant of decide_action()."""
+        usage = self.new_usage()
+        fallback, router_trace, context_tokens = None, {}, None
+        try:
+            action_text, router_trace = self._route(query, context)
+            if action_text is None:
+                prompt, context_tokens = self._decision_prompt(query, context)
+                with span("decision"):
+                    action_text = (await self._acomplete(prompt, max_tokens=20, usage=usage)).lower()
+        except ProviderError as e:
+            fallback = e
+        except Exception as e:
+            if is_auth_error(e):
+                raise
+            print(f"[Error] Failed to decide action: {e}")
+            return "error", "Unable to decide action due to an error.", {}
+        if fallback is not None:
+            action, reasoning_trace = self._fallback_result(usage, fallback, prompt_version)
+        else:
+            action, reasoning_trace = self._decision_result(action_text, usage, prompt_version)
+        reasoning_trace.update(router_trace)
+        reasoning_trace["context_tokens"] = context_tokens
+
+        # Generate final answer only if the caller consumes it
+        answer = None
+        if generate_answer and fallback is None:
+            try:
+                answer = await self.areason(query, context if action == "kb_summary" else "", usage=usage,
+                                            prompt_version=prompt_version)
+            except ProviderError as e:
+                reasoning_trace["fallback"] = str(e)
 
         return action, answer, reasoning_trace
@@ -1,48 +1,326 @@
 import os
+import asyncio
+import faiss
+import numpy as np
 from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import TextLoader, DirectoryLoader
+from langchain_core.documents import Document
+from langchain_community.vectorstores.utils import DistanceStrategy
+from modules.kb_index import KBIndex, apply_search_params
+from modules.embedding_cache import EmbeddingCache, CachedEmbeddings
+from modules.cache import make_cache
+from modules.metrics import METRICS, span
+from modules.bm25 import BM25Index, reciprocal_rank_fusion
+from modules.providers import Provider, ProviderError, is_auth_error
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+RETRIEVAL_MODES = ("hybrid", "dense")
 
 class Retriever:
-    def __init__(self, docs_path):
+    def __init__(self, docs_path, index_dir=None, embedding_cache_dir=None, limits=None,
+                 embeddings=None, embedding_model=EMBEDDING_MODEL, cache=None, mode=None,
+                 lexical_threshold=None, index_type=None, index_params=None, shared_index=None,
+                 provider=None):
+        """
+        mode: "hybrid" (default, BM25 + FAISS fused with reciprocal rank fusion) or "dense"
+        (FAISS only); also settable via RETRIEVAL_MODE.
+        lexical_threshold: BM25 confidence (0-1) above which a hybrid query is answered from the
+        keyword index alone, with no embedding call (default 0.9, LEXICAL_THRESHOLD; 1.1 disables).
+        index_type: FAISS index - "flat" (exact, default), "ivf_flat", "hnsw" or "ivf_pq"
+        (also settable via KB_INDEX_TYPE); index_params: build/search settings such as
+        nlist, pq_m, hnsw_m, nprobe, ef_search (see modules/kb_index.py INDEX_DEFAULTS).
+        shared_index: load the saved index read-only and memory-mapped, without rescanning the KB,
+        so server worker processes share one copy (also settable via KB_INDEX_SHARED=1).
+        provider: the "embeddings" Provider (modules/providers.py) - pooled HTTP client, rate
+        limiting, retries and circuit breaker. When it fails, hybrid retrieval falls back to BM25.
+        """
+        self.mode = mode or os.getenv("RETRIEVAL_MODE", "hybrid")
+        if self.mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unsupported retrieval mode: {self.mode}")
+        if lexical_threshold is None:
+            lexical_threshold = float(os.getenv("LEXICAL_THRESHOLD", 0.9))
+        self.lexical_threshold = lexical_threshold
+        self.index_type = index_type or os.getenv("KB_INDEX_TYPE", "flat")
+        self.index_params = dict(index_params or {})
+        if shared_index is None:
+            shared_index = os.getenv("KB_INDEX_SHARED", "0").lower() in ("1", "true", "yes")
+        self.shared_index = shared_index
         # added try except for better error handling
         try:
-            self.embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+            # persistent embedding cache shared by KB indexing and query-time retrieval
+            # (embeddings can be injected, e.g. the offline stubs in modules/stubs.py)
+            self.embedding_model = embedding_model
+            cache_dir = embedding_cache_dir or os.getenv("EMBEDDING_CACHE_DIR", "embedding_cache")
+            provider = provider or Provider("embeddings", limits)
+            if embeddings is None:
+                # pooled keep-alive client; retries are done by the provider, not the SDK
+                embeddings = OpenAIEmbeddings(model=embedding_model, http_client=provider.http_client(),
+                                              http_async_client=provider.async_http_client(), max_retries=0)
+            self.embeddings = CachedEmbeddings(embeddings, EmbeddingCache(cache_dir, embedding_model),
+                                               provider=provider)
+            self.index_dir = index_dir or os.getenv("KB_INDEX_DIR", "kb_index")
             self.vectorstore = self._load_docs(docs_path)
+            self.bm25 = self._build_lexical_index() if self.mode == "hybrid" else None
         except FileNotFoundError as fnf_error:
             print(f"[Error] KB folder not found: {fnf_error}")
             raise
         except Exception as e:
             print(f"[Error] Failed to initialize Retriever: {e}")
             raise
-        self.cache = {}  # In-memory cache for document retrievals
+        self.cache = cache if cache is not None else make_cache("retriever")  # bounded LRU/TTL cache for document retrievals
 
     def _load_docs(self, docs_path):
         # added check for docs_path existence
         if not os.path.exists(docs_path):
             raise FileNotFoundError(f"KB folder {docs_path} does not exist!")
         try:
-            loader = DirectoryLoader(docs_path, glob="*.txt", loader_cls=TextLoader)
-            documents = loader.load()
-            splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-            docs_chunks = splitter.split_documents(documents)
-            return FAISS.from_documents(docs_chunks, self.embeddings)
+            # persistent index: only added/changed files are re-embedded on startup
+            self.kb_index = KBIndex(
+                docs_path,
+                self.embeddings,
+                index_dir=self.index_dir,
+                embedding_model=self.embedding_model,
+                chunk_size=1000,
+                chunk_overlap=100,
+                index_type=self.index_type,
+                index_params=self.index_params,
+            )
+            if self.shared_index:
+                return self.kb_index.load_shared()
+            return self.kb_index.load_or_build()
         except Exception as e:
             print(f"[Error] Failed to load documents: {e}")
             raise
 
+    def set_search_params(self, **params):
+        """Tunes approximate search at runtime, e.g. set_search_params(nprobe=16, ef_search=128)."""
+        self.index_params.update(params)
+        apply_search_params(self.vectorstore.index, self.kb_index.index_params | params)
+        self.cache.clear()  # cached results were found with the old settings
+
+    def _chunk_texts(self, keys):
+        for key in keys:
+            doc = self.vectorstore.docstore.search(key)
+            yield doc.page_content if isinstance(doc, Document) else ""
+
+    def _build_lexical_index(self):
+        """BM25 index over the same chunks (and chunk ids) as the FAISS index."""
+        keys = list(self.vectorstore.index_to_docstore_id.values())
+        if not self.shared_index:
+            return BM25Index(keys, self._chunk_texts(keys))
+        # shared mode: postings are saved next to the FAISS index and memory-mapped, so workers
+        # start without re-reading every chunk and share one copy; the first worker builds them
+        stamp = self.kb_index.stamp()
+        bm25 = BM25Index.load(self.index_dir, keys, stamp)
+        if bm25 is None:
+            with self.kb_index.build_lock():
+                bm25 = BM25Index.load(self.index_dir, keys, stamp)
+                if bm25 is None:
+                    BM25Index(keys, self._chunk_texts(keys)).save(self.index_dir, stamp)
+                    bm25 = BM25Index.load(self.index_dir, keys, stamp)
+                    print(f"[Info] Saved BM25 index to {self.index_dir}")
+        return bm25
+
+    def _lexical_search(self, query, top_k):
+        """
+        Returns (lexical ranking, output). output is set when the keyword match is confident
+        enough to skip the embedding call (the lexical fast path), otherwise None.
+        """
+        if self.bm25 is None:
+            return [], None
+        with span("lexical_search"):
+            ranking = self.bm25.search(query, top_k * 4)
+            confident = self.bm25.confidence(query, ranking) >= self.lexical_threshold
+        if not confident:
+            return ranking, None
+        METRICS.inc("retrieval_lexical_only")
+        hits = ranking[:top_k]
+        docs = [self.vectorstore.docstore.search(key) for key, _ in hits]
+        return ranking, self._output(docs, [round(score, 4) for _, score in hits], "lexical")
+
+    @staticmethod
+    def _output(docs, scores, retrieval, similarities=None):
+        summary = " ".join([doc.page_content for doc in docs])
+        return {"summary": summary, "docs": docs, "scores": scores, "retrieval": retrieval,
+                "similarities": similarities or []}
+
+    def _fuse(self, lexical, dense, top_k):
+        """Reciprocal rank fusion of the BM25 ranking and the FAISS hits (dense mode: FAISS only)."""
+        docs_by_key = {key: doc for key, doc, _ in dense}
+        rankings = [[key for key, _, _ in dense]]
+        if self.bm25 is not None:
+            rankings.append([key for key, _ in lexical])
+        fused = reciprocal_rank_fusion(rankings)[:top_k]
+        docs = []
+        for key, _ in fused:
+            doc = docs_by_key.get(key) or self.vectorstore.docstore.search(key)
+            docs.append(doc)
+        similarities = [similarity for _, _, similarity in dense[:top_k]]
+        return self._output(docs, [round(score, 4) for _, score in fused], self.mode, similarities)
+
+    def _candidates(self, top_k):
+        # hybrid fuses deeper FAISS candidate lists so keyword-only hits can still make the top_k
+        return top_k * 4 if self.bm25 is not None else top_k
+
+    def _lexical_fallback(self, lexical, top_k, error):
+        """BM25-only results when the embeddings provider is unavailable (not cached)."""
+        print(f"[Warning] Embeddings unavailable, using keyword retrieval: {error}")
+        METRICS.inc("retrieval_fallback")
+        hits = lexical[:top_k]
+        docs = [self.vectorstore.docstore.search(key) for key, _ in hits]
+        return self._output(docs, [round(score, 4) for _, score in hits], "lexical_fallback")
+
     def get_relevant_docs(self, query, top_k=3):
+        with span("retrieve"):
+            return self._get_relevant_docs(query, top_k)
+
+    def _get_relevant_docs(self, query, top_k):
         # added simple in-memory cache for retrieval results
-        if query in self.cache:  # Check cache first
-            return self.cache[query]
+        cached = self.cache.get(query)
+        if cached is not None:  # Check cache first
+            return cached
         try: 
-            results = self.vectorstore.similarity_search(query, k=top_k)
-            summary = " ".join([doc.page_content for doc in results])
-            output = {"summary": summary, "docs": results}
+            lexical, output = self._lexical_search(query, top_k)
+            if output is None:
+                try:
+                    with span("embed"):
+                        vector = self.embeddings.embed_query(query)
+                except ProviderError as e:
+                    return self._lexical_fallback(lexical, top_k, e)
+                dense = self._search_batch([vector], self._candidates(top_k))[0]
+                output = self._fuse(lexical, dense, top_k)
         except Exception as e:
+            if is_auth_error(e):
+                raise  # a rejected API key is reported, not answered around
             print(f"[Error] Failed to retrieve relevant docs: {e}")
             output = {"summary": "", "docs": []}    
 
-        self.cache[query] = output  # Cache the result
+        self.cache.set(query, output)  # Cache the result
+        return output
+
+    async def aget_relevant_docs(self, query, top_k=3):
+        """Async variant of get_relevant_docs(); the embedding call is awaited, FAISS search runs in a thread."""
+        with span("retrieve"):
+            return await self._aget_relevant_docs(query, top_k)
+
+    async def _aget_relevant_docs(self, query, top_k):
+        cached = self.cache.get(query)
+        if cached is not None:  # Check cache first
+            return cached
+        try:
+            lexical, output = self._lexical_search(query, top_k)
+            if output is None:
+                try:
+                    with span("embed"):
+                        vector = await self.embeddings.aembed_query(query)
+                except ProviderError as e:
+                    return self._lexical_fallback(lexical, top_k, e)
+                dense = (await asyncio.to_thread(self._search_batch, [vector], self._candidates(top_k)))[0]
+                output = self._fuse(lexical, dense, top_k)
+        except Exception as e:
+            if is_auth_error(e):
+                raise
+            print(f"[Error] Failed to retrieve relevant docs: {e}")
+            output = {"summary": "", "docs": []}
+
+        self.cache.set(query, output)  # Cache the result
         return output
+
+    def _similarity(self, distance):
+        # embeddings are unit length, so squared L2 distance d maps to cosine similarity 1 - d / 2
+        if self.vectorstore.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+            return round(float(distance), 4)
+        return round(1.0 - float(distance) / 2, 4)
+
+    def _search_batch(self, vectors, top_k):
+        """
+        One FAISS search call for a matrix of query vectors.
+        Returns [(docstore id, Document, cosine similarity)] per row, best first.
+        """
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if self.vectorstore._normalize_L2:
+            faiss.normalize_L2(matrix)
+        with span("faiss_search"):
+            distances, indices = self.vectorstore.index.search(matrix, top_k)
+        batch_docs = []
+        for row_distances, row in zip(distances, indices):
+            docs = []
+            for distance, i in zip(row_distances, row):
+                if i == -1:
+                    continue  # fewer than top_k vectors in the index
+                key = self.vectorstore.index_to_docstore_id[int(i)]
+                doc = self.vectorstore.docstore.search(key)
+                if isinstance(doc, Document):
+                    docs.append((key, doc, self._similarity(distance)))
+            batch_docs.append(docs)
+        return batch_docs
+
+    def _collect_batch(self, queries, uncached, lexical, vectors, top_k, outputs):
+        try:
+            for query, dense in zip(uncached, self._search_batch(vectors, self._candidates(top_k))):
+                outputs[query] = self._fuse(lexical[query], dense, top_k)
+                self.cache.set(query, outputs[query])  # Cache the result
+        except Exception as e:
+            print(f"[Error] Failed to retrieve relevant docs: {e}")
+            for query in uncached:
+                outputs[query] = {"summary": "", "docs": []}
+        return [outputs[query] for query in queries]
+
+    def _split_cached(self, queries, top_k):
+        """
+        Resolves cached and lexical fast-path queries.
+        Returns (outputs, queries that still need an embedding, their lexical rankings).
+        """
+        outputs = {}
+        lexical = {}
+        for query in dict.fromkeys(queries):
+            cached = self.cache.get(query)
+            if cached is not None:
+                outputs[query] = cached
+                continue
+            try:
+                lexical[query], output = self._lexical_search(query, top_k)
+            except Exception as e:
+                print(f"[Error] Failed to retrieve relevant docs: {e}")
+                lexical[query], output = [], None
+            if output is not None:
+                outputs[query] = output
+                self.cache.set(query, output)  # Cache the result
+        return outputs, [q for q in dict.fromkeys(queries) if q not in outputs], lexical
+
+    def get_relevant_docs_batch(self, queries, top_k=3):
+        """
+        Batched get_relevant_docs(): all uncached queries are embedded in one embeddings
+        request and searched with a single FAISS matrix search.
+        Returns one {"summary", "docs", "scores", "retrieval", "similarities"} dict per query, in input order.
+        """
+        outputs, uncached, lexical = self._split_cached(queries, top_k)
+        if not uncached:
+            return [outputs[query] for query in queries]
+        try:
+            with span("embed"):
+                vectors = self.embeddings.embed_documents(uncached)
+        except ProviderError as e:
+            for query in uncached:
+                outputs[query] = self._lexical_fallback(lexical[query], top_k, e)
+            return [outputs[query] for query in queries]
+        except Exception as e:
+            print(f"[Error] Failed to embed queries: {e}")
+            return [outputs.get(query) or self.get_relevant_docs(query, top_k) for query in queries]
+        return self._collect_batch(queries, uncached, lexical, vectors, top_k, outputs)
+
+    async def aget_relevant_docs_batch(self, queries, top_k=3):
+        """Async variant of get_relevant_docs_batch()."""
+        outputs, uncached, lexical = self._split_cached(queries, top_k)
+        if not uncached:
+            return [outputs[query] for query in queries]
+        try:
+            with span("embed"):
+                vectors = await self.embeddings.aembed_documents(uncached)
+        except ProviderError as e:
+            for query in uncached:
+                outputs[query] = self._lexical_fallback(lexical[query], top_k, e)
+            return [outputs[query] for query in queries]
+        except Exception as e:
+            print(f"[Error] Failed to embed queries: {e}")
+            return [outputs.get(query) or await self.aget_relevant_docs(query, top_k) for query in queries]
+        return await asyncio.to_thread(self._collect_batch, queries, uncached, lexical, vectors, top_k, outputs)
@@ -0,0 +1,100 @@
+import os
+import json
+import itertools
+from modules.bm25 import tokenize
+from modules.speculation import has_recency_cue
+
+# thresholds used when no calibration file exists (see calibrate_router.py)
+ROUTER_DEFAULTS = {"kb_overlap": 0.75, "kb_similarity": 0.3, "tool_overlap": 0.25}
+
+def router_features(query, kb_results):
+    """
+    Local signals for the KB/Tavily decision:
+    overlap - share of the query's terms found in the retrieved KB text,
+    similarity / similarity_gap - cosine similarity of the best FAISS hit and its lead over the next
+    (None on the lexical fast path, which needs no embedding), lexical - retrieval took the BM25 fast path,
+    recency - the query has recency/entity cues ("current", "price", a year, ...).
+    """
+    kb_results = kb_results if isinstance(kb_results, dict) else {"summary": str(kb_results or "")}
+    terms = set(tokenize(query))
+    kb_terms = set(tokenize(kb_results.get("summary", "")))
+    similarities = kb_results.get("similarities") or []
+    return {
+        "overlap": round(len(terms & kb_terms) / len(terms), 4) if terms else 0.0,
+        "similarity": similarities[0] if similarities else None,
+        "similarity_gap": round(similarities[0] - similarities[1], 4) if len(similarities) > 1 else None,
+        "lexical": kb_results.get("retrieval") == "lexical",
+        "recency": has_recency_cue(query),
+    }
+
+class Router:
+    """
+    Decides KB vs Tavily locally when the retrieval signals are clear, so the decide_action
+    LLM call is only made for ambiguous queries.
+      KB     - no recency cue, and the BM25 fast path matched or the KB text covers at least
+               kb_overlap of the query terms with a FAISS similarity of at least kb_similarity
+      Tavily - a recency cue, or at most tool_overlap of the query terms appear in the KB text
+    Thresholds come from ROUTER_DEFAULTS or a calibration file written by calibrate_router.py.
+    """
+    def __init__(self, thresholds=None, calibration_path=None):
+        self.thresholds = dict(ROUTER_DEFAULTS)
+        calibration_path = calibration_path or os.getenv("ROUTER_CALIBRATION", "router_calibration.json")
+        if thresholds is None and os.path.exists(calibration_path):
+            try:
+                with open(calibration_path, "r", encoding="utf-8") as f:
+                    thresholds = json.load(f).get("thresholds")
+            except Exception as e:
+                print(f"[Warning] Could not load router calibration {calibration_path}: {e}")
+        self.thresholds.update(thresholds or {})
+
+    def decide(self, features, thresholds=None):
+        """Returns "kb_summary", "tavily_search" or None (ambiguous, ask the LLM)."""
+        t = thresholds or self.thresholds
+        if features["recency"]:
+            return "tavily_search"
+        if features["lexical"]:
+            return "kb_summary"
+        similarity = features["similarity"]
+        if features["overlap"] >= t["kb_overlap"] and (similarity is None or similarity >= t["kb_similarity"]):
+            return "kb_summary"
+        if features["overlap"] <= t["tool_overlap"]:
+            return "tavily_search"
+        return None
+
+    def route(self, query, kb_results):
+        """Returns (action, features) when the local decision is confident, else (None, features)."""
+        features = router_features(query, kb_results)
+        return self.decide(features), features
+
+def calibrate(samples, min_agreement=0.95):
+    """
+    Picks the thresholds that decide the most samples locally while agreeing with the recorded
+    LLM decisions at least min_agreement of the time. samples: [(features, llm_action)].
+    Returns (thresholds, report).
+    """
+    router = Router(thresholds=ROUTER_DEFAULTS)
+    grid = itertools.product(
+        [x / 20 for x in range(10, 21)],   # kb_overlap 0.5 .. 1.0
+        [x / 20 for x in range(0, 19)],    # kb_similarity 0.0 .. 0.9
+        [x / 20 for x in range(0, 11)],    # tool_overlap 0.0 .. 0.5
+    )
+    best, best_key, best_report = dict(ROUTER_DEFAULTS), None, None
+    for kb_overlap, kb_similarity, tool_overlap in grid:
+        if tool_overlap >= kb_overlap:
+            continue
+        thresholds = {"kb_overlap": kb_overlap, "kb_similarity": kb_similarity, "tool_overlap": tool_overlap}
+        decided = agreed = 0
+        for features, llm_action in samples:
+            action = router.decide(features, thresholds)
+            if action is not None:
+                decided += 1
+                agreed += action == llm_action
+        agreement = agreed / decided if decided else 1.0
+        if agreement < min_agreement:
+            continue
+        # most local decisions first, then the most conservative thresholds
+        key = (decided, agreement, kb_overlap, kb_similarity, -tool_overlap)
+        if best_key is None or key > best_key:
+            best, best_key = thresholds, key
+            best_report = {"samples": len(samples), "decided_locally": decided, "agreement": round(agreement, 4)}
+    return best, best_report
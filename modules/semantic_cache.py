@@ -0,0 +1,123 @@
+import copy
+import time
+import threading
+import numpy as np
+
+class SemanticCache:
+    """
+    Answer cache matched by query meaning instead of exact text.
+    Query embeddings of answered queries are kept in a small in-memory matrix; a new query
+    whose cosine similarity to a stored one passes the threshold reuses that answer and trace.
+    Exact inner-product search is used: at a few thousand entries it is faster than building
+    an approximate index and it supports in-place eviction.
+    Tavily-sourced answers expire after tool_ttl seconds, KB answers after kb_ttl.
+    """
+    def __init__(self, embeddings, threshold=0.92, max_entries=1000, kb_ttl=24 * 3600, tool_ttl=600):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.kb_ttl = kb_ttl
+        self.tool_ttl = tool_ttl
+        self._vectors = None          # (max_entries, dim) float32, unit-normalized rows
+        self._entries = [None] * max_entries
+        self._live = np.zeros(max_entries, dtype=bool)
+        self._expires = np.full(max_entries, np.inf)
+        self._last_used = np.zeros(max_entries)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _search(self, vector):
+        """Returns (entry, similarity) for the best live match above the threshold, or None."""
+        now = time.time()
+        with self._lock:
+            if self._vectors is None:
+                self.misses += 1
+                return None
+            # freshness policy: stale (e.g. Tavily) answers are dropped, never served
+            for slot in np.flatnonzero(self._live & (self._expires < now)):
+                self._live[slot] = False
+                self._entries[slot] = None
+            scores = np.where(self._live, self._vectors @ vector, -1.0)
+            slot = int(np.argmax(scores))
+            similarity = float(scores[slot])
+            if similarity < self.threshold:
+                self.misses += 1
+                return None
+            self._last_used[slot] = now
+            self.hits += 1
+            return copy.deepcopy(self._entries[slot]), similarity
+
+    def lookup(self, query):
+        if self.threshold is None:
+            return None
+        return self._search(self._normalize(self.embeddings.embed_query(query)))
+
+    async def alookup(self, query):
+        if self.threshold is None:
+            return None
+        return self._search(self._normalize(await self.embeddings.aembed_query(query)))
+
+    def lookup_batch(self, queries):
+        """lookup() for several queries with one embeddings request; a hit or None per query."""
+        if self.threshold is None or not queries:
+            return [None] * len(queries)
+        return [self._search(self._normalize(vector)) for vector in self.embeddings.embed_documents(queries)]
+
+    async def alookup_batch(self, queries):
+        """Async variant of lookup_batch()."""
+        if self.threshold is None or not queries:
+            return [None] * len(queries)
+        return [self._search(self._normalize(vector)) for vector in await self.embeddings.aembed_documents(queries)]
+
+    def _store(self, vector, query, trace):
+        used = trace.get("reasoning_trace", {}).get("used")
+        ttl = self.tool_ttl if used == "Tavily" else self.kb_ttl
+        now = time.time()
+        entry = {"query": query, "trace": copy.deepcopy(trace)}
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            free = np.flatnonzero(~self._live)
+            if free.size:
+                slot = int(free[0])
+            else:
+                # evict an expired entry first, otherwise the least recently used one
+                expired = np.flatnonzero(self._expires < now)
+                slot = int(expired[0]) if expired.size else int(np.argmin(self._last_used))
+                self.evictions += 1
+            self._vectors[slot] = vector
+            self._entries[slot] = entry
+            self._live[slot] = True
+            self._expires[slot] = now + ttl if ttl else np.inf
+            self._last_used[slot] = now
+
+    def add(self, query, trace):
+        if self.threshold is None:
+            return
+        self._store(self._normalize(self.embeddings.embed_query(query)), query, trace)
+
+    async def aadd(self, query, trace):
+        if self.threshold is None:
+            return
+        self._store(self._normalize(await self.embeddings.aembed_query(query)), query, trace)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": int(self._live.sum()),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,55 @@
+import re
+import threading
+
+# words that usually mean the KB (static documents) cannot answer the query
+RECENCY_CUES = (
+    "current", "currently", "latest", "today", "tonight", "now", "recent", "recently",
+    "news", "price", "stock", "upcoming", "this year", "this week", "who won", "score",
+)
+YEAR_PATTERN = re.compile(r"\b(19|20)\d{2}\b")
+
+def has_recency_cue(query, cues=RECENCY_CUES):
+    text = query.lower()
+    if YEAR_PATTERN.search(text):
+        return True
+    return any(re.search(rf"\b{re.escape(cue)}\b", text) for cue in cues)
+
+class SpeculationPolicy:
+    """
+    Decides when the pipeline starts the Tavily call in parallel with the LLM decision.
+    mode: "off" (default), "heuristic" (only queries with recency/entity cues) or "always".
+    max_wasted: budget of discarded speculative tool calls; once spent, speculation stops.
+    """
+    MODES = ("off", "heuristic", "always")
+
+    def __init__(self, mode="off", max_wasted=None, cues=RECENCY_CUES):
+        if mode not in self.MODES:
+            raise ValueError(f"Unsupported speculation mode: {mode}")
+        self.mode = mode
+        self.max_wasted = max_wasted
+        self.cues = cues
+        self.launched = 0
+        self.used = 0
+        self.wasted = 0
+        self._lock = threading.Lock()
+
+    def should_speculate(self, query):
+        if self.mode == "off":
+            return False
+        with self._lock:
+            if self.max_wasted is not None and self.wasted >= self.max_wasted:
+                return False
+        return self.mode == "always" or has_recency_cue(query, self.cues)
+
+    def record(self, used, wasted):
+        """Records the outcome of one speculative call and returns its trace entry."""
+        with self._lock:
+            self.launched += 1
+            self.used += int(used)
+            self.wasted += int(wasted)
+        return {"launched": True, "used": used, "wasted": wasted}
+
+    def stats(self):
+        """Totals since startup, served by /cache/stats."""
+        with self._lock:
+            return {"mode": self.mode, "launched": self.launched, "used": self.used, "wasted": self.wasted}
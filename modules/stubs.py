@@ -0,0 +1,172 @@
+"""
+Local stand-ins for the OpenAI chat, OpenAI embeddings and Tavily clients.
+They return deterministic output after an optional simulated latency, so the
+pipeline (sync, concurrent and async paths) can be run and benchmarked offline.
+An optional failure_rate makes a seeded fraction of calls raise StubProviderError.
+"""
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import numpy as np
+from types import SimpleNamespace
+from langchain_core.embeddings import Embeddings
+
+# queries mentioning any of these words are routed to Tavily by the stub LLM
+STUB_TOOL_WORDS = ("current", "latest", "today", "price", "upcoming", "2024", "2025", "who won")
+
+class StubProviderError(Exception):
+    """Injected failure of a stub provider call; behaves like a transient 503 (retried)."""
+    status_code = 503
+
+class _FailureInjector:
+    """Seeded coin flip per call, shared across threads, so failure runs are reproducible."""
+    def __init__(self, failure_rate=0.0, seed=0):
+        self.failure_rate = failure_rate
+        self.failures = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def check(self, provider):
+        if not self.failure_rate:
+            return
+        with self._lock:
+            failed = self._rng.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        if failed:
+            raise StubProviderError(f"Injected {provider} failure")
+
+def _stub_completion(messages, max_tokens):
+    prompt = messages[-1]["content"]
+    if max_tokens <= 20:
+        # decision call: look at the query line of decide_action.txt
+        query = prompt.split("Query:", 1)[-1].lower()
+        text = "action: Tavily" if any(w in query for w in STUB_TOOL_WORDS) else "action: KB"
+    else:
+        text = "Stub answer generated offline. " * 3
+    prompt_tokens = len(prompt.split())
+    completion_tokens = len(text.split())
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+        usage=SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+        ),
+    )
+
+def _stub_stream(completion):
+    """Splits a stub completion into OpenAI-style stream chunks, usage on the last one."""
+    words = completion.choices[0].message.content.strip().split(" ")
+    for i, word in enumerate(words):
+        token = word if i == 0 else " " + word
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))], usage=None)
+    yield SimpleNamespace(choices=[], usage=completion.usage)
+
+class StubChatClient:
+    """Mimics OpenAI().chat.completions.create(...)."""
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.calls = 0
+        self.faults = _FailureInjector(failure_rate, seed)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model=None, messages=None, max_tokens=250, stream=False, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        self.faults.check("chat")
+        completion = _stub_completion(messages, max_tokens)
+        return _stub_stream(completion) if stream else completion
+
+class AsyncStubChatClient:
+    """Mimics AsyncOpenAI().chat.completions.create(...)."""
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.calls = 0
+        self.faults = _FailureInjector(failure_rate, seed)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model=None, messages=None, max_tokens=250, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        self.faults.check("chat")
+        return _stub_completion(messages, max_tokens)
+
+def _stub_search(query, max_results):
+    return {"results": [
+        {"content": f"Stub web result {i + 1} for '{query}'."} for i in range(max_results)
+    ]}
+
+class StubTavilyClient:
+    """Mimics TavilyClient().search(...)."""
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.calls = 0
+        self.faults = _FailureInjector(failure_rate, seed)
+
+    def search(self, query, max_results=3, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        self.faults.check("tavily")
+        return _stub_search(query, max_results)
+
+class AsyncStubTavilyClient:
+    """Mimics AsyncTavilyClient().search(...)."""
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.calls = 0
+        self.faults = _FailureInjector(failure_rate, seed)
+
+    async def search(self, query, max_results=3, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        self.faults.check("tavily")
+        return _stub_search(query, max_results)
+
+class StubEmbeddings(Embeddings):
+    """Deterministic unit-length vectors derived from a hash of the text."""
+    def __init__(self, dim=256, latency=0.0, failure_rate=0.0, seed=0):
+        self.dim = dim
+        self.latency = latency
+        self.calls = 0
+        self.faults = _FailureInjector(failure_rate, seed)
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        time.sleep(self.latency)
+        self.faults.check("embeddings")
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        self.faults.check("embeddings")
+        return [self._vector(t) for t in texts]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+def build_stub_providers(chat_latency=0.0, tool_latency=0.0, embedding_latency=0.0,
+                         chat_failure_rate=0.0, tool_failure_rate=0.0, embedding_failure_rate=0.0, seed=0):
+    """
+    Returns the keyword arguments Pipeline passes to Retriever/Reasoner/Actor in stub mode.
+    Each client gets its own seed (seed + n), so injected failures of different providers
+    do not fire on the same call numbers.
+    """
+    return {
+        "embeddings": StubEmbeddings(latency=embedding_latency, failure_rate=embedding_failure_rate, seed=seed),
+        "chat": StubChatClient(latency=chat_latency, failure_rate=chat_failure_rate, seed=seed + 1),
+        "async_chat": AsyncStubChatClient(latency=chat_latency, failure_rate=chat_failure_rate, seed=seed + 2),
+        "tavily": StubTavilyClient(latency=tool_latency, failure_rate=tool_failure_rate, seed=seed + 3),
+        "async_tavily": AsyncStubTavilyClient(latency=tool_latency, failure_rate=tool_failure_rate, seed=seed + 4),
+    }
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import threading
+from modules.metrics import span
+
+try:
+    import fcntl  # POSIX only, used to serialize appends across worker processes
+except ImportError:
+    fcntl = None
+
+class TraceSink:
+    """
+    Append-only trace writer: one JSON line per query (NDJSON) in trace_path and the
+    formatted answer in answers_path. Lines are buffered and written in batches of
+    batch_size (or after flush_interval seconds), so a run never rewrites the whole file.
+    Safe to share between threads; appends from several processes are serialized with flock.
+    append=False truncates both files first (one file per CLI run).
+    """
+    def __init__(self, trace_path=None, answers_path=None, append=True, batch_size=32, flush_interval=1.0):
+        self.trace_path = trace_path
+        self.answers_path = answers_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._traces = []
+        self._answers = []
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+        self.written = 0
+        if not append:
+            for path in (trace_path, answers_path):
+                if path:
+                    open(path, "w", encoding="utf-8").close()
+
+    def write(self, formatted_answer, trace):
+        with self._lock:
+            if self.trace_path:
+                self._traces.append(json.dumps(trace, ensure_ascii=False, default=str) + "\n")
+            if self.answers_path:
+                self._answers.append(formatted_answer)
+            due = (len(self._traces) >= self.batch_size or len(self._answers) >= self.batch_size
+                   or time.time() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def write_result(self, result):
+        """Writes a (formatted_answer, trace) result; failed queries (None) are skipped."""
+        if result is not None:
+            self.write(*result)
+
+    @staticmethod
+    def _append(path, lines):
+        with open(path, "a", encoding="utf-8") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write("".join(lines))
+                f.flush()
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def flush(self):
+        # the lock is held while writing so batches from different threads never interleave
+        with self._lock:
+            traces, self._traces = self._traces, []
+            answers, self._answers = self._answers, []
+            self._last_flush = time.time()
+            if not traces and not answers:
+                return
+            # added try except for better error handling
+            try:
+                with span("trace_write"):
+                    if traces:
+                        self._append(self.trace_path, traces)
+                    if answers:
+                        self._append(self.answers_path, answers)
+                self.written += len(traces)
+            except Exception as e:
+                print(f"[File Save Error] Could not append traces → {e}")
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class OrderedWriter:
+    """
+    Writes one run's results to a sink in query order: results of concurrent queries that
+    finish early are held until every earlier index has been written (failed ones included).
+    """
+    def __init__(self, sink, first_index=1):
+        self.sink = sink
+        self.next_index = first_index
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def write_result(self, idx, result):
+        with self._lock:
+            self._pending[idx] = result
+            while self.next_index in self._pending:
+                self.sink.write_result(self._pending.pop(self.next_index))
+                self.next_index += 1
+
+    def close(self):
+        """Writes whatever is still held (a run that stopped early), in index order."""
+        with self._lock:
+            for idx in sorted(self._pending):
+                self.sink.write_result(self._pending.pop(idx))
+
+def iter_traces(path):
+    """
+    Yields trace entries one at a time from an NDJSON trace file.
+    Older answers_trace.json files (a JSON list, or a dict keyed by query) are loaded whole.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        first = f.readline()
+        try:
+            entry = json.loads(first) if first.strip() not in ("", "[", "{") else None
+        except json.JSONDecodeError:
+            entry = None
+        if isinstance(entry, dict):
+            yield entry
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    yield from (data.values() if isinstance(data, dict) else data)